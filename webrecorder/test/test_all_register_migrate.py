@@ -221,6 +221,9 @@ class TestRegisterMigrate(FullStackTests):
 
         assert res.json == {'title': 'FOOD BAR', 'rec_id': 'food-bar', 'coll_id': 'test-migrate'}
 
+        # no rename left in progress
+        assert self.redis.keys('h:rename:*') == []
+
         #time.sleep(2.0)
 
         res = self.testapp.get('/someuser/test-migrate/food-bar/mp_/http://httpbin.org/get?food=bar')
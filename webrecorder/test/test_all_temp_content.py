@@ -25,12 +25,19 @@ class TestTempContent(FullStackTests):
         'r:{user}:{coll}:{rec}:cdxj',
         'r:{user}:{coll}:{rec}:info',
         'r:{user}:{coll}:{rec}:page',
+        'r:{user}:{coll}:{rec}:page_ts',
         'r:{user}:{coll}:{rec}:warc',
+        'r:{user}:{coll}:{rec}:warc_size',
         'c:{user}:{coll}:info',
+        'c:{user}:{coll}:recs',
         'u:{user}:info',
+        'u:{user}:warcs',
+        'u:{user}:colls',
         'h:roles',
         'h:defaults',
         'h:temp-usage',
+        'h:key-registry',
+        'z:colls',
     ]
 
     def setup_class(cls, **kwargs):
@@ -303,6 +310,41 @@ class TestTempContent(FullStackTests):
         cdx[1]['url'] = 'http://httpbin.org/get?food=bar'
         cdx[1]['mime'] = '-'
 
+    def test_anon_download_rec_range(self):
+        res = self._get_anon('/temp/my-rec2/$download')
+        full = res.body
+
+        assert res.headers['Accept-Ranges'] == 'bytes'
+        assert int(res.headers['Content-Length']) == len(full)
+
+        etag = res.headers['ETag']
+
+        # resume partway through, content must match the full download
+        res = self.testapp.get('/' + self.anon_user + '/temp/my-rec2/$download',
+                               headers={'Range': 'bytes=100-', 'If-Range': etag},
+                               status=206)
+
+        assert res.headers['Content-Range'] == 'bytes 100-{0}/{1}'.format(len(full) - 1, len(full))
+        assert res.headers['ETag'] == etag
+        assert res.body == full[100:]
+
+        res = self.testapp.get('/' + self.anon_user + '/temp/my-rec2/$download',
+                               headers={'Range': 'bytes=-50'},
+                               status=206)
+
+        assert res.body == full[-50:]
+
+        # changed since, send everything
+        res = self.testapp.get('/' + self.anon_user + '/temp/my-rec2/$download',
+                               headers={'Range': 'bytes=100-', 'If-Range': '"other"'},
+                               status=200)
+
+        assert res.body == full
+
+        res = self.testapp.get('/' + self.anon_user + '/temp/my-rec2/$download',
+                               headers={'Range': 'bytes={0}-'.format(len(full))},
+                               status=416)
+
     def test_anon_download_coll(self):
         res = self._get_anon('/temp/$download')
 
@@ -341,6 +383,9 @@ class TestTempContent(FullStackTests):
 
         assert res.json == {'deleted_id': 'my-recording'}
 
+        # not found once queued for delete, before the delete worker is done
+        self.testapp.get('/api/v1/recordings/my-recording?user={user}&coll=temp'.format(user=self.anon_user), status=404)
+
         res = self.testapp.delete('/api/v1/recordings/{rec}?user={user}&coll=temp'.format(rec=quote('вэбрекордэр'), user=self.anon_user))
 
         assert res.json == {'deleted_id': 'вэбрекордэр'}
@@ -349,6 +394,10 @@ class TestTempContent(FullStackTests):
 
         time.sleep(2.0)
 
+        # delete jobs done
+        assert not self.redis.exists('h:delete-jobs')
+        assert not self.redis.exists('q:deletes')
+
         self._assert_size_all_eq(user, 'temp', 'my-rec2')
 
         anon_dir = os.path.join(self.warcs_dir, user)
@@ -431,7 +480,7 @@ class TestTempContent(FullStackTests):
 
         time.sleep(4.0)
 
-        assert set(self.redis.keys()) == set([b'h:roles', b'h:defaults', b'h:temp-usage'])
+        assert set(self.redis.keys()) == set([b'h:roles', b'h:defaults', b'h:temp-usage', b'h:key-registry'])
 
         assert glob.glob(os.path.join(self.warcs_dir, 'temp$*')) == []
         #assert os.listdir(os.path.join(self.warcs_dir, 'anon')) == []
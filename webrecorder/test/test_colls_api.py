@@ -32,6 +32,11 @@ class TestWebRecCollsAPI(BaseWRTests):
 
         assert self.redis.exists('c:' + self.anon_user + ':temp-2:info')
 
+        # collection indexes, by creation time
+        assert self.redis.zrange('u:' + self.anon_user + ':colls', 0, -1) == [b'temp', b'temp-2']
+        assert set(self.redis.zrange('z:colls', 0, -1)) == set([(self.anon_user + ':temp').encode('utf-8'),
+                                                               (self.anon_user + ':temp-2').encode('utf-8')])
+
     def test_get_anon_coll(self):
         res = self.testapp.get('/api/v1/collections/temp?user={user}'.format(user=self.anon_user))
 
@@ -47,6 +52,32 @@ class TestWebRecCollsAPI(BaseWRTests):
         assert rec['recordings'] == []
 
 
+    def test_get_anon_coll_info_once(self):
+        # collection info loaded once per request for access checks and metadata
+        manager_redis = self.appcont.manager.redis
+        coll_key = 'c:' + self.anon_user + ':temp:info'
+        calls = []
+
+        def count(name):
+            func = getattr(manager_redis, name)
+            def wrapped(key, *args, **kwargs):
+                if key == coll_key:
+                    calls.append(name)
+                return func(key, *args, **kwargs)
+            return wrapped
+
+        for name in ('hget', 'hmget', 'hgetall', 'exists'):
+            setattr(manager_redis, name, count(name))
+
+        try:
+            res = self.testapp.get('/api/v1/collections/temp?user={user}'.format(user=self.anon_user))
+        finally:
+            for name in ('hget', 'hmget', 'hgetall', 'exists'):
+                delattr(manager_redis, name)
+
+        assert res.json['collection']['id'] == 'temp'
+        assert calls == ['hgetall']
+
     def test_list_anon_collections(self):
         res = self.testapp.get('/api/v1/collections?user={user}'.format(user=self.anon_user))
 
@@ -63,6 +94,18 @@ class TestWebRecCollsAPI(BaseWRTests):
         assert colls[1]['title'] == 'Temp 2'
         assert colls[1]['download_url'] == 'http://localhost:80/{user}/temp-2/$download'.format(user=self.anon_user)
 
+    def test_list_anon_collections_indexed(self):
+        # list from collection index, once built, instead of scanning
+        self.redis.hset('h:key-registry', 'built_at', int(time.time()))
+
+        try:
+            res = self.testapp.get('/api/v1/collections?user={user}'.format(user=self.anon_user))
+        finally:
+            self.redis.hdel('h:key-registry', 'built_at')
+
+        colls = res.json['collections']
+        assert [coll['id'] for coll in colls] == ['temp', 'temp-2']
+
     #def test_error_already_exists(self):
     #    res = self.testapp.post('/api/v1/collections?user={user}'.format(user=self.anon_user), params={'title': 'temp'}, status=400)
     #    assert res.json == {'error_message': 'Collection already exists', 'id': 'temp', 'title': 'Temp'}
@@ -0,0 +1,301 @@
+from webrecorder.downloadcontroller import DownloadController, DownloadPlan, WarcInfoCache
+
+from fakeredis import FakeStrictRedis
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+# ============================================================================
+class TestDownloadPlan(object):
+    @classmethod
+    def setup_class(cls):
+        cls.root_dir = tempfile.mkdtemp()
+
+        cls.warc_a = os.path.join(cls.root_dir, 'a.warc.gz')
+        cls.warc_b = os.path.join(cls.root_dir, 'b.warc.gz')
+
+        cls.data_a = os.urandom(300 * 1024)
+        cls.data_b = os.urandom(1000)
+
+        with open(cls.warc_a, 'wb') as fh:
+            fh.write(cls.data_a)
+
+        with open(cls.warc_b, 'wb') as fh:
+            fh.write(cls.data_b)
+
+        cls.full = b'coll-info' + cls.data_a + b'rec-info' + cls.data_b
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.root_dir)
+
+    def get_plan(self, sendfile=None):
+        plan = DownloadPlan(loader=object(), sendfile=sendfile)
+        plan.add_buffer(b'coll-info')
+        plan.add_warc('http://example.com/a.warc.gz', len(self.data_a), self.warc_a)
+        plan.add_buffer(b'rec-info')
+        plan.add_warc('http://example.com/b.warc.gz', len(self.data_b), self.warc_b)
+        return plan
+
+    def send(self, plan, start=0, length=None):
+        """ write yielded chunks and sendfile() bytes in order,
+        as the server would
+        """
+        out = []
+        sent = []
+
+        def sendfile(fh, offset, length):
+            # headers and earlier bytes already written
+            assert out
+            fh.seek(offset)
+            out.append(fh.read(length))
+            sent.append(length)
+
+        plan.sendfile = sendfile
+
+        for chunk in plan.iter_range(start, length):
+            out.append(chunk)
+
+        return b''.join(out), sent
+
+    def test_iter_no_sendfile(self):
+        plan = self.get_plan()
+        assert plan.size == len(self.full)
+        assert b''.join(plan.iter_range()) == self.full
+        assert b''.join(plan.iter_range(20, 1000)) == self.full[20:1020]
+
+    def test_sendfile_full(self):
+        res, sent = self.send(self.get_plan())
+        assert res == self.full
+
+        # only the warcinfo records read in python
+        assert sent == [len(self.data_a), len(self.data_b)]
+
+    def test_sendfile_ranges(self):
+        plan = self.get_plan()
+        size = len(self.full)
+
+        for start, length in [(0, size), (5, 200000), (9, len(self.data_a)),
+                              (100, size - 100), (size - 1010, 1010), (size - 5, 5)]:
+            res, sent = self.send(plan, start, length)
+            assert res == self.full[start:start + length]
+
+    def test_sendfile_range_starts_in_warc(self):
+        res, sent = self.send(self.get_plan(), 100, 200000)
+        assert res == self.full[100:200100]
+
+        # first block yielded, to send headers, rest with sendfile()
+        assert sent == [200000 - 128 * 1024]
+
+
+# ============================================================================
+class TestWarcInfoCache(object):
+    def test_hit_and_miss(self):
+        cache = WarcInfoCache(100, 600)
+        cache.set(('a', 1), b'abc')
+
+        assert cache.get(('a', 1)) == b'abc'
+        assert cache.get(('a', 2)) is None
+        assert cache.size == 3
+
+    def test_expired(self):
+        cache = WarcInfoCache(100, 600)
+        cache.set('a', b'abc')
+
+        cache.cache['a'] = (b'abc', time.time() - 1)
+
+        assert cache.get('a') is None
+        assert cache.size == 0
+        assert 'a' not in cache.cache
+
+    def test_least_recently_used_removed(self):
+        cache = WarcInfoCache(10, 600)
+        cache.set('a', b'aaaa')
+        cache.set('b', b'bbbb')
+
+        assert cache.get('a') == b'aaaa'
+
+        cache.set('c', b'cccc')
+
+        assert cache.get('b') is None
+        assert cache.get('a') == b'aaaa'
+        assert cache.get('c') == b'cccc'
+        assert cache.size == 8
+
+        # larger than the cache, never kept
+        cache.set('d', b'd' * 11)
+        assert cache.get('d') is None
+        assert cache.size == 8
+
+    def test_disabled(self):
+        cache = WarcInfoCache(100, 0)
+        cache.set('a', b'abc')
+
+        assert cache.get('a') is None
+
+
+# ============================================================================
+class FakeManager(object):
+    def __init__(self, redis=None):
+        self.redis = redis
+        self.pages = [{'url': 'http://example.com/', 'timestamp': '2016'}]
+        self.is_admin = True
+        self.num_lists = 0
+
+    def list_pages(self, user, coll, rec):
+        self.num_lists += 1
+        return [page for page in self.pages if self.is_admin or not page.get('hidden')]
+
+    def can_admin_coll(self, user, coll):
+        return self.is_admin
+
+
+# ============================================================================
+class TestRecWarcInfoCache(object):
+    def setup_method(self):
+        self.controller = DownloadController.__new__(DownloadController)
+        self.controller.manager = FakeManager()
+        self.controller.warcinfo_cache = WarcInfoCache(100000, 600)
+
+        # metadata only, to check which pages were included
+        def create_warcinfo(creator, title, metadata, source, filename, id_key=''):
+            return json.dumps(metadata['pages']).encode('utf-8')
+
+        self.controller.create_warcinfo = create_warcinfo
+
+        self.collection = {'id': 'coll', 'title': 'Coll'}
+        self.recording = {'id': 'rec', 'title': 'Rec', 'size': 100, 'updated_at': 1}
+
+    def get_pages(self):
+        buff = self.controller.create_rec_warcinfo('user', self.collection, self.recording,
+                                                   'download.warc.gz')
+        return json.loads(buff.decode('utf-8'))
+
+    def test_cached(self):
+        pages = self.get_pages()
+        assert self.get_pages() == pages
+        assert self.controller.manager.num_lists == 1
+
+    def test_pages_changed(self):
+        manager = self.controller.manager
+        self.get_pages()
+
+        # page hidden, and pages version updated
+        manager.pages[0]['hidden'] = '1'
+        self.recording['pages_version'] = 1
+
+        pages = self.get_pages()
+        assert pages[0]['hidden'] == '1'
+        assert manager.num_lists == 2
+
+        # hidden page not included for other users
+        manager.is_admin = False
+        assert self.get_pages() == []
+        assert manager.num_lists == 3
+
+        manager.is_admin = True
+        assert self.get_pages() == pages
+        assert manager.num_lists == 3
+
+    def test_recording_changed(self):
+        self.get_pages()
+
+        self.recording['title'] = 'New Title'
+        self.get_pages()
+
+        self.recording['updated_at'] = 2
+        self.get_pages()
+
+        self.collection['title'] = 'New Coll Title'
+        self.get_pages()
+
+        assert self.controller.manager.num_lists == 4
+        assert self.get_pages() == self.controller.manager.pages
+        assert self.controller.manager.num_lists == 4
+
+
+# ============================================================================
+class TestDownloadOrder(object):
+    WARC_KEY = 'r:user:coll:rec:warc'
+    SIZE_KEY = 'r:user:coll:rec:warc_size'
+
+    def setup_method(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+
+        controller = DownloadController.__new__(DownloadController)
+        controller.manager = FakeManager(self.redis)
+        controller.warcinfo_cache = WarcInfoCache(100000, 600)
+        controller.warc_key_templ = 'r:{user}:{coll}:{rec}:warc'
+        controller.warc_size_key_templ = 'r:{user}:{coll}:{rec}:warc_size'
+        controller.download_local_warcs = True
+        controller.full_warc_prefix = ''
+
+        def create_warcinfo(creator, title, metadata, source, filename, id_key=''):
+            return 'warcinfo {0}\n'.format(title).encode('utf-8')
+
+        controller.create_warcinfo = create_warcinfo
+
+        self.controller = controller
+
+        self.collection = {'id': 'coll', 'title': 'Coll'}
+        self.recording = {'id': 'rec', 'title': 'Rec', 'size': 0}
+
+        # WARC name, path and redis hash order all differ
+        warcs = [('rec-3.warc.gz', 'a.warc.gz'),
+                 ('rec-1.warc.gz', 'c.warc.gz'),
+                 ('rec-2.warc.gz', 'b.warc.gz')]
+
+        self.data = {}
+
+        for name, filename in warcs:
+            path = os.path.join(self.root_dir, filename)
+            data = os.urandom(1000)
+
+            with open(path, 'wb') as fh:
+                fh.write(data)
+
+            self.redis.hset(self.WARC_KEY, name, path)
+            self.redis.hset(self.SIZE_KEY, name, len(data))
+
+            self.data[name] = data
+            self.recording['size'] += len(data)
+
+        self.coll_info = b'coll-info'
+
+    def teardown_method(self):
+        shutil.rmtree(self.root_dir)
+
+    def get_expected(self):
+        return (self.coll_info + b'warcinfo Coll/Rec\n' + self.data['rec-1.warc.gz'] +
+                self.data['rec-2.warc.gz'] + self.data['rec-3.warc.gz'])
+
+    def get_planned(self):
+        plan = self.controller.plan_download('user', self.collection, [self.recording],
+                                             self.coll_info, 'download.warc.gz')
+        return plan, b''.join(plan.iter_range())
+
+    def test_planned_and_chunked(self):
+        plan, planned = self.get_planned()
+        assert plan.seekable
+
+        chunked = b''.join(self.controller.iter_download('user', self.collection,
+                                                         [self.recording],
+                                                         self.coll_info,
+                                                         'download.warc.gz'))
+
+        assert planned == self.get_expected()
+        assert chunked == planned
+
+    def test_planned_no_sizes(self):
+        self.redis.hdel(self.SIZE_KEY, 'rec-2.warc.gz')
+
+        plan, planned = self.get_planned()
+        assert not plan.seekable
+
+        assert planned == self.get_expected()
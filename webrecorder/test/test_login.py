@@ -309,3 +309,19 @@ class TestLogin(BaseWRTests):
         assert self.testapp.cookies.get('__test_sesh', '') != ''
 
 
+
+    def test_home_page_logged_in(self):
+        with patch.object(self.appcont, 'fill_anon_info', return_value=False) as fill_anon_info:
+            res = self.testapp.get('/')
+
+        assert res.status_code == 200
+        assert not fill_anon_info.called
+
+    def test_home_page_logged_out(self):
+        res = self.testapp.get('/_logout')
+
+        with patch.object(self.appcont, 'fill_anon_info', return_value=False) as fill_anon_info:
+            res = self.testapp.get('/')
+
+        assert res.status_code == 200
+        assert fill_anon_info.called
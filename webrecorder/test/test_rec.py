@@ -4,11 +4,26 @@ from fakeredis import FakeStrictRedis
 from .testutils import FullStackTests
 
 from pywb.webagg.test.testutils import LiveServerTests
+from pywb.warc.archiveiterator import ArchiveIterator
 
+from webrecorder.rec.webrecrecorder import WebRecRecorder
+from webrecorder.rec.storagecommitter import StorageCommitter
+from webrecorder.rec.webrecrecorder import TempWriteBuffer, SkipCheckingMultiFileWARCWriter
+from webrecorder.rec.webrecrecorder import LocalTTLCache
+from webrecorder.redisutils import KeyRegistry
+from webrecorder.utils import load_wr_config
+
+import gevent
+import glob
+import json
 import os
+import shutil
+import tempfile
 
 import webtest
 
+from mock import patch
+
 from six.moves.urllib.parse import quote, urlsplit
 import time
 
@@ -31,6 +46,10 @@ class TestWebRecRecorder(FullStackTests):
 
         app = init()
         cls.wr_rec = app.wr
+        cls.wr_rec.key_registry.build()
+
+        # responses cross several pending size flushes
+        cls.wr_rec.pending_flush_size = 64
         cls.testapp = webtest.TestApp(app)
 
     def _test_warc_write(self, url, user, coll, rec):
@@ -62,10 +81,13 @@ class TestWebRecRecorder(FullStackTests):
 
         assert set(keys) == set([
             'r:USER:COLL:REC:warc',
+            'r:USER:COLL:REC:warc_size',
             'r:USER:COLL:REC:cdxj',
             'r:USER:COLL:REC:info',
             'c:USER:COLL:info',
-            'u:USER:info'
+            'u:USER:info',
+            'u:USER:warcs',
+            'h:key-registry'
         ])
 
         resp.charset = 'utf-8'
@@ -78,6 +100,24 @@ class TestWebRecRecorder(FullStackTests):
 
         assert self.redis.hget('r:USER:COLL:REC:info', 'updated_at') is not None
 
+        # warc ownership index
+        warcs = self.redis.hkeys('r:USER:COLL:REC:warc')
+        assert len(warcs) == 1
+        assert self.redis.hget('u:USER:warcs', warcs[0]) == b'COLL:REC'
+
+        # no pending size left once response is written
+        assert int(self.redis.hget('r:USER:COLL:REC:info', 'pending_size') or 0) == 0
+
+        # response written to the warc in full
+        warc_files = glob.glob(os.path.join(self.warcs_dir, '**', '*.warc*'), recursive=True)
+        assert len(warc_files) == 1
+
+        with open(warc_files[0], 'rb') as fh:
+            payloads = [record.stream.read() for record in ArchiveIterator(fh)()
+                        if record.rec_type == 'response']
+
+        assert payloads == [resp.body]
+
     def test_multi_user_rec_2(self):
         resp = self._test_warc_write('http://httpbin.org/get?boo=far', user='USER', coll='COLL', rec='REC2')
 
@@ -87,14 +127,546 @@ class TestWebRecRecorder(FullStackTests):
         assert set(keys) == set([
             'r:USER:COLL:REC:warc',
             'r:USER:COLL:REC2:warc',
+            'r:USER:COLL:REC:warc_size',
+            'r:USER:COLL:REC2:warc_size',
             'r:USER:COLL:REC:cdxj',
             'r:USER:COLL:REC2:cdxj',
             'r:USER:COLL:REC:info',
             'r:USER:COLL:REC2:info',
             'c:USER:COLL:info',
-            'u:USER:info'
+            'u:USER:info',
+            'u:USER:warcs',
+            'h:key-registry'
         ])
 
         resp.charset = 'utf-8'
         assert '"boo": "far"' in resp.text
 
+
+# ============================================================================
+class TestTempWriteBuffer(object):
+    INFO_KEY = 'r:USER:COLL:REC:info'
+
+    def setup_method(self, method):
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+
+    def pending(self):
+        return (int(self.redis.hget(self.INFO_KEY, 'pending_count') or 0),
+                int(self.redis.hget(self.INFO_KEY, 'pending_size') or 0))
+
+    def test_flush_by_size(self):
+        buff = TempWriteBuffer(self.redis, self.INFO_KEY, 'response', 'http://example.com/',
+                               flush_size=1000)
+
+        data = os.urandom(300 * 12)
+
+        for i in range(12):
+            buff.write(data[i * 300:(i + 1) * 300])
+
+            # size sent once every 1000 bytes or more
+            written = (i + 1) * 300
+            flushed = self.pending()[1]
+            assert written - 1000 < flushed <= written
+            assert flushed in (0, 1200, 2400, 3600)
+
+        assert self.pending() == (1, 3600)
+
+        # spooled to disk past max size, still written in full
+        large = os.urandom(600 * 1024)
+        buff.write(large)
+        data += large
+
+        assert self.pending() == (1, len(data))
+
+        buff.seek(0)
+        assert buff.read() == data
+
+        buff.close()
+        assert self.pending() == (0, 0)
+
+    def test_close_before_flush(self):
+        buff = TempWriteBuffer(self.redis, self.INFO_KEY, 'response', 'http://example.com/',
+                               flush_size=1000)
+
+        data = os.urandom(500)
+        buff.write(data[:200])
+        buff.write(data[200:])
+
+        # not counted until first flush
+        assert self.pending() == (0, 0)
+
+        buff.seek(0)
+        assert buff.read() == data
+
+        buff.close()
+        assert self.pending() == (0, 0)
+        assert self.redis.keys() == []
+
+    def test_unbuffered(self):
+        buff = TempWriteBuffer(self.redis, self.INFO_KEY, 'response', 'http://example.com/')
+
+        assert self.pending() == (1, 0)
+
+        data = os.urandom(500)
+        buff.write(data[:200])
+        assert self.pending() == (1, 200)
+
+        buff.write(data[200:])
+        assert self.pending() == (1, 500)
+
+        buff.seek(0)
+        assert buff.read() == data
+
+        buff.close()
+        assert self.pending() == (0, 0)
+
+
+# ============================================================================
+class TestWarcOwners(object):
+    def setup_method(self, method):
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+
+        self.committer = StorageCommitter.__new__(StorageCommitter)
+        self.committer.redis = self.redis
+        self.committer.warc_key_templ = 'r:{user}:{coll}:{rec}:warc'
+        self.committer.warc_owner_key_templ = 'u:{user}:warcs'
+        self.committer.warc_owner_built_key = 'h:warc-owners-built'
+        self.committer.full_warc_prefix = 'local+http://nginx:6090'
+
+    def test_warc_owner_index_built_once(self):
+        r = self.redis
+        r.hset('r:a:c:r:warc', 'old.warc.gz', 'local+http://nginx:6090/data/a/old.warc.gz')
+        r.hset('r:a:c:r:warc', 'done.warc.gz', 's3://bucket/accounts/a/warcs/done.warc.gz')
+
+        # new WARC written by the recorder before the first commit pass
+        r.hset('r:a:c:r2:warc', 'new.warc.gz', 'local+http://nginx:6090/data/a/new.warc.gz')
+        r.hset('u:a:warcs', 'new.warc.gz', 'c:r2')
+
+        assert self.committer.get_warc_owner('a', 'old.warc.gz') == ('c', 'r')
+        assert self.committer.get_warc_owner('a', 'new.warc.gz') == ('c', 'r2')
+
+        # already committed WARCs are not indexed
+        assert self.committer.get_warc_owner('a', 'done.warc.gz') == (None, None)
+        assert not r.hexists('u:a:warcs', 'done.warc.gz')
+        assert r.hexists('h:warc-owners-built', 'a')
+
+        # not built again, even if a WARC is not found
+        r.hset('r:a:c:r3:warc', 'later.warc.gz', 'local+http://nginx:6090/data/a/later.warc.gz')
+        assert self.committer.get_warc_owner('a', 'later.warc.gz') == (None, None)
+
+
+# ============================================================================
+class TestClosedWarcQueue(object):
+    QUEUE_KEY = 'q:closed-warcs'
+
+    def setup_method(self, method):
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+
+        self.warcs_dir = tempfile.mkdtemp()
+
+        self.writer = SkipCheckingMultiFileWARCWriter(
+                        dir_template=os.path.join(self.warcs_dir, '{user}') + os.path.sep,
+                        filename_template='rec-{timestamp}.warc.gz',
+                        redis=self.redis,
+                        closed_queue_key=self.QUEUE_KEY,
+                        temp_prefix='temp-')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.warcs_dir)
+
+    def close_warc(self, user):
+        user_dir = os.path.join(self.warcs_dir, user)
+        os.makedirs(user_dir)
+
+        fh = open(os.path.join(user_dir, 'rec.warc.gz'), 'a+b')
+        self.writer._close_file(fh)
+
+        assert fh.closed
+        return fh.name
+
+    def test_queue_closed(self):
+        filename = self.close_warc('USER')
+        filename2 = self.close_warc('USER2')
+
+        assert self.redis.lrange(self.QUEUE_KEY, 0, -1) == [filename.encode('utf-8'),
+                                                            filename2.encode('utf-8')]
+
+    def test_skip_temp(self):
+        self.close_warc('temp-abc')
+
+        assert self.redis.llen(self.QUEUE_KEY) == 0
+
+    def test_no_queue(self):
+        self.writer.closed_queue_key = None
+        self.close_warc('USER')
+
+        assert self.redis.keys() == []
+
+
+# ============================================================================
+class TestDeleteWorker(object):
+    INFO_KEY = 'r:USER:COLL:REC:info'
+    WARC_KEY = 'r:USER:COLL:REC:warc'
+
+    def setup_method(self, method):
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+
+        self.warcs_dir = tempfile.mkdtemp()
+        os.environ['RECORD_ROOT'] = self.warcs_dir
+        os.environ.setdefault('WEBAGG_HOST', 'http://localhost:8010')
+        os.environ.setdefault('REDIS_BASE_URL', 'redis://localhost:6379/2')
+
+        self.has_clients = True
+        self.messages = []
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.warcs_dir)
+
+    def make_recorder(self):
+        config = load_wr_config()
+
+        wr = WebRecRecorder(config)
+        wr.redis = self.redis
+        wr.key_registry = KeyRegistry(self.redis, config)
+        wr.storage_committer = None
+
+        wr.delete_poll_secs = 0.01
+        wr.delete_batch_secs = 0
+
+        def queue_message(channel, message):
+            self.messages.append((channel, message))
+            return self.has_clients
+
+        wr.queue_message = queue_message
+        return wr
+
+    def add_rec(self, wr):
+        self.warc_path = os.path.join(self.warcs_dir, 'USER', 'rec.warc.gz')
+
+        self.redis.hmset(self.INFO_KEY, {'id': 'REC', 'size': 100})
+        self.redis.hmset('c:USER:COLL:info', {'id': 'COLL', 'size': 100})
+        self.redis.hset('u:USER:info', 'size', 100)
+
+        self.redis.hset(self.WARC_KEY, 'rec.warc.gz', wr.full_warc_prefix + self.warc_path)
+        self.redis.zadd('r:USER:COLL:REC:cdxj', 0, 'com,example)/ 2016 {}')
+
+    def get_job(self, job_id):
+        return json.loads(self.redis.hget('h:delete-jobs', job_id).decode('utf-8'))
+
+    def assert_deleted(self):
+        assert not self.redis.exists('h:delete-jobs')
+        assert self.redis.zcard('q:deletes') == 0
+
+        assert not self.redis.exists(self.INFO_KEY)
+        assert not self.redis.exists(self.WARC_KEY)
+        assert not self.redis.exists('r:USER:COLL:REC:cdxj')
+
+        assert self.redis.hget('c:USER:COLL:info', 'size') == b'0'
+
+    def test_leased_job_run_once(self):
+        recorders = [self.make_recorder(), self.make_recorder()]
+        self.add_rec(recorders[0])
+
+        recorders[0].queue_delete('rec', 'USER', 'COLL', 'REC')
+
+        runs = []
+
+        for wr in recorders:
+            def run_delete(job_id, wr=wr, run_delete=wr.run_delete):
+                runs.append(job_id)
+
+                # other worker polls while this job is leased
+                gevent.sleep(0.1)
+                run_delete(job_id)
+
+            wr.run_delete = run_delete
+
+        loops = [gevent.spawn(wr.delete_loop) for wr in recorders]
+        gevent.sleep(0.5)
+        gevent.killall(loops)
+
+        assert len(runs) == 1
+        self.assert_deleted()
+
+    def test_resume_after_failed_stage(self):
+        wr = self.make_recorder()
+        self.add_rec(wr)
+
+        wr.queue_delete('rec', 'USER', 'COLL', 'REC')
+
+        # fails in the 'local' stage, no recorders to delete local WARCs
+        self.has_clients = False
+
+        job_id = wr._claim_delete()
+        wr.run_delete(job_id)
+
+        job = self.get_job(job_id)
+        assert job['stage'] == 'local'
+        assert job['error'] == 'no local clients'
+        assert job['local_delete_list'] == [self.warc_path]
+
+        # still tombstoned, keys not yet deleted
+        assert self.redis.hget(self.INFO_KEY, 'deleted') == job_id.encode('utf-8')
+        assert self.redis.exists(self.WARC_KEY)
+
+        # retried after delete_retry_secs
+        assert wr._claim_delete() is None
+        self.redis.zadd('q:deletes', 0, job_id)
+
+        # resumes from the failed stage, WARCs not collected again
+        def iter_all_warcs(*args):
+            raise Exception('already collected')
+
+        wr._iter_all_warcs = iter_all_warcs
+        self.has_clients = True
+        self.messages = []
+
+        assert wr._claim_delete() == job_id
+        wr.run_delete(job_id)
+
+        assert self.messages == [('delete', {'delete_list': [self.warc_path]})]
+        self.assert_deleted()
+
+
+# ============================================================================
+class TestAddCdxj(object):
+    CDXJ_KEY = 'r:USER:COLL:REC:cdxj'
+
+    def setup_method(self, method):
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+
+        os.environ.setdefault('RECORD_ROOT', tempfile.gettempdir())
+        os.environ.setdefault('WEBAGG_HOST', 'http://localhost:8010')
+        os.environ.setdefault('REDIS_BASE_URL', 'redis://localhost:6379/2')
+
+        wr = WebRecRecorder(load_wr_config())
+        wr.redis = self.redis
+
+        self.indexer = wr.init_indexer()
+
+        # count pipelines executed
+        self.pipelines = 0
+        pipeline = self.redis.pipeline
+
+        def count_pipeline(*args, **kwargs):
+            self.pipelines += 1
+            return pipeline(*args, **kwargs)
+
+        self.redis.pipeline = count_pipeline
+
+        self.params = {'param.user': 'USER',
+                       'param.coll': 'COLL',
+                       'param.rec': 'REC'}
+
+    def make_cdxj(self, count):
+        return ['com,example)/{0:05d} 2016 {{"offset": "{1}"}}'.format(i, i * 100).encode('utf-8')
+                for i in range(count)]
+
+    def test_add_multiple_batches(self):
+        self.indexer.CDXJ_ZADD_SIZE = 7
+        self.indexer.CDXJ_BATCH_SIZE = 20
+
+        cdx_list = self.make_cdxj(103)
+
+        # unsorted, with empty lines skipped
+        self.indexer.add_cdxj(list(reversed(cdx_list)) + [b''], self.params, 'rec.warc.gz', 1000)
+
+        # 6 batches, plus size update
+        assert self.pipelines == 6 + 1
+
+        assert self.redis.zcard(self.CDXJ_KEY) == 103
+        assert self.redis.zrange(self.CDXJ_KEY, 0, -1) == cdx_list
+
+        assert self.redis.hget('r:USER:COLL:REC:info', 'size') == b'1000'
+
+    def test_add_default_batch_size(self):
+        cdx_list = self.make_cdxj(self.indexer.CDXJ_BATCH_SIZE + 1500)
+
+        self.indexer.add_cdxj(cdx_list, self.params, 'rec.warc.gz', 1000)
+
+        assert self.pipelines == 2 + 1
+        assert self.redis.zrange(self.CDXJ_KEY, 0, -1) == cdx_list
+
+
+# ============================================================================
+class TestLocalTTLCache(object):
+    def test_expire(self):
+        cache = LocalTTLCache(10)
+
+        with patch('time.time', lambda: 1000):
+            cache.set('key', 'value')
+            cache.set('skip', False)
+
+            assert cache.get('key') == 'value'
+            assert cache.get('skip') == False
+            assert cache.get('other') == None
+
+        with patch('time.time', lambda: 1010):
+            assert cache.get('key') == 'value'
+
+        with patch('time.time', lambda: 1011):
+            assert cache.get('key') == None
+            assert cache.get('skip') == None
+
+        assert cache.cache == {}
+
+    def test_max_size(self):
+        cache = LocalTTLCache(10, max_size=2)
+
+        with patch('time.time', lambda: 1000):
+            cache.set('a', 1)
+
+        with patch('time.time', lambda: 1005):
+            cache.set('b', 2)
+
+        # expired entries purged first
+        with patch('time.time', lambda: 1011):
+            cache.set('c', 3)
+            assert sorted(cache.cache) == ['b', 'c']
+
+            # then cleared if still full
+            cache.set('d', 4)
+            assert sorted(cache.cache) == ['d']
+
+    def test_disabled(self):
+        cache = LocalTTLCache(0)
+        cache.set('key', 'value')
+
+        assert cache.get('key') == None
+        assert cache.cache == {}
+
+
+# ============================================================================
+class FakePubSub(object):
+    """ Yields the given messages once subscribed, then stops listening
+    """
+    def __init__(self, messages):
+        self.messages = messages
+        self.channels = []
+
+    def subscribe(self, channel):
+        self.channels.append(channel)
+
+    def listen(self):
+        for channel in self.channels:
+            yield {'type': 'subscribe', 'channel': channel.encode('utf-8'), 'data': 1}
+
+        for channel, data in self.messages:
+            yield {'type': 'message', 'channel': channel.encode('utf-8'), 'data': data.encode('utf-8')}
+
+
+# ============================================================================
+class TestCachedChecks(object):
+    INFO_KEY = 'r:USER:COLL:REC:info'
+    COLL_KEY = 'c:USER:COLL:info'
+    SKIP_KEY = 'us:USER:s:http://example.com/'
+
+    def setup_method(self, method):
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+
+        self.warcs_dir = tempfile.mkdtemp()
+        os.environ['RECORD_ROOT'] = self.warcs_dir
+        os.environ.setdefault('WEBAGG_HOST', 'http://localhost:8010')
+        os.environ.setdefault('REDIS_BASE_URL', 'redis://localhost:6379/2')
+
+        self.writer = SkipCheckingMultiFileWARCWriter(
+                        dir_template=os.path.join(self.warcs_dir, '{user}') + os.path.sep,
+                        filename_template='rec-{timestamp}.warc.gz',
+                        redis=self.redis,
+                        skip_key_templ='us:{user}:s:{url}',
+                        key_template='r:{user}:{coll}:{rec}:info',
+                        coll_key_template='c:{user}:{coll}:info',
+                        cache_secs=60)
+
+        self.params = {'param.user': 'USER',
+                       'param.coll': 'COLL',
+                       'param.rec': 'REC',
+                       'url': 'http://example.com/'}
+
+        self.redis.hset(self.INFO_KEY, 'id', 'REC')
+        self.redis.hset(self.COLL_KEY, 'id', 'COLL')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.warcs_dir)
+
+    def send_messages(self, *messages):
+        wr = WebRecRecorder(load_wr_config())
+        wr.redis = self.redis
+        wr.writer = self.writer
+
+        self.redis.pubsub = lambda: FakePubSub(messages)
+        wr.msg_listen_loop()
+
+    def is_write_req(self):
+        class Req(object):
+            rec_headers = {'WARC-Type': 'response'}
+
+        return self.writer._is_write_req(Req(), self.params)
+
+    def allow_new_file(self):
+        return self.writer.allow_new_file('rec.warc.gz', self.params)
+
+    def test_skip_invalidated(self):
+        assert self.is_write_req() == True
+
+        # cached, until skip message
+        self.redis.set(self.SKIP_KEY, '1')
+        assert self.is_write_req() == True
+
+        self.send_messages(('skip', 'us:USER:s:http://other.example.com/'))
+        assert self.is_write_req() == True
+
+        self.send_messages(('skip', self.SKIP_KEY))
+        assert self.is_write_req() == False
+
+        # skip cached too
+        self.redis.delete(self.SKIP_KEY)
+        assert self.is_write_req() == False
+
+        self.send_messages(('skip', self.SKIP_KEY))
+        assert self.is_write_req() == True
+
+    def test_skip_expired(self):
+        with patch('time.time', lambda: 1000):
+            assert self.is_write_req() == True
+
+        self.redis.set(self.SKIP_KEY, '1')
+
+        with patch('time.time', lambda: 1060):
+            assert self.is_write_req() == True
+
+        with patch('time.time', lambda: 1061):
+            assert self.is_write_req() == False
+
+    def test_rec_exists_invalidated_by_delete(self):
+        assert self.allow_new_file() == True
+
+        # recording being deleted, still cached until delete message
+        self.redis.hdel(self.INFO_KEY, 'id')
+        assert self.allow_new_file() == True
+
+        self.send_messages(('delete', json.dumps({'delete_list': []})))
+        assert self.allow_new_file() == False
+
+    def test_rec_exists_invalidated_by_rename(self):
+        assert self.allow_new_file() == True
+
+        # recording moved away, still cached until rename message
+        self.redis.delete(self.INFO_KEY)
+        assert self.allow_new_file() == True
+
+        self.send_messages(('rename', json.dumps({'replace_list': []})))
+        assert self.allow_new_file() == False
+
+    def test_missing_rec_not_cached(self):
+        self.redis.delete(self.INFO_KEY)
+        assert self.allow_new_file() == False
+
+        self.redis.hset(self.INFO_KEY, 'id', 'REC')
+        assert self.allow_new_file() == True
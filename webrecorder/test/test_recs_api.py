@@ -1,7 +1,12 @@
 import time
 import os
+import re
+
+from six.moves.urllib.parse import quote
+from mock import patch
 
 from .testutils import BaseWRTests
+from webrecorder.collscontroller import CollsController
 
 
 # ============================================================================
@@ -79,6 +84,29 @@ class TestWebRecRecAPI(BaseWRTests):
         assert recs[2]['title'] == 'My Rec 2'
         assert recs[2]['download_url'] == 'http://localhost:80/{user}/temp/my-rec-2/$download'.format(user=self.anon_user)
 
+    def test_list_recordings_paged(self):
+        res = self._anon_get('/api/v1/recordings?user={user}&coll=temp&offset=1&limit=1')
+
+        assert res.json['total'] == 3
+        assert res.json['offset'] == 1
+        assert [rec['id'] for rec in res.json['recordings']] == ['my-rec']
+
+        # paging from recording index, once built, instead of scanning
+        self.redis.hset('h:key-registry', 'built_at', int(time.time()))
+
+        try:
+            recs = []
+            for offset in (0, 2, 4):
+                res = self._anon_get('/api/v1/recordings?user={user}&coll=temp&limit=2&offset=' + str(offset))
+                assert res.json['total'] == 3
+                recs.extend(rec['id'] for rec in res.json['recordings'])
+        finally:
+            self.redis.hdel('h:key-registry', 'built_at')
+
+        assert sorted(recs) == ['2-another-recording', 'my-rec', 'my-rec-2']
+
+        self._anon_get('/api/v1/recordings?user={user}&coll=temp&limit=x', status=400)
+
     def test_page_list_0(self):
         res = self._anon_get('/api/v1/recordings/my-rec/pages?user={user}&coll=temp')
 
@@ -113,6 +141,69 @@ class TestWebRecRecAPI(BaseWRTests):
         assert {'title': 'Example', 'url': 'http://example.com/', 'timestamp': '2016010203000000'} in res.json['pages']
         assert {'title': 'Example', 'url': 'http://example.com/foo/bar', 'timestamp': '2015010203000000'} in res.json['pages']
 
+    def test_page_list_paged(self):
+        pages = []
+        cursor = ''
+        for i in range(3):
+            res = self._anon_get('/api/v1/recordings/my-rec/pages?user={user}&coll=temp&limit=1&cursor=' + quote(cursor))
+            pages.extend(page['url'] for page in res.json['pages'])
+            cursor = res.json['cursor']
+            if not cursor:
+                break
+
+        # ordered by timestamp
+        assert pages == ['http://example.com/foo/bar', 'http://example.com/']
+
+        res = self._anon_get('/api/v1/collections/temp/pages?user={user}')
+        assert [page['timestamp'] for page in res.json['pages']] == ['2015010203000000', '2016010203000000']
+        assert res.json['pages'][0]['recording'] == 'my-rec'
+        assert res.json['cursor'] == None
+
+        # index built for recordings from before the index
+        index_key = 'r:{user}:temp:my-rec:page_ts'.format(user=self.anon_user)
+        info_key = 'r:{user}:temp:my-rec:info'.format(user=self.anon_user)
+
+        self.redis.delete(index_key)
+        self.redis.hdel(info_key, 'pages_indexed')
+
+        res = self._anon_get('/api/v1/collections/temp/pages?user={user}&limit=5')
+        assert len(res.json['pages']) == 2
+        assert self.redis.hget(info_key, 'pages_indexed') == b'1'
+
+        # only checked once
+        self.redis.zrem(index_key, 'http://example.com/ 2016010203000000')
+        res = self._anon_get('/api/v1/collections/temp/pages?user={user}&limit=5')
+        assert len(res.json['pages']) == 1
+
+        self.redis.hdel(info_key, 'pages_indexed')
+        res = self._anon_get('/api/v1/collections/temp/pages?user={user}&limit=5')
+        assert len(res.json['pages']) == 2
+
+        self._anon_get('/api/v1/collections/temp/pages?user={user}&limit=0', status=400)
+        self._anon_get('/api/v1/collections/temp/pages?user={user}&cursor=x', status=400)
+
+    def test_page_list_view_paged(self):
+        def get_links(res):
+            return dict(re.findall(r'<a class="(prev-bookmarks|more-bookmarks)" href="([^"]*)"', res.text))
+
+        with patch.object(CollsController, 'VIEW_PAGES_LIMIT', 1):
+            res = self._anon_get('/{user}/temp')
+            first_links = get_links(res)
+            assert 'prev-bookmarks' not in first_links
+            assert first_links['more-bookmarks'].startswith('?cursor=')
+
+            res = self._anon_get('/{user}/temp' + first_links['more-bookmarks'])
+            second_links = get_links(res)
+
+            # back to first window
+            assert second_links['prev-bookmarks'] == '?'
+
+            res = self._anon_get('/{user}/temp' + second_links['more-bookmarks'])
+            third_links = get_links(res)
+
+            assert 'more-bookmarks' not in third_links
+            assert third_links['prev-bookmarks'] == first_links['more-bookmarks']
+
     def test_page_delete(self):
         params = {'url': 'http://example.com/foo/bar', 'timestamp': '2015010203000000'}
         res = self._anon_delete('/api/v1/recordings/my-rec/pages?user={user}&coll=temp', params=params)
@@ -0,0 +1,227 @@
+from webrecorder.rec.s3 import S3MultipartUploader, S3Storage
+
+import os
+import pytest
+import tempfile
+import threading
+
+
+# ============================================================================
+class FakePart(object):
+    def __init__(self, part_number, data):
+        self.part_number = part_number
+        self.size = len(data)
+        self.data = data
+
+
+# ============================================================================
+class FakeMultiPartUpload(object):
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = 'upload-' + key_name
+        self.parts = {}
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return iter(sorted(self.parts.values(), key=lambda x: x.part_number))
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        if part_num in self.bucket.fail_parts:
+            raise Exception('Upload Failed')
+
+        data = fp.read(size)
+        with self.lock:
+            self.parts[part_num] = FakePart(part_num, data)
+            self.bucket.uploaded_parts.append(part_num)
+
+    def complete_upload(self):
+        data = b''.join(part.data for part in self)
+        self.bucket.keys[self.key_name] = data
+        self.bucket.uploads.remove(self)
+
+
+# ============================================================================
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = len(bucket.keys.get(name, b''))
+        self.etag = '"etag-' + name + '"'
+
+    def set_contents_from_file(self, fh, replace=True):
+        self.bucket.keys[self.name] = fh.read()
+
+
+# ============================================================================
+class FakeDeleteResult(object):
+    def __init__(self, errors):
+        self.errors = errors
+
+
+# ============================================================================
+class FakeBucket(object):
+    def __init__(self):
+        self.keys = {}
+        self.uploads = []
+        self.uploaded_parts = []
+        self.fail_parts = set()
+        self.num_lists = 0
+        self.delete_batches = []
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def initiate_multipart_upload(self, name):
+        mp = FakeMultiPartUpload(self, name)
+        self.uploads.append(mp)
+        return mp
+
+    def get_all_multipart_uploads(self, prefix=''):
+        return [mp for mp in self.uploads if mp.key_name.startswith(prefix)]
+
+    def list(self, prefix='', marker=''):
+        self.num_lists += 1
+        for name in sorted(self.keys):
+            if name.startswith(prefix) and name > marker:
+                yield FakeKey(self, name)
+
+    def delete_keys(self, names, quiet=False):
+        self.delete_batches.append(len(names))
+        for name in names:
+            self.keys.pop(name, None)
+
+        return FakeDeleteResult([])
+
+
+# ============================================================================
+class TestS3MultipartUpload(object):
+    @classmethod
+    def setup_class(cls):
+        cls.data = os.urandom(1000)
+
+        with tempfile.NamedTemporaryFile(delete=False) as fh:
+            fh.write(cls.data)
+            cls.filename = fh.name
+
+    @classmethod
+    def teardown_class(cls):
+        os.remove(cls.filename)
+
+    def test_single_part(self):
+        bucket = FakeBucket()
+        uploader = S3MultipartUploader(bucket, part_size=1000)
+
+        uploader.upload('warcs/single.warc.gz', self.filename)
+
+        assert bucket.keys['warcs/single.warc.gz'] == self.data
+        assert bucket.uploaded_parts == []
+
+    def test_multipart(self):
+        bucket = FakeBucket()
+        uploader = S3MultipartUploader(bucket, part_size=300, num_threads=3)
+
+        uploader.upload('warcs/multi.warc.gz', self.filename)
+
+        assert bucket.keys['warcs/multi.warc.gz'] == self.data
+        assert sorted(bucket.uploaded_parts) == [1, 2, 3, 4]
+        assert bucket.uploads == []
+
+    def test_multipart_resume(self):
+        bucket = FakeBucket()
+        uploader = S3MultipartUploader(bucket, part_size=300, num_threads=2)
+
+        bucket.fail_parts.add(3)
+
+        with pytest.raises(Exception):
+            uploader.upload('warcs/resume.warc.gz', self.filename)
+
+        assert 'warcs/resume.warc.gz' not in bucket.keys
+        assert len(bucket.uploads) == 1
+        assert sorted(bucket.uploaded_parts) == [1, 2, 4]
+
+        bucket.fail_parts.clear()
+        bucket.uploaded_parts = []
+
+        uploader.upload('warcs/resume.warc.gz', self.filename)
+
+        # only the failed part is uploaded again
+        assert bucket.uploaded_parts == [3]
+        assert bucket.keys['warcs/resume.warc.gz'] == self.data
+        assert bucket.uploads == []
+
+    def test_batch_verify(self):
+        storage = S3Storage.__new__(S3Storage)
+        storage.bucket_name = 'bucket'
+        storage.remote_path_templ = 'accounts/{user}/warcs/{filename}'
+        storage.config = {}
+        storage.bucket = FakeBucket()
+
+        storage.bucket.keys['accounts/a/warcs/rec-1.warc.gz'] = b'abc'
+        storage.bucket.keys['accounts/a/warcs/rec-2.warc.gz'] = b'ab'
+        storage.bucket.keys['accounts/a/warcs/rec-3.warc.gz'] = b'abc'
+        storage.bucket.keys['accounts/b/warcs/rec-1.warc.gz'] = b'abcd'
+
+        res = storage.get_valid_remote_urls([('a', 'c', 'r', 'rec-1.warc.gz', 3),
+                                             ('a', 'c', 'r', 'rec-2.warc.gz', 3),
+                                             ('a', 'c', 'r', 'rec-4.warc.gz', 3),
+                                             ('b', 'c', 'r', 'rec-1.warc.gz', None)])
+
+        # one listing per user dir
+        assert storage.bucket.num_lists == 2
+
+        # rec-2 size mismatch, rec-4 missing
+        assert res == {('a', 'rec-1.warc.gz'): ('s3://bucket/accounts/a/warcs/rec-1.warc.gz',
+                                                '"etag-accounts/a/warcs/rec-1.warc.gz"', 3),
+                       ('b', 'rec-1.warc.gz'): ('s3://bucket/accounts/b/warcs/rec-1.warc.gz',
+                                                '"etag-accounts/b/warcs/rec-1.warc.gz"', 4)}
+
+    def test_thread_bucket_per_thread(self):
+        storage = S3Storage.__new__(S3Storage)
+        storage.thread_local = threading.local()
+
+        connects = []
+
+        def connect():
+            connects.append(threading.current_thread())
+            bucket = FakeBucket()
+            bucket.get_bucket = lambda name, validate=True: bucket
+            return bucket
+
+        storage._connect = connect
+        storage.bucket_name = 'bucket'
+
+        bucket = storage._get_thread_bucket()
+        assert storage._get_thread_bucket() is bucket
+
+        res = []
+        thread = threading.Thread(target=lambda: res.extend([storage._get_thread_bucket(),
+                                                             storage._get_thread_bucket()]))
+        thread.start()
+        thread.join()
+
+        assert res[0] is res[1]
+        assert res[0] is not bucket
+        assert len(connects) == 2
+
+    def test_batch_delete_user(self):
+        storage = S3Storage.__new__(S3Storage)
+        storage.bucket_name = 'bucket'
+        storage.remote_path_templ = 'accounts/{user}/warcs/{filename}'
+        storage.bucket = FakeBucket()
+
+        for i in range(2500):
+            storage.bucket.keys['accounts/a/warcs/rec-{0:04d}.warc.gz'.format(i)] = b'abc'
+
+        storage.bucket.keys['accounts/b/warcs/rec-1.warc.gz'] = b'abc'
+
+        assert list(storage.iter_delete_user('a')) == [1000, 1000, 500]
+        assert list(storage.bucket.keys) == ['accounts/b/warcs/rec-1.warc.gz']
+
+        # nothing left to delete on retry
+        assert storage.delete_user('a') == True
+        assert storage.bucket.delete_batches == [1000, 1000, 500]
+
+        assert storage.delete(['s3://bucket/accounts/b/warcs/rec-1.warc.gz', 'file:///invalid']) == True
+        assert storage.bucket.keys == {}
+
@@ -0,0 +1,200 @@
+from webrecorder.standalone.sqliteredis import SQLiteRedis, SQLiteRedisStore
+
+import os
+import pytest
+import tempfile
+
+import redis
+import redis.utils
+from redis.exceptions import ResponseError
+
+
+# ============================================================================
+class TestSQLiteRedis(object):
+    @classmethod
+    def setup_class(cls):
+        cls.root_dir = tempfile.mkdtemp()
+        cls.db_file = os.path.join(cls.root_dir, 'wr.rld')
+        cls.store = SQLiteRedisStore(cls.db_file)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.store.close()
+
+    def get_redis(self, url='redis://localhost/1', **kwargs):
+        return SQLiteRedis.from_url(url, store=self.store, **kwargs)
+
+    def test_strings(self):
+        r = self.get_redis()
+        assert r.set('foo', 'bar') == True
+        assert r.get('foo') == b'bar'
+        assert r.incrby('count', 5) == 5
+        assert r.incr('count') == 6
+        assert r.get('count') == b'6'
+
+        assert r.exists('foo')
+        assert r.delete('foo', 'not-a-key') == 1
+        assert not r.exists('foo')
+        assert r.get('foo') == None
+
+    def test_dbs_separate(self):
+        r0 = self.get_redis('redis://localhost/0')
+        r0.set('foo', 'db0')
+        assert self.get_redis().get('foo') == None
+        assert r0.get('foo') == b'db0'
+
+    def test_expire(self):
+        r = self.get_redis()
+        r.setex('sesh', 100, 'data')
+        assert 98 <= r.ttl('sesh') <= 100
+        assert r.ttl('not-a-key') == -2
+
+        r.set('perm', 'data')
+        assert r.ttl('perm') == -1
+
+        r.set('temp', 'data')
+        r.expire('temp', 0)
+        assert r.get('temp') == None
+        assert r.ttl('temp') == -2
+
+    def test_hashes(self):
+        r = self.get_redis()
+        assert r.hset('h:test', 'a', 'x') == 1
+        assert r.hset('h:test', 'a', 'y') == 0
+        assert r.hsetnx('h:test', 'a', 'z') == 0
+        assert r.hsetnx('h:test', 'b', 'z') == 1
+        r.hmset('h:test', {'c': 1, 'd': 2})
+
+        assert r.hget('h:test', 'a') == b'y'
+        assert r.hmget('h:test', ['a', 'b', 'x']) == [b'y', b'z', None]
+        assert r.hgetall('h:test') == {b'a': b'y', b'b': b'z', b'c': b'1', b'd': b'2'}
+        assert r.hlen('h:test') == 4
+        assert r.hincrby('h:test', 'd', 10) == 12
+        assert r.hincrby('h:test', 'e') == 1
+
+        assert r.hdel('h:test', 'a', 'b', 'c', 'd', 'e') == 5
+        assert not r.exists('h:test')
+
+    def test_wrong_type(self):
+        r = self.get_redis()
+        r.set('str', 'value')
+        with pytest.raises(ResponseError):
+            r.hset('str', 'a', 'b')
+
+    def test_zset_lex(self):
+        r = self.get_redis()
+        r.zadd('r:cdxj', 0, b'com,example)/ 2017', 0, b'com,example)/a 2017', 0, b'org,example)/ 2017')
+
+        assert r.zcard('r:cdxj') == 3
+        assert r.zrangebylex('r:cdxj', b'[com,example)/', b'(com,example)/a') == [b'com,example)/ 2017']
+        assert r.zrangebylex('r:cdxj', b'[com,', b'(com-') == [b'com,example)/ 2017', b'com,example)/a 2017']
+        assert r.zrangebylex('r:cdxj', '-', '+', start=2, num=1) == [b'org,example)/ 2017']
+        assert r.zrevrangebylex('r:cdxj', '+', '-', start=0, num=1) == [b'org,example)/ 2017']
+
+    def test_zset_score(self):
+        r = self.get_redis()
+        r.zadd('z:tags', 2, 'b', 1, 'a')
+        r.zadd('z:tags', c=3)
+        assert r.zincrby('z:tags', 'a', 5) == 6.0
+
+        assert r.zrange('z:tags', 0, -1) == [b'b', b'c', b'a']
+        assert r.zrange('z:tags', 0, 0, withscores=True) == [(b'b', 2.0)]
+        assert r.zrevrange('z:tags', 0, 1) == [b'a', b'c']
+        assert r.zrangebyscore('z:tags', '(2', '+inf') == [b'c', b'a']
+        assert r.zscore('z:tags', 'c') == 3.0
+        assert list(r.zscan_iter('z:tags')) == [(b'a', 6.0), (b'b', 2.0), (b'c', 3.0)]
+
+        assert r.zrem('z:tags', 'a', 'b', 'c') == 3
+        assert not r.exists('z:tags')
+
+    def test_sets_lists(self):
+        r = self.get_redis()
+        assert r.sadd('s:test', 'a', 'b', 'a') == 2
+        assert r.smembers('s:test') == {b'a', b'b'}
+        assert r.sismember('s:test', 'a')
+        assert r.srem('s:test', 'a') == 1
+
+        r.rpush('l:test', 'b')
+        r.lpush('l:test', 'a')
+        r.rpush('l:test', 'c')
+        assert r.lrange('l:test', 0, -1) == [b'a', b'b', b'c']
+        assert r.lpop('l:test') == b'a'
+        assert r.blpop('l:test', timeout=1) == (b'l:test', b'b')
+        assert r.lpop('l:test') == b'c'
+        assert r.lpop('l:test') == None
+        assert r.blpop('l:test', timeout=1) == None
+
+    def test_keys_rename(self):
+        r = self.get_redis()
+        r.hset('r:user:coll:rec:info', 'size', 10)
+        r.zadd('r:user:coll:rec:cdxj', 0, 'line')
+
+        assert sorted(r.keys('r:user:coll:rec:*')) == [b'r:user:coll:rec:cdxj', b'r:user:coll:rec:info']
+
+        with redis.utils.pipeline(r) as pi:
+            for key in r.scan_iter('r:user:coll:rec:*'):
+                pi.rename(key, key.replace(b':rec:', b':rec2:'))
+
+        assert r.keys('r:user:coll:rec:*') == []
+        assert r.hget('r:user:coll:rec2:info', 'size') == b'10'
+        assert r.zrange('r:user:coll:rec2:cdxj', 0, -1) == [b'line']
+
+    def test_pipeline(self):
+        r = self.get_redis()
+        pi = r.pipeline()
+        pi.hset('h:pipe', 'a', 1)
+        pi.hincrby('h:pipe', 'a', 2)
+        pi.hget('h:pipe', 'a')
+        assert pi.execute() == [1, 3, b'3']
+
+    def test_transaction(self):
+        r = self.get_redis()
+        r.hset('h:watched', 'size', 5)
+
+        def move_size(pi):
+            size = int(pi.hget('h:watched', 'size'))
+            pi.multi()
+            pi.hincrby('h:target', 'size', size)
+            pi.rename('h:watched', 'h:moved')
+            pi.rename('h:not-a-key', 'h:other')
+
+        with pytest.raises(ResponseError):
+            r.transaction(move_size, 'h:watched')
+
+        # rolled back entirely
+        assert r.exists('h:watched')
+        assert not r.exists('h:target')
+
+        pi = r.pipeline()
+        pi.rename('h:not-a-key', 'h:other')
+        pi.rename('h:watched', 'h:moved')
+        res = pi.execute(raise_on_error=False)
+        assert isinstance(res[0], ResponseError)
+        assert res[1] == True
+        assert r.hget('h:moved', 'size') == b'5'
+
+    def test_decode_responses(self):
+        r = self.get_redis(decode_responses=True)
+        r.hset('h:decode', 'a', 'b')
+        assert r.hgetall('h:decode') == {'a': 'b'}
+        assert r.keys('h:decode') == ['h:decode']
+
+    def test_pubsub(self):
+        r = self.get_redis()
+        pubsub = r.pubsub()
+        pubsub.subscribe('delete')
+
+        assert r.publish('delete', 'msg') == 1
+        assert r.publish('other', 'msg') == 0
+
+        assert pubsub.get_message(ignore_subscribe_messages=True)['data'] == b'msg'
+        assert pubsub.get_message() == None
+
+    def test_persisted(self):
+        self.get_redis().hset('h:persist', 'a', 'b')
+
+        store = SQLiteRedisStore(self.db_file)
+        try:
+            assert SQLiteRedis(store=store, db=1).hget('h:persist', 'a') == b'b'
+        finally:
+            store.close()
@@ -0,0 +1,195 @@
+from webrecorder.standalone.standalone import iter_indexed_archives, index_archive_file
+from webrecorder.standalone.standalone import get_file_fingerprint, load_index_cache, save_index_cache
+from webrecorder.standalone.standalone import INDEX_CACHE_EXT, FINGERPRINT_BLOCK_SIZE
+
+from mock import patch
+
+import os
+import shutil
+import tempfile
+import uuid
+
+
+# ============================================================================
+def make_warc(url, payload):
+    record = (b'WARC/1.0\r\n'
+              b'WARC-Type: resource\r\n'
+              b'WARC-Record-ID: <urn:uuid:' + str(uuid.uuid4()).encode('utf-8') + b'>\r\n'
+              b'WARC-Target-URI: ' + url.encode('utf-8') + b'\r\n'
+              b'WARC-Date: 2017-01-02T03:04:05Z\r\n'
+              b'Content-Type: text/plain\r\n'
+              b'Content-Length: ' + str(len(payload)).encode('utf-8') + b'\r\n'
+              b'\r\n' + payload + b'\r\n\r\n')
+
+    return record
+
+
+# ============================================================================
+class TestIndexArchives(object):
+    def setup_method(self, method):
+        self.root_dir = tempfile.mkdtemp()
+
+        self.filenames = []
+        for name in ('a', 'b'):
+            filename = os.path.join(self.root_dir, name + '.warc')
+            with open(filename, 'wb') as fh:
+                fh.write(make_warc('http://example.com/' + name, b'some text ' + name.encode('utf-8')))
+
+            self.filenames.append(filename)
+
+        self.cdx_filenames = ['a.warc', 'b.warc']
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.root_dir)
+
+    def test_index_in_pool(self):
+        res = list(iter_indexed_archives(self.filenames, self.cdx_filenames,
+                                         num_workers=2, use_cache=False))
+
+        assert [filename for filename, infos, error in res] == self.filenames
+
+        for (filename, infos, error), name in zip(res, ('a', 'b')):
+            assert error is None
+            assert len(infos) == 1
+            assert infos[0]['type'] == 'recording'
+            assert infos[0]['offset'] == 0
+            assert infos[0]['length'] == os.path.getsize(filename)
+
+            assert len(infos[0]['cdx']) == 1
+            assert b'http://example.com/' + name.encode('utf-8') in infos[0]['cdx'][0]
+            assert (name + '.warc').encode('utf-8') in infos[0]['cdx'][0]
+
+    def test_index_error(self):
+        os.remove(self.filenames[0])
+
+        res = list(iter_indexed_archives(self.filenames, self.cdx_filenames,
+                                         num_workers=2, use_cache=False))
+
+        assert res[0][2] is not None
+        assert res[1][2] is None
+        assert len(res[1][1][0]['cdx']) == 1
+
+
+# ============================================================================
+class TestIndexCache(object):
+    def setup_method(self, method):
+        self.root_dir = tempfile.mkdtemp()
+
+        self.filename = os.path.join(self.root_dir, 'a.warc')
+        with open(self.filename, 'wb') as fh:
+            fh.write(make_warc('http://example.com/a', b'some text a'))
+
+        self.cache_filename = self.filename + INDEX_CACHE_EXT
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.root_dir)
+
+    def rewrite(self, filename, offset, data):
+        """ Overwrite bytes in place, keeping the size and mtime unchanged
+        """
+        stat = os.stat(filename)
+
+        with open(filename, 'r+b') as fh:
+            fh.seek(offset)
+            fh.write(data)
+
+        os.utime(filename, (stat.st_atime, stat.st_mtime))
+
+    def test_fingerprint(self):
+        fingerprint = get_file_fingerprint(self.filename)
+
+        assert fingerprint['path'] == os.path.abspath(self.filename)
+        assert fingerprint['size'] == os.path.getsize(self.filename)
+        assert fingerprint['mtime'] == os.stat(self.filename).st_mtime
+        assert get_file_fingerprint(self.filename) == fingerprint
+
+        # same size and mtime, only the hash differs
+        self.rewrite(self.filename, 0, b'X')
+
+        new_fingerprint = get_file_fingerprint(self.filename)
+        assert new_fingerprint['hash'] != fingerprint['hash']
+        assert dict(new_fingerprint, hash=None) == dict(fingerprint, hash=None)
+
+    def test_fingerprint_tail_block(self):
+        filename = os.path.join(self.root_dir, 'big.warc')
+        with open(filename, 'wb') as fh:
+            fh.write(b'a' * (FINGERPRINT_BLOCK_SIZE * 3))
+
+        fingerprint = get_file_fingerprint(filename)
+
+        # middle block not hashed
+        self.rewrite(filename, FINGERPRINT_BLOCK_SIZE + 10, b'b')
+        assert get_file_fingerprint(filename) == fingerprint
+
+        # last block hashed
+        self.rewrite(filename, FINGERPRINT_BLOCK_SIZE * 3 - 10, b'b')
+        assert get_file_fingerprint(filename)['hash'] != fingerprint['hash']
+
+    def test_cache_hit(self):
+        assert load_index_cache(self.filename, 'a.warc') == None
+
+        infos = index_archive_file(self.filename, 'a.warc', use_cache=True)
+        assert os.path.isfile(self.cache_filename)
+
+        cached = load_index_cache(self.filename, 'a.warc')
+        assert cached == infos
+
+        # cdx lines loaded back as bytes
+        cdx = [cdx for info in cached for cdx in info.get('cdx', [])]
+        assert cdx and all(isinstance(line, bytes) for line in cdx)
+
+    def test_invalidated_on_change(self):
+        index_archive_file(self.filename, 'a.warc', use_cache=True)
+
+        # different cdx filename
+        assert load_index_cache(self.filename, 'b.warc') == None
+
+        # file appended to
+        with open(self.filename, 'ab') as fh:
+            fh.write(make_warc('http://example.com/b', b'some text b'))
+
+        assert load_index_cache(self.filename, 'a.warc') == None
+
+        # reindexed and cached again
+        infos = index_archive_file(self.filename, 'a.warc', use_cache=True)
+        assert load_index_cache(self.filename, 'a.warc') == infos
+
+        # changed in place
+        self.rewrite(self.filename, 0, b'X')
+        assert load_index_cache(self.filename, 'a.warc') == None
+
+    def test_invalid_cache_file(self):
+        with open(self.cache_filename, 'wb') as fh:
+            fh.write(b'not gzip')
+
+        assert load_index_cache(self.filename, 'a.warc') == None
+
+    def test_atomic_write(self):
+        infos = index_archive_file(self.filename, 'a.warc', use_cache=True)
+
+        replaced = []
+
+        def replace(src, dest):
+            # cache complete in temp file before replacing, old cache still in place
+            assert src == self.cache_filename + '.tmp'
+            assert load_index_cache(self.filename, 'a.warc') == infos
+            replaced.append(dest)
+            os.rename(src, dest)
+
+        with patch('os.replace', replace):
+            save_index_cache(self.filename, 'a.warc', infos)
+
+        assert replaced == [self.cache_filename]
+        assert sorted(os.listdir(self.root_dir)) == ['a.warc', 'a.warc' + INDEX_CACHE_EXT]
+
+    def test_failed_write_keeps_cache(self):
+        infos = index_archive_file(self.filename, 'a.warc', use_cache=True)
+
+        def replace(src, dest):
+            raise OSError('replace failed')
+
+        with patch('os.replace', replace):
+            save_index_cache(self.filename, 'a.warc', [{'type': 'collection'}])
+
+        # existing cache untouched
+        assert load_index_cache(self.filename, 'a.warc') == infos
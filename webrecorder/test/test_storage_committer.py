@@ -0,0 +1,282 @@
+from fakeredis import FakeStrictRedis
+
+from webrecorder.rec.storagecommitter import StorageCommitter, InflightLimiter
+from webrecorder.utils import load_wr_config
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+# ============================================================================
+class FakeStorage(object):
+    """ Keeps uploaded WARC names, failing uploads of names in fail,
+    and raising for names in error
+    """
+    def __init__(self):
+        self.uploads = []
+        self.fail = set()
+        self.error = set()
+
+    def upload_file(self, user, coll, rec, warcname, full_filename):
+        if warcname in self.error:
+            raise Exception('Upload Error')
+
+        if warcname in self.fail:
+            return False
+
+        self.uploads.append((user, warcname))
+        return True
+
+    def get_valid_remote_url(self, user, coll, rec, warcname):
+        if (user, warcname) in self.uploads:
+            return 'fake://' + user + '/' + warcname
+
+
+# ============================================================================
+class BaseStorageCommitterTest(object):
+    def setup_method(self):
+        self.root_dir = tempfile.mkdtemp()
+
+        os.environ['RECORD_ROOT'] = self.root_dir
+        os.environ['REDIS_BASE_URL'] = 'redis://localhost:6379/2'
+
+        self.redis = FakeStrictRedis()
+        self.storage = FakeStorage()
+
+        self.committer = StorageCommitter(load_wr_config())
+        self.committer.redis = self.redis
+        self.committer.add_storage_class('local', lambda config: self.storage)
+
+    def teardown_method(self):
+        shutil.rmtree(self.root_dir)
+
+    def add_warc(self, user, warcname, coll='coll', rec='rec'):
+        user_dir = os.path.join(self.root_dir, user)
+        if not os.path.isdir(user_dir):
+            os.makedirs(user_dir)
+
+        full_filename = os.path.join(user_dir, warcname)
+        with open(full_filename, 'wb') as fh:
+            fh.write(b'WARC/1.0\r\n')
+
+        self.redis.hset('r:{0}:{1}:{2}:warc'.format(user, coll, rec), warcname,
+                        'local+http://nginx:6090/data/' + user + '/' + warcname)
+
+        self.redis.hset('u:{0}:warcs'.format(user), warcname, coll + ':' + rec)
+
+        return full_filename
+
+    def get_warc_url(self, user, warcname, coll='coll', rec='rec'):
+        url = self.redis.hget('r:{0}:{1}:{2}:warc'.format(user, coll, rec), warcname)
+        return url.decode('utf-8')
+
+
+# ============================================================================
+class TestStorageCommitter(BaseStorageCommitterTest):
+    def test_interleave(self):
+        user_warcs = [['a1', 'a2', 'a3'], [], ['b1'], ['c1', 'c2']]
+
+        res = list(self.committer.interleave(user_warcs))
+        assert res == ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+
+    def test_commit_round_robin(self):
+        for warcname in ('a-1.warc.gz', 'a-2.warc.gz', 'a-3.warc.gz'):
+            self.add_warc('a', warcname)
+
+        self.add_warc('b', 'b-1.warc.gz')
+
+        for warcname in ('c-1.warc.gz', 'c-2.warc.gz'):
+            self.add_warc('c', warcname)
+
+        # one worker, so uploads run in the order queued
+        self.committer.num_workers = 1
+        self.committer()
+
+        users = [user for user, warcname in self.storage.uploads]
+
+        # user dirs are listed in any order
+        first = users[:3]
+        assert sorted(first) == ['a', 'b', 'c']
+        assert users[3:] == [user for user in first if user != 'b'] + ['a']
+
+        assert self.committer.last_metrics['uploaded'] == 6
+        assert self.committer.last_metrics['verified'] == 6
+
+        assert self.get_warc_url('b', 'b-1.warc.gz') == 'fake://b/b-1.warc.gz'
+        assert os.listdir(self.root_dir) == []
+
+    def test_inflight_limit(self):
+        limiter = InflightLimiter(100)
+        seen = []
+
+        def run():
+            limiter.acquire(30)
+            with limiter.cond:
+                seen.append(limiter.inflight)
+
+            time.sleep(0.01)
+            limiter.release(30)
+
+        threads = [threading.Thread(target=run) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert len(seen) == 20
+        assert max(seen) <= 90
+        assert limiter.inflight == 0
+
+    def test_inflight_over_limit_alone(self):
+        limiter = InflightLimiter(100)
+
+        # larger than the limit, still allowed if nothing else inflight
+        limiter.acquire(500)
+        assert limiter.inflight == 500
+
+        limiter.release(500)
+        assert limiter.inflight == 0
+
+    def test_failed_commit_retried(self):
+        failed = self.add_warc('a', 'a-1.warc.gz')
+        errored = self.add_warc('a', 'a-2.warc.gz')
+
+        self.storage.fail.add('a-1.warc.gz')
+        self.storage.error.add('a-2.warc.gz')
+
+        self.committer()
+
+        metrics = self.committer.last_metrics
+        assert metrics['failed'] == 2
+        assert metrics['uploaded'] == 0
+
+        # kept locally, and queued to retry
+        assert os.path.isfile(failed)
+        assert os.path.isfile(errored)
+        assert sorted(self.committer.retries) == [failed, errored]
+
+        self.storage.fail.clear()
+        self.storage.error.clear()
+
+        # retry due now
+        for filename, (retry_at, args) in self.committer.retries.items():
+            self.committer.retries[filename] = (0, args)
+
+        self.committer.process_closed(1)
+
+        assert sorted(self.storage.uploads) == [('a', 'a-1.warc.gz'), ('a', 'a-2.warc.gz')]
+        assert self.committer.retries == {}
+        assert not os.path.isfile(failed)
+        assert not os.path.isfile(errored)
+        assert self.get_warc_url('a', 'a-2.warc.gz') == 'fake://a/a-2.warc.gz'
+
+
+# ============================================================================
+class TestClosedWarcQueue(BaseStorageCommitterTest):
+    QUEUE_KEY = 'q:closed-warcs'
+
+    def test_commit_closed(self):
+        filename = self.add_warc('a', 'a-1.warc.gz')
+        self.redis.rpush(self.QUEUE_KEY, filename)
+
+        self.committer.process_closed(1)
+
+        assert self.storage.uploads == [('a', 'a-1.warc.gz')]
+        assert self.get_warc_url('a', 'a-1.warc.gz') == 'fake://a/a-1.warc.gz'
+        assert not os.path.isfile(filename)
+        assert self.redis.llen(self.QUEUE_KEY) == 0
+
+    def test_commit_closed_several(self):
+        filenames = [self.add_warc('a', 'a-1.warc.gz'),
+                     self.add_warc('b', 'b-1.warc.gz'),
+                     self.add_warc('b', 'b-2.warc.gz')]
+
+        for filename in filenames:
+            self.redis.rpush(self.QUEUE_KEY, filename)
+
+        # all queued WARCs committed after a single wait
+        self.committer.process_closed(1)
+
+        assert sorted(self.storage.uploads) == [('a', 'a-1.warc.gz'),
+                                                ('b', 'b-1.warc.gz'),
+                                                ('b', 'b-2.warc.gz')]
+        assert self.redis.llen(self.QUEUE_KEY) == 0
+
+    def test_retry_failed(self):
+        filename = self.add_warc('a', 'a-1.warc.gz')
+        self.redis.rpush(self.QUEUE_KEY, filename)
+
+        self.storage.fail.add('a-1.warc.gz')
+        self.committer.process_closed(1)
+
+        # not in the queue, but kept to retry
+        assert self.redis.llen(self.QUEUE_KEY) == 0
+        assert list(self.committer.retries) == [filename]
+        assert os.path.isfile(filename)
+
+        self.storage.fail.clear()
+
+        # retry not yet due
+        self.committer.process_closed(1)
+        assert self.storage.uploads == []
+
+        retry_at, args = self.committer.retries[filename]
+        self.committer.retries[filename] = (time.time() - 1, args)
+
+        self.committer.process_closed(1)
+
+        assert self.storage.uploads == [('a', 'a-1.warc.gz')]
+        assert self.committer.retries == {}
+        assert not os.path.isfile(filename)
+
+    def test_skip_temp(self):
+        filename = self.add_warc('temp-abc', 'a-1.warc.gz')
+        self.redis.rpush(self.QUEUE_KEY, filename)
+
+        self.committer.process_closed(1)
+
+        assert self.storage.uploads == []
+        assert self.committer.retries == {}
+        assert os.path.isfile(filename)
+
+    def test_sweep(self):
+        assert self.committer.sweep_secs == 600
+
+        # first pass always sweeps
+        self.add_warc('a', 'a-1.warc.gz')
+        self.committer.process(1)
+        assert self.storage.uploads == [('a', 'a-1.warc.gz')]
+
+        # not queued, so only found by the next sweep
+        filename = self.add_warc('a', 'a-2.warc.gz')
+        self.committer.process(1)
+        assert len(self.storage.uploads) == 1
+
+        self.committer.last_sweep = time.time() - 601
+        self.committer.process(1)
+
+        assert self.storage.uploads == [('a', 'a-1.warc.gz'), ('a', 'a-2.warc.gz')]
+        assert not os.path.isfile(filename)
+
+    def test_popped_and_lost(self):
+        self.committer.last_sweep = time.time()
+
+        filename = self.add_warc('a', 'a-1.warc.gz')
+        self.redis.rpush(self.QUEUE_KEY, filename)
+
+        # popped by a committer that then crashed
+        assert self.redis.blpop(self.QUEUE_KEY, timeout=1)[1] == filename.encode('utf-8')
+
+        self.committer.process(1)
+        assert self.storage.uploads == []
+        assert os.path.isfile(filename)
+
+        self.committer.last_sweep = time.time() - 601
+        self.committer.process(1)
+
+        assert self.storage.uploads == [('a', 'a-1.warc.gz')]
+        assert not os.path.isfile(filename)
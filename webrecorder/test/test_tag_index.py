@@ -0,0 +1,52 @@
+from fakeredis import FakeStrictRedis
+
+from webrecorder.redisutils import TagIndex
+
+
+# ============================================================================
+class TestTagIndex(object):
+    PAGE_A = 'http://example.com/ 20160102030000 chrome:53'
+    PAGE_B = 'http://example.com/foo 20150102030000 -'
+
+    def setup_method(self, method):
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+
+        self.tag_index = TagIndex(self.redis, {'tag_pages_key_templ': 't:{tag}:pages',
+                                               'user_tag_templ': 'r:{user}:{coll}:{rec}:tag:{tag}'})
+
+    def add_pages(self):
+        pi = self.redis.pipeline()
+        self.tag_index.add(pi, 'foo', 'user', 'coll', 'rec', self.PAGE_A, self.PAGE_B)
+        pi.execute()
+
+    def test_parse_tag_key(self):
+        assert self.tag_index.parse_tag_key('r:user:coll:rec:tag:foo') == ('user', 'coll', 'rec', 'foo')
+        assert self.tag_index.parse_tag_key('r:user:coll:rec:page') == None
+
+    def test_add_by_timestamp(self):
+        self.add_pages()
+
+        assert list(self.tag_index.iter_pages('foo')) == [('user', 'coll', 'rec', self.PAGE_B),
+                                                          ('user', 'coll', 'rec', self.PAGE_A)]
+
+    def test_move_key(self):
+        self.add_pages()
+
+        pi = self.redis.pipeline()
+        self.tag_index.move_key(pi, 'r:user:coll:rec:tag:foo', 'r:user2:coll2:rec2:tag:foo',
+                                [self.PAGE_A.encode('utf-8')])
+        pi.execute()
+
+        assert list(self.tag_index.iter_pages('foo')) == [('user', 'coll', 'rec', self.PAGE_B),
+                                                          ('user2', 'coll2', 'rec2', self.PAGE_A)]
+
+    def test_remove_key(self):
+        self.add_pages()
+
+        pi = self.redis.pipeline()
+        self.tag_index.remove_key(pi, 'r:user:coll:rec:tag:foo', [self.PAGE_B.encode('utf-8')])
+        pi.execute()
+
+        assert self.tag_index.num_pages('foo') == 1
+        assert list(self.tag_index.iter_pages('foo')) == [('user', 'coll', 'rec', self.PAGE_A)]
@@ -0,0 +1,131 @@
+from webrecorder.uploadcontroller import UploadReader, UploadJobQueue
+
+from fakeredis import FakeStrictRedis
+from io import BytesIO
+
+import gevent
+import json
+
+
+# ============================================================================
+class TestUploadReader(object):
+    DATA = b''.join(str(i).encode('utf-8') for i in range(2000))
+
+    def sent(self, reader, start, end):
+        res = []
+
+        def send_func(stream, length):
+            res.append(stream.read(length))
+
+        reader.send(start, end, send_func)
+        return res[0]
+
+    def test_send_from_buff(self):
+        reader = UploadReader(BytesIO(self.DATA), max_buff=10000)
+        reader.read(1000)
+
+        assert self.sent(reader, 200, 700) == self.DATA[200:700]
+
+        reader.discard(700)
+        reader.read(500)
+
+        assert reader.in_buff
+        assert len(reader.buff) == 800
+        assert self.sent(reader, 700, 1500) == self.DATA[700:1500]
+
+    def test_send_past_max_buff(self):
+        stream = BytesIO(self.DATA)
+        reader = UploadReader(stream, max_buff=1000)
+
+        for _ in range(8):
+            reader.read(256)
+
+        assert not reader.in_buff
+        assert len(reader.buff) == 0
+
+        # reread from stream, position kept for next read
+        assert self.sent(reader, 100, 1900) == self.DATA[100:1900]
+        assert stream.tell() == 2048
+
+        # bytes past end read back into buffer
+        reader.discard(1900)
+        assert reader.in_buff
+        assert reader.buff == self.DATA[1900:2048]
+
+        reader.read(256)
+        assert self.sent(reader, 1900, 2304) == self.DATA[1900:2304]
+
+    def test_not_seekable(self):
+        stream = BytesIO(self.DATA)
+        stream.seekable = lambda: False
+
+        reader = UploadReader(stream, max_buff=1000)
+        reader.read(2000)
+
+        assert reader.in_buff
+        assert self.sent(reader, 0, 2000) == self.DATA[:2000]
+
+
+# ============================================================================
+class TestUploadJobQueue(object):
+    def setup_method(self):
+        self.redis = FakeStrictRedis()
+        self.processed = []
+        self.failed = []
+        self.queues = []
+
+    def teardown_method(self):
+        for queue in self.queues:
+            gevent.killall(queue.workers)
+
+    def make_queue(self, process=None):
+        queue = UploadJobQueue(self.redis, 'q:uploads', 'h:uploads',
+                               lease_secs=30, poll_secs=0.01, num_workers=2,
+                               process=process or self.processed.append,
+                               fail=lambda job, msg: self.failed.append((job, msg)))
+
+        self.queues.append(queue)
+        return queue
+
+    def test_run_only_once_started(self):
+        queue = self.make_queue()
+        queue.put('abc', {'upload_id': 'abc', 'user': 'test', 'force_coll': 'foo'})
+
+        gevent.sleep(0.05)
+        assert self.processed == []
+        assert queue.workers == []
+
+        queue.start()
+        gevent.sleep(0.05)
+
+        assert len(self.processed) == 1
+        job = self.processed[0]
+        assert job['user'] == 'test'
+        assert job['force_coll'] == 'foo'
+
+        assert self.redis.zcard('q:uploads') == 0
+        assert self.redis.hlen('h:uploads') == 0
+
+    def test_run_once_by_several_queues(self):
+        def process(job):
+            self.processed.append(job)
+            gevent.sleep(0.05)
+
+        for _ in range(3):
+            self.make_queue(process).start()
+
+        self.queues[0].put('abc', {'upload_id': 'abc', 'user': 'test'})
+        gevent.sleep(0.2)
+
+        assert [job['upload_id'] for job in self.processed] == ['abc']
+
+    def test_interrupted_fails(self):
+        queue = self.make_queue()
+        queue.put('abc', {'upload_id': 'abc', 'user': 'test', 'started': 1})
+        queue.start()
+        gevent.sleep(0.05)
+
+        assert self.processed == []
+        assert len(self.failed) == 1
+        assert self.failed[0][0]['upload_id'] == 'abc'
+        assert self.redis.hlen('h:uploads') == 0
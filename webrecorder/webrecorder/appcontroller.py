@@ -107,6 +107,12 @@ class AppController(BaseController):
                                 manager=manager,
                                 config=config)
 
+            if controller_type == UploadController:
+                upload_controller = x
+
+        # Run queued uploads in this app, incl. any queued before a restart
+        upload_controller.upload_jobs.start()
+
         # Set Error Handler
         bottle_app.default_error_handler = self.make_err_handler(
                                             bottle_app.default_error_handler)
@@ -252,6 +258,14 @@ class AppController(BaseController):
             else:
                 self.fill_anon_info(resp)
 
+            # player archives still being indexed
+            index_status_key = self.config.get('player_index_status_key')
+            if index_status_key:
+                total, indexed = self.manager.redis.hmget(index_status_key, ['total', 'indexed'])
+                if total and int(indexed or 0) < int(total):
+                    resp['index_total'] = int(total)
+                    resp['index_count'] = int(indexed or 0)
+
             return resp
 
         @self.bottle_app.route('/_faq')
@@ -91,6 +91,36 @@ class BaseController(object):
             err.json_err = True
         raise err
 
+    def get_paging(self, api=False):
+        """ offset and limit query params, limit of None if not paging
+        """
+        try:
+            offset = int(request.query.get('offset', 0))
+            limit = request.query.get('limit')
+            limit = int(limit) if limit else None
+        except ValueError:
+            offset = -1
+
+        if offset < 0 or (limit is not None and limit < 0):
+            self._raise_error(400, 'Invalid offset or limit', api=api)
+
+        return offset, limit
+
+    def get_cursor(self, default_limit, api=False):
+        """ cursor and limit query params, for paging by cursor
+        """
+        cursor = request.query.getunicode('cursor') or None
+
+        try:
+            limit = int(request.query.get('limit', default_limit))
+        except ValueError:
+            limit = 0
+
+        if limit <= 0:
+            self._raise_error(400, 'Invalid limit', api=api)
+
+        return cursor, limit
+
     def get_session(self):
         return request.environ['webrec.session']
 
@@ -10,6 +10,8 @@ import json
 
 # ============================================================================
 class CollsController(BaseController):
+    VIEW_PAGES_LIMIT = 500
+
     def __init__(self, app, jinja_env, manager, config):
         super(CollsController, self).__init__(app, jinja_env, manager, config)
         self.default_coll_desc = config['coll_desc']
@@ -118,6 +120,16 @@ class CollsController(BaseController):
 
             return {'count': self.manager.count_pages(user, coll, rec='*') }
 
+        @self.app.get('/api/v1/collections/<coll>/pages')
+        def list_pages(coll):
+            user = self.get_user(api=True)
+            self._ensure_coll_exists(user, coll)
+
+            cursor, limit = self.get_cursor(self.manager.PAGES_LIMIT, api=True)
+
+            pages, cursor = self.manager.list_pages_paged(user, coll, '*', cursor, limit)
+            return {'pages': pages, 'cursor': cursor}
+
         @self.app.post('/api/v1/collections/<coll>/mount')
         def add_mount(coll):
             user = self.get_user(api=True)
@@ -256,8 +268,26 @@ class CollsController(BaseController):
         result['rec_title'] = ''
         result['coll_title'] = result['collection']['title']
 
+        # only the current window of pages, by timestamp, the next window is
+        # loaded with the returned cursor, and the previous window with the prev cursor
+        cursor = request.query.getunicode('cursor') or None
+        pages, result['pages_cursor'] = self.manager.list_pages_paged(user, coll, '*',
+                                                                      cursor,
+                                                                      self.VIEW_PAGES_LIMIT)
+
+        result['pages_prev_cursor'] = self.manager.get_prev_pages_cursor(user, coll, '*',
+                                                                         cursor,
+                                                                         self.VIEW_PAGES_LIMIT)
+
+        rec_pages = {}
+        for page in pages:
+            rec_pages.setdefault(page['recording'], []).append(page)
+
+        num_pages = self.manager.count_rec_pages(user, coll)
+
         for rec in result['collection']['recordings']:
-           rec['pages'] = self.manager.list_pages(user, coll, rec['id'])
+           rec['pages'] = rec_pages.get(rec['id'], [])
+           rec['num_pages'] = num_pages.get(rec['id'], 0)
            result['bookmarks'].append(rec['pages'])
 
         if not result['collection'].get('desc'):
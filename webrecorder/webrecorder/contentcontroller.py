@@ -59,10 +59,12 @@ class ContentController(BaseController, RewriterApp):
 
             active_tags = self.manager.get_available_tags()
 
+            offset, limit = self.get_paging()
+
             for tag in tags:
                 if tag in active_tags:
                     keys.append(tag)
-                    items[tag] = self.manager.get_pages_for_tag(tag)
+                    items[tag] = self.manager.get_pages_for_tag(tag, offset, limit)
 
             return {'data': items, 'keys': keys}
 
@@ -393,6 +395,16 @@ class ContentController(BaseController, RewriterApp):
 
         self.cookie_tracker.add_cookie(key, domain, name, value)
 
+        # register cookie key with its owner, for rename and delete
+        templ = self.get_cookie_key(dict(user='{user}',
+                                         coll='{coll}',
+                                         rec='{rec}' if rec != '*' else rec))
+
+        if rec != '*':
+            self.manager.key_registry.register(self.manager.redis, 'rec', templ, user, coll, rec)
+        else:
+            self.manager.key_registry.register(self.manager.redis, 'coll', templ, user, coll)
+
     ## RewriterApp overrides
     def get_base_url(self, wb_url, kwargs):
         type = kwargs['type']
@@ -415,8 +427,10 @@ class ContentController(BaseController, RewriterApp):
         cdx['rec'] = rec
 
     def get_query_params(self, wb_url, kwargs):
-        collection = self.manager.get_collection(kwargs['user'], kwargs['coll_orig'])
-        kwargs['rec_titles'] = dict((rec['id'], rec['title']) for rec in collection['recordings'])
+        collection = self.manager.get_collection(kwargs['user'], kwargs['coll_orig'],
+                                                 include_recs=False)
+
+        kwargs['rec_titles'] = self.manager.get_rec_titles(kwargs['user'], kwargs['coll_orig'])
 
         kwargs['user'] = self.get_view_user(kwargs['user'])
         kwargs['coll_title'] = collection.get('title', '')
@@ -1,4 +1,4 @@
-from pywb.utils.timeutils import timestamp_now
+from pywb.utils.timeutils import datetime_to_timestamp, datetime_to_iso_date
 from pywb.utils.loaders import BlockLoader
 
 from pywb.webagg.utils import StreamIter, chunk_encode_iter
@@ -7,25 +7,45 @@ from pywb.recorder.warcwriter import SimpleTempWARCWriter
 from webrecorder.basecontroller import BaseController
 from webrecorder import __version__
 
-from bottle import response
+from bottle import request, response
+from gevent.socket import wait_write
 from six.moves.urllib.parse import quote
 from six import iteritems
 from collections import OrderedDict
+from itertools import chain
+from datetime import datetime
+import hashlib
 import json
+import os
+import redis
+import re
+import time
+import uuid
 
 
+BLOCK_SIZE = 16384 * 8
+
 # ============================================================================
 class DownloadController(BaseController):
     COPY_FIELDS = ['title', 'desc', 'size', 'updated_at', 'created_at']
 
+    RANGE_RX = re.compile(r'bytes=(\d*)-(\d*)$')
+
     def __init__(self, app, jinja_env, manager, config):
         super(DownloadController, self).__init__(app, jinja_env, manager, config)
         self.paths = config['url_templates']
         self.download_filename = config['download_paths']['filename']
         self.warc_key_templ = config['warc_key_templ']
+        self.warc_size_key_templ = config['warc_size_key_templ']
 
         self.download_chunk_encoded = config['download_chunk_encoded']
 
+        self.download_local_warcs = config['download_local_warcs']
+        self.full_warc_prefix = config['full_warc_prefix']
+
+        self.warcinfo_cache = WarcInfoCache(int(config['download_warcinfo_cache_size']),
+                                            int(config['download_warcinfo_cache_secs']))
+
     def init_routes(self):
         @self.app.get('/<user>/<coll>/<rec>/$download')
         def logged_in_download_rec_warc(user, coll, rec):
@@ -39,7 +59,7 @@ class DownloadController(BaseController):
 
             return self.handle_download(user, coll, '*')
 
-    def create_warcinfo(self, creator, title, metadata, source, filename):
+    def create_warcinfo(self, creator, title, metadata, source, filename, id_key=''):
         for name, value in iteritems(source):
             if name in self.COPY_FIELDS:
                 metadata[name] = value
@@ -53,7 +73,18 @@ class DownloadController(BaseController):
                ])
 
         wi_writer = SimpleTempWARCWriter()
-        wi_writer.write_record(wi_writer.create_warcinfo_record(filename, info))
+        record = wi_writer.create_warcinfo_record(filename, info)
+
+        # same id and date on every download, so byte ranges stay valid
+        # for as long as the source is unchanged
+        updated_at = source.get('updated_at') or source.get('created_at', 0)
+        warc_date = datetime_to_iso_date(datetime.utcfromtimestamp(updated_at))
+        warc_id = uuid.uuid5(uuid.NAMESPACE_URL, filename + '/' + id_key)
+
+        record.rec_headers.replace_header('WARC-Date', warc_date)
+        record.rec_headers.replace_header('WARC-Record-ID', '<urn:uuid:{0}>'.format(warc_id))
+
+        wi_writer.write_record(record)
         return wi_writer.get_buffer()
 
     def create_coll_warcinfo(self, user, collection, filename=''):
@@ -61,17 +92,41 @@ class DownloadController(BaseController):
         metadata['type'] = 'collection'
 
         title = quote(collection['title'])
-        return self.create_warcinfo(user, title, metadata, collection, filename)
+        return self.create_warcinfo(user, title, metadata, collection, filename,
+                                    id_key=collection['id'])
 
     def create_rec_warcinfo(self, user, collection, recording, filename=''):
+        coll = collection['id']
+        rec = recording['id']
+
+        # any page change updates the pages version, hidden pages
+        # are only included for admins
+        cache_key = (user, coll, rec, filename, collection['title'],
+                     recording.get('pages_version'),
+                     self.manager.can_admin_coll(user, coll))
+
+        cache_key += tuple(recording.get(name) for name in self.COPY_FIELDS)
+
+        warcinfo = self.warcinfo_cache.get(cache_key)
+        if warcinfo is None:
+            warcinfo = self._create_rec_warcinfo(user, collection, recording, filename)
+            self.warcinfo_cache.set(cache_key, warcinfo)
+
+        return warcinfo
+
+    def _create_rec_warcinfo(self, user, collection, recording, filename):
         metadata = {}
-        metadata['pages'] = self.manager.list_pages(user,
-                                                    collection['id'],
-                                                    recording['id'])
+        pages = self.manager.list_pages(user,
+                                        collection['id'],
+                                        recording['id'])
+
+        metadata['pages'] = sorted(pages, key=lambda page: (page.get('timestamp', ''),
+                                                            page.get('url', '')))
         metadata['type'] = 'recording'
 
         title = quote(collection['title']) + '/' + quote(recording['title'])
-        return self.create_warcinfo(user, title, metadata, recording, filename)
+        return self.create_warcinfo(user, title, metadata, recording, filename,
+                                    id_key=collection['id'] + '/' + recording['id'])
 
     def handle_download(self, user, coll, rec):
         collection = self.manager.get_collection(user, coll, rec)
@@ -79,8 +134,6 @@ class DownloadController(BaseController):
             self._raise_error(404, 'Collection not found',
                               id=coll)
 
-        now = timestamp_now()
-
         name = collection['id']
         if rec != '*':
             rec_list = rec.split(',')
@@ -91,64 +144,389 @@ class DownloadController(BaseController):
         else:
             rec_list = None
 
+        recordings = [recording for recording in collection['recordings']
+                      if not rec_list or recording['id'] in rec_list]
+
+        recordings.sort(key=lambda recording: (recording.get('created_at', 0),
+                                               recording['id']))
+
+        # timestamp of last change, rather than now, so that repeat
+        # downloads of unchanged content are identical
+        updated_at = max([collection.get('updated_at', 0),
+                          collection.get('created_at', 0)] +
+                         [recording.get('updated_at', 0) for recording in recordings])
+
+        updated_at = updated_at or int(time.time())
+
+        now = datetime_to_timestamp(datetime.utcfromtimestamp(updated_at))
+
         filename = self.download_filename.format(title=quote(name),
                                                  timestamp=now)
-        loader = BlockLoader()
+
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Content-Disposition'] = "attachment; filename*=UTF-8''" + filename
 
         coll_info = self.create_coll_warcinfo(user, collection, filename)
 
-        def iter_infos():
-            for recording in collection['recordings']:
-                if rec_list and recording['id'] not in rec_list:
-                    continue
+        # stream everything
+        if self.download_chunk_encoded:
+            response.headers['Transfer-Encoding'] = 'chunked'
 
-                warcinfo = self.create_rec_warcinfo(user,
-                                                    collection,
-                                                    recording,
-                                                    filename)
+            return self.iter_download(user, collection, recordings, coll_info, filename)
 
-                size = len(warcinfo)
-                size += recording['size']
-                yield recording, warcinfo, size
+        plan = self.plan_download(user, collection, recordings, coll_info, filename)
 
-        def read_all(infos):
-            yield coll_info
+        response.headers['ETag'] = plan.etag
 
-            for recording, warcinfo, _ in infos:
-                yield warcinfo
+        if not plan.seekable:
+            response.headers['Accept-Ranges'] = 'none'
+            response.headers['Content-Length'] = plan.size
+            return plan.iter_range()
 
-                for warc_path in self._iter_all_warcs(user, coll, recording['id']):
-                    try:
-                        fh = loader.load(warc_path)
-                    except:
-                        print('Skipping invalid ' + warc_path)
-                        continue
+        response.headers['Accept-Ranges'] = 'bytes'
 
-                    for chunk in StreamIter(fh):
-                        yield chunk
+        range_ = None
+        if request.headers.get('If-Range', plan.etag) == plan.etag:
+            range_ = self.parse_range(request.headers.get('Range'), plan.size)
 
-        response.headers['Content-Type'] = 'application/octet-stream'
-        response.headers['Content-Disposition'] = "attachment; filename*=UTF-8''" + filename
+        if not range_:
+            response.headers['Content-Length'] = plan.size
+            return plan.iter_range()
 
-        # if not transfer-encoding, store infos and calculate total size
-        if not self.download_chunk_encoded:
-            size = len(coll_info)
-            infos = list(iter_infos())
-            size += sum(size for r, i, size in infos)
+        start, end = range_
+        if start >= plan.size or start > end:
+            response.status = 416
+            response.headers['Content-Range'] = 'bytes */{0}'.format(plan.size)
+            return b''
 
-            response.headers['Content-Length'] = size
-            return read_all(infos)
+        response.status = 206
+        response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, plan.size)
+        response.headers['Content-Length'] = end - start + 1
 
-        else:
-        # stream everything
-            response.headers['Transfer-Encoding'] = 'chunked'
+        return plan.iter_range(start, end - start + 1)
+
+    def parse_range(self, range_header, size):
+        """ Parse a single 'bytes=' range into inclusive (start, end),
+        or None if not set or not supported, to send the whole download
+        """
+        if not range_header:
+            return None
+
+        m = self.RANGE_RX.match(range_header.strip())
+        if not m:
+            return None
+
+        start, end = m.groups()
+
+        if not start:
+            if not end:
+                return None
+
+            # suffix range, last n bytes
+            return max(size - int(end), 0), size - 1
+
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+        return start, end
+
+    def plan_download(self, user, collection, recordings, coll_info, filename):
+        # under uwsgi, local WARCs are sent to the client socket with sendfile(),
+        # only the warcinfo records and any remote WARCs are read in python
+        plan = DownloadPlan(sendfile=uwsgi_sendfile if uwsgi else None)
+        plan.add_buffer(coll_info)
+
+        for recording in recordings:
+            plan.add_buffer(self.create_rec_warcinfo(user,
+                                                     collection,
+                                                     recording,
+                                                     filename))
+
+            extents = self._get_warc_extents(user, collection['id'], recording['id'])
+
+            if extents is not None:
+                for warc_path, size in extents:
+                    plan.add_warc(warc_path, size, self._get_local_path(warc_path))
+            else:
+                warc_paths = list(self._iter_all_warcs(user,
+                                                       collection['id'],
+                                                       recording['id']))
+
+                plan.add_warcs(warc_paths, recording['size'])
+
+        return plan
+
+    def iter_download(self, user, collection, recordings, coll_info, filename):
+        loader = BlockLoader()
+
+        yield coll_info
+
+        for recording in recordings:
+            yield self.create_rec_warcinfo(user, collection, recording, filename)
+
+            for warc_path in self._iter_all_warcs(user, collection['id'], recording['id']):
+                warc_path = self._get_local_path(warc_path) or warc_path
+                for chunk in iter_warc(loader, warc_path):
+                    yield chunk
+
+    def _get_local_path(self, warc_path):
+        """ Return local filename for a WARC stored on this host's
+        filesystem, if downloading directly from local files is enabled
+        """
+        if not self.download_local_warcs:
+            return None
+
+        if not warc_path.startswith(self.full_warc_prefix):
+            return None
+
+        local_path = warc_path[len(self.full_warc_prefix):]
+        if not os.path.isfile(local_path):
+            return None
+
+        return local_path
+
+    def _get_warc_extents(self, user, coll, rec):
+        """ Return (warc_path, size) for each WARC in the recording,
+        ordered by WARC name, or None if the size of any WARC is not known
+        """
+        warc_key = self.warc_key_templ.format(user=user, coll=coll, rec=rec)
+        size_key = self.warc_size_key_templ.format(user=user, coll=coll, rec=rec)
 
-            return read_all(iter_infos())
+        with redis.utils.pipeline(self.manager.redis) as pi:
+            pi.hgetall(warc_key)
+            pi.hgetall(size_key)
+            allwarcs, sizes = pi.execute()
+
+        extents = []
+
+        for n, v in sorted(iteritems(allwarcs)):
+            size = sizes.get(n)
+            if size is None:
+                return None
+
+            extents.append((v.decode('utf-8'), int(size)))
+
+        return extents
 
     def _iter_all_warcs(self, user, coll, rec):
+        """ Yield the path of each WARC in the recording, ordered by WARC name,
+        the same as _get_warc_extents(), so all downloads are identical
+        """
         warc_key = self.warc_key_templ.format(user=user, coll=coll, rec=rec)
         allwarcs = self.manager.redis.hgetall(warc_key)
 
-        for n, v in iteritems(allwarcs):
-            #n = n.decode('utf-8')
+        for n, v in sorted(iteritems(allwarcs)):
             yield v.decode('utf-8')
+
+
+# ============================================================================
+def iter_warc(loader, warc_path, offset=0, length=-1):
+    try:
+        fh = loader.load(warc_path, offset, length)
+    except:
+        print('Skipping invalid ' + warc_path)
+        return
+
+    for chunk in StreamIter(fh):
+        yield chunk
+
+
+# ============================================================================
+def iter_local_file(local_path, offset, length, block_size=BLOCK_SIZE):
+    try:
+        fh = open(local_path, 'rb')
+    except IOError:
+        print('Skipping invalid ' + local_path)
+        return
+
+    with fh:
+        fh.seek(offset)
+        while length > 0:
+            buff = fh.read(min(block_size, length))
+            if not buff:
+                break
+
+            length -= len(buff)
+            yield buff
+
+
+# ============================================================================
+def uwsgi_sendfile(fh, offset, length):
+    """ Send length bytes of fh from offset directly to the uwsgi client
+    socket. Only valid once the response headers have been sent, and
+    with Content-Length set, as the bytes bypass any chunk encoding
+    """
+    out_fd = uwsgi.connection_fd()
+    in_fd = fh.fileno()
+
+    while length > 0:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset, length)
+        except BlockingIOError:
+            wait_write(out_fd)
+            continue
+
+        if not sent:
+            raise IOError('File shorter than expected')
+
+        offset += sent
+        length -= sent
+
+
+# ============================================================================
+class WarcInfoCache(object):
+    """ LRU cache of generated warcinfo records, limited by total bytes,
+    entries expire after ttl secs
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.cache = OrderedDict()
+
+    def get(self, key):
+        res = self.cache.pop(key, None)
+        if not res:
+            return None
+
+        buff, expires = res
+        if expires < time.time():
+            self.size -= len(buff)
+            return None
+
+        # most recently used last
+        self.cache[key] = res
+        return buff
+
+    def set(self, key, buff):
+        if len(buff) > self.max_size or self.ttl <= 0:
+            return
+
+        old = self.cache.pop(key, None)
+        if old:
+            self.size -= len(old[0])
+
+        while self.cache and self.size + len(buff) > self.max_size:
+            _, (old_buff, _) = self.cache.popitem(last=False)
+            self.size -= len(old_buff)
+
+        self.cache[key] = (buff, time.time() + self.ttl)
+        self.size += len(buff)
+
+
+# ============================================================================
+class DownloadPlan(object):
+    """ Map of a download as ordered segments, either generated warcinfo
+    buffers or WARC file extents, so that any byte range can be served
+    by seeking directly into the WARCs that contain it
+    """
+    def __init__(self, loader=None, sendfile=None):
+        self.loader = loader or BlockLoader()
+        self.sendfile = sendfile
+        self.segments = []
+        self.size = 0
+        self.seekable = True
+        self._digest = hashlib.md5()
+
+    @property
+    def etag(self):
+        return '"' + self._digest.hexdigest() + '"'
+
+    def add_buffer(self, buff):
+        self._digest.update(buff)
+        self._add(len(buff), buff, None)
+
+    def add_warc(self, warc_path, size, local_path=None):
+        """ Add WARC extent, read from local_path instead of loading
+        warc_path, if the WARC is available on the local filesystem
+        """
+        # by name, as the path changes once committed to remote storage
+        name = warc_path.rsplit('/', 1)[-1]
+        self._digest.update('{0} {1}\n'.format(name, size).encode('utf-8'))
+
+        self._add(size, None, [local_path or warc_path], local_path)
+
+    def add_warcs(self, warc_paths, total_size):
+        """ WARCs with only the total size known, only downloadable in full
+        """
+        self.seekable = False
+
+        for warc_path in warc_paths:
+            self._digest.update(warc_path.rsplit('/', 1)[-1].encode('utf-8') + b'\n')
+
+        self._add(total_size, None, warc_paths)
+
+    def _add(self, length, buff, warc_paths, local_path=None):
+        self.segments.append((self.size, length, buff, warc_paths, local_path))
+        self.size += length
+
+    def iter_range(self, start=0, length=None):
+        if length is None:
+            length = self.size - start
+
+        end = start + length
+
+        # set once any bytes are yielded, and so the headers sent
+        started = False
+
+        for offset, seg_length, buff, warc_paths, local_path in self.segments:
+            if offset + seg_length <= start:
+                continue
+
+            if offset >= end:
+                break
+
+            skip = max(start - offset, 0)
+            count = min(offset + seg_length, end) - offset - skip
+
+            if buff is not None:
+                chunks = [buff[skip:skip + count]]
+
+            elif local_path and self.sendfile:
+                chunks = self._send_local(local_path, skip, count, started)
+
+            elif local_path:
+                chunks = iter_local_file(local_path, skip, count)
+
+            elif len(warc_paths) == 1:
+                chunks = iter_warc(self.loader, warc_paths[0], skip, count)
+
+            else:
+                chunks = chain.from_iterable(iter_warc(self.loader, warc_path)
+                                             for warc_path in warc_paths)
+
+            for chunk in chunks:
+                if chunk:
+                    started = True
+
+                yield chunk
+
+    def _send_local(self, local_path, offset, length, started):
+        """ Send from the local file with sendfile(). The server only
+        resumes iteration once the last chunk is written, so earlier bytes
+        are already sent. If there are none, the first block is yielded
+        instead, so that the headers are sent first
+        """
+        try:
+            fh = open(local_path, 'rb')
+        except IOError:
+            print('Skipping invalid ' + local_path)
+            return
+
+        with fh:
+            if not started:
+                fh.seek(offset)
+                buff = fh.read(min(BLOCK_SIZE, length))
+                yield buff
+
+                offset += len(buff)
+                length -= len(buff)
+
+            if length > 0:
+                self.sendfile(fh, offset, length)
+
+
+# ============================================================================
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
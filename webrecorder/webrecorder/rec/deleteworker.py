@@ -0,0 +1,30 @@
+from webrecorder.utils import load_wr_config
+from webrecorder.rec.webrecrecorder import WebRecRecorder
+from webrecorder.rec.storagecommitter import StorageCommitter
+
+
+# =============================================================================
+def init_storage_committer(config):
+    """ Storage committer for storage lookup only, for deleting remote WARCs
+    """
+    from webrecorder.rec.s3 import S3Storage
+
+    storage_committer = StorageCommitter(config)
+    storage_committer.add_storage_class('s3', S3Storage)
+    return storage_committer
+
+
+# =============================================================================
+def run():
+    config = load_wr_config()
+
+    wr = WebRecRecorder(config)
+    wr.storage_committer = init_storage_committer(config)
+
+    # jobs are leased, so safe to run with other delete workers
+    wr.delete_loop()
+
+
+# =============================================================================
+if __name__ == "__main__":
+    run()
@@ -2,6 +2,7 @@ from gevent import monkey; monkey.patch_all()
 
 from webrecorder.utils import load_wr_config
 from webrecorder.rec.webrecrecorder import WebRecRecorder
+from webrecorder.rec.deleteworker import init_storage_committer
 
 import gevent
 
@@ -14,9 +15,22 @@ def init():
 
     gevent.spawn(wr.msg_listen_loop)
 
-    wr.init_app(None)
+    # one-time registration of keys created before key registries
+    gevent.spawn(wr.key_registry.build)
+
+    # deletes run by the delete worker mule, unless enabled here
+    run_delete_worker = config['run_delete_worker']
+
+    storage_committer = None
+    if run_delete_worker:
+        storage_committer = init_storage_committer(config)
+
+    wr.init_app(storage_committer)
     wr.app.wr = wr
 
+    if run_delete_worker:
+        gevent.spawn(wr.delete_loop)
+
     return wr.app
 
 
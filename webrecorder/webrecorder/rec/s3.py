@@ -1,9 +1,20 @@
 import boto
+import os
+import threading
+
+from boto.s3.multipart import MultiPartUpload
+from concurrent.futures import ThreadPoolExecutor
 from six.moves.urllib.parse import urlsplit, quote_plus
 
 
 ## ============================================================================
 class S3Storage(object):
+    DEFAULT_PART_SIZE = 16 * 1024 * 1024
+    DEFAULT_PART_THREADS = 4
+
+    # max keys per multi-object delete request
+    DELETE_BATCH_SIZE = 1000
+
     def __init__(self, config):
         self.remote_url_templ = config['remote_url_templ']
 
@@ -12,11 +23,31 @@ class S3Storage(object):
 
         self.config = config
 
-        self.conn = boto.connect_s3(aws_access_key_id=config.get('aws_access_key_id'),
-                                    aws_secret_access_key=config.get('aws_secret_access_key'))
+        self.conn = self._connect()
 
         self.bucket = self.conn.get_bucket(self.bucket_name)
 
+        self.thread_local = threading.local()
+
+        self.uploader = S3MultipartUploader(self.bucket,
+                            part_size=int(config.get('part_size', self.DEFAULT_PART_SIZE)),
+                            num_threads=int(config.get('part_threads', self.DEFAULT_PART_THREADS)),
+                            get_bucket=self._get_thread_bucket)
+
+    def _connect(self):
+        return boto.connect_s3(aws_access_key_id=self.config.get('aws_access_key_id'),
+                               aws_secret_access_key=self.config.get('aws_secret_access_key'))
+
+    def _get_thread_bucket(self):
+        # boto connections are not thread-safe, each upload thread uses its own,
+        # kept for all the parts that thread uploads
+        bucket = getattr(self.thread_local, 'bucket', None)
+        if not bucket:
+            bucket = self._connect().get_bucket(self.bucket_name, validate=False)
+            self.thread_local.bucket = bucket
+
+        return bucket
+
     def _split_bucket_path(self, url):
         parts = urlsplit(url)
         return parts.netloc, parts.path.lstrip('/')
@@ -36,11 +67,14 @@ class S3Storage(object):
         s3_url += self.bucket_name + '/' + remote_path
         return s3_url
 
+    def _get_remote_path(self, user, coll, rec, warcname):
+        return self.remote_path_templ.format(user=user,
+                                             coll=coll,
+                                             rec=rec,
+                                             filename=warcname)
+
     def get_valid_remote_url(self, user, coll, rec, warcname):
-        remote_path = self.remote_path_templ.format(user=user,
-                                                    coll=coll,
-                                                    rec=rec,
-                                                    filename=warcname)
+        remote_path = self._get_remote_path(user, coll, rec, warcname)
 
         key = self.bucket.get_key(remote_path)
         if key is not None:
@@ -48,19 +82,57 @@ class S3Storage(object):
         else:
             return None
 
+    def get_valid_remote_urls(self, warcs):
+        """ Check many uploaded WARCs with one listing per remote dir,
+        instead of a HEAD request per WARC
+
+        warcs: list of (user, coll, rec, warcname, size), size may be None
+        returns dict of (user, warcname) -> (remote_url, etag, size)
+        for each WARC found with the expected size
+        """
+        remote_dirs = {}
+
+        for user, coll, rec, warcname, size in warcs:
+            remote_path = self._get_remote_path(user, coll, rec, warcname)
+            remote_dir = remote_path.rsplit('/', 1)[0] + '/'
+            remote_dirs.setdefault(remote_dir, {})[remote_path] = (user, warcname, size)
+
+        results = {}
+
+        for remote_dir, paths in remote_dirs.items():
+            first = min(paths)
+            last = max(paths)
+
+            # listing is sorted, start just before the first pending path
+            for key in self.bucket.list(prefix=remote_dir, marker=first[:-1]):
+                if key.name > last:
+                    break
+
+                res = paths.get(key.name)
+                if not res:
+                    continue
+
+                user, warcname, size = res
+
+                # objects are only listed once complete, so a size mismatch is
+                # an earlier upload, listed before this upload's complete_upload
+                # (checked again on a later cycle)
+                if size is not None and key.size != size:
+                    continue
+
+                remote_url = self._get_s3_url(key.name, self.config.get('profile'))
+                results[(user, warcname)] = (remote_url, key.etag, key.size)
+
+        return results
+
     def upload_file(self, user, coll, rec, warcname, full_filename):
-        remote_path = self.remote_path_templ.format(user=user,
-                                                    coll=coll,
-                                                    rec=rec,
-                                                    filename=warcname)
+        remote_path = self._get_remote_path(user, coll, rec, warcname)
 
         s3_url = self._get_s3_url(remote_path)
 
         try:
-            new_key = self.bucket.new_key(remote_path)
             print('Uploading {0} -> {1}'.format(full_filename, s3_url))
-            with open(full_filename, 'rb') as fh:
-                new_key.set_contents_from_file(fh, replace=True)
+            self.uploader.upload(remote_path, full_filename)
         except Exception as e:
             print(e)
             print('Failed to Upload to {0}'.format(s3_url))
@@ -69,20 +141,20 @@ class S3Storage(object):
         return True
 
     def delete(self, delete_list):
-        path_list = []
-
-        for remote_file in delete_list:
-            if not remote_file.startswith('s3://'):
-                print('Invalid S3 Filename: ' + remote_file)
-                continue
+        try:
+            for count in self.iter_delete(delete_list):
+                pass
 
-            bucket, path = self._split_bucket_path(remote_file)
-            print('Deleting Remote', remote_file)
+        except Exception as e:
+            print(e)
+            return False
 
-            path_list.append(path)
+        return True
 
+    def delete_user(self, user):
         try:
-            self.bucket.delete_keys(path_list)
+            for count in self.iter_delete_user(user):
+                pass
 
         except Exception as e:
             print(e)
@@ -90,22 +162,136 @@ class S3Storage(object):
 
         return True
 
-    def delete_user(self, user):
+    def iter_delete(self, delete_list):
+        """ Delete remote WARCs, at most DELETE_BATCH_SIZE per request,
+        yielding the number deleted after each batch
+        """
+        path_list = []
+
+        for remote_file in delete_list:
+            if not remote_file.startswith('s3://'):
+                print('Invalid S3 Filename: ' + remote_file)
+                continue
+
+            bucket, path = self._split_bucket_path(remote_file)
+            path_list.append(path)
+
+        for start in range(0, len(path_list), self.DELETE_BATCH_SIZE):
+            batch = path_list[start:start + self.DELETE_BATCH_SIZE]
+            self._delete_keys(batch)
+            yield len(batch)
+
+    def iter_delete_user(self, user):
+        """ Delete all remote files of a user, paging through the listing
+        and yielding the number deleted after each batch
+        """
         remote_path = self.remote_path_templ.format(user=user,
                                                     filename='')
 
-        path_list = []
+        batch = []
 
+        # listing continues after the last key listed, so deleting as we go is safe
         for key in self.bucket.list(prefix=remote_path):
-            path_list.append(key)
-            print('Deleting ' + key.name)
+            batch.append(key.name)
 
-        try:
-            self.bucket.delete_keys(path_list)
+            if len(batch) == self.DELETE_BATCH_SIZE:
+                self._delete_keys(batch)
+                yield len(batch)
+                batch = []
 
-        except Exception as e:
-            print(e)
-            return False
+        if batch:
+            self._delete_keys(batch)
+            yield len(batch)
 
-        return True
+    def _delete_keys(self, path_list):
+        print('Deleting Remote: {0} files from {1}'.format(len(path_list), path_list[0]))
+
+        res = self.bucket.delete_keys(path_list, quiet=True)
+
+        # deleting a missing key is not an error, so a retried delete succeeds
+        if res.errors:
+            msg = 'Remote Delete Failed: {0} errors, first: {1} {2}'
+            raise Exception(msg.format(len(res.errors), res.errors[0].key, res.errors[0].message))
+
+
+## ============================================================================
+class S3MultipartUploader(object):
+    """ Upload files as S3 multipart uploads, sending parts in parallel
+
+    Incomplete uploads are left in place on failure, and the next upload
+    of the same remote path resumes from the parts already completed.
+    Files no larger than one part are uploaded in a single request.
+    """
+    def __init__(self, bucket, part_size, num_threads=1, get_bucket=None):
+        self.bucket = bucket
+        self.part_size = part_size
+        self.num_threads = max(num_threads, 1)
+        self.get_bucket = get_bucket
+
+    def upload(self, remote_path, full_filename):
+        size = os.path.getsize(full_filename)
+
+        if size <= self.part_size:
+            new_key = self.bucket.new_key(remote_path)
+            with open(full_filename, 'rb') as fh:
+                new_key.set_contents_from_file(fh, replace=True)
+            return
+
+        mp = self.find_incomplete_upload(remote_path)
+
+        done_parts = {}
+
+        if mp:
+            for part in mp:
+                done_parts[part.part_number] = part.size
+
+            print('Resuming upload of {0}, {1} parts done'.format(remote_path,
+                                                                  len(done_parts)))
+        else:
+            mp = self.bucket.initiate_multipart_upload(remote_path)
+
+        parts = []
+
+        for part_num, offset, length in self.iter_parts(size):
+            if done_parts.get(part_num) != length:
+                parts.append((part_num, offset, length))
+
+        if parts:
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                futures = [executor.submit(self.upload_part, mp, full_filename, *part)
+                           for part in parts]
+
+            # all parts attempted, raise first error, if any
+            for future in futures:
+                future.result()
+
+        mp.complete_upload()
+
+    def iter_parts(self, size):
+        part_num = 1
+        offset = 0
+
+        while offset < size:
+            length = min(self.part_size, size - offset)
+            yield part_num, offset, length
+
+            part_num += 1
+            offset += length
+
+    def find_incomplete_upload(self, remote_path):
+        for mp in self.bucket.get_all_multipart_uploads(prefix=remote_path):
+            if mp.key_name == remote_path:
+                return mp
+
+        return None
+
+    def upload_part(self, mp, full_filename, part_num, offset, length):
+        if self.get_bucket:
+            thread_mp = MultiPartUpload(self.get_bucket())
+            thread_mp.key_name = mp.key_name
+            thread_mp.id = mp.id
+            mp = thread_mp
 
+        with open(full_filename, 'rb') as fh:
+            fh.seek(offset)
+            mp.upload_part_from_file(fh, part_num, size=length)
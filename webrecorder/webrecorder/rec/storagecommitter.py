@@ -3,6 +3,9 @@ import redis
 import datetime
 import fcntl
 import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 from webrecorder.utils import load_wr_config
 
@@ -17,6 +20,9 @@ class StorageCommitter(object):
         self.record_root_dir = os.environ['RECORD_ROOT']
 
         self.warc_key_templ = config['warc_key_templ']
+        self.warc_owner_key_templ = config['warc_owner_key_templ']
+        self.warc_owner_built_key = config['warc_owner_built_key']
+        self.full_warc_prefix = config['full_warc_prefix']
         self.warc_upload_wait_templ = config['warc_upload_wait_templ']
 
         self.default_storage_profile = self.create_default_profile(config)
@@ -30,6 +36,27 @@ class StorageCommitter(object):
 
         self.temp_prefix = config['temp_prefix']
 
+        self.num_workers = int(config['commit_workers'])
+        self.max_inflight_bytes = int(config['commit_max_inflight_bytes'])
+
+        self.last_metrics = None
+
+        # queue of WARCs closed by the recorder, and closed WARCs to retry
+        self.closed_queue_key = config['closed_warc_queue_key']
+        self.retries = {}
+
+        # full directory sweep only needed as a fallback if closed WARCs are queued,
+        # otherwise run on every pass
+        if self.closed_queue_key:
+            self.sweep_secs = int(config['commit_sweep_secs'])
+        else:
+            self.sweep_secs = 0
+
+        self.last_sweep = 0
+
+        # WARCs found remotely, but not yet committed: filename -> (url, etag, size)
+        self.verified = {}
+
         print('Storage Committer Root: ' + self.record_root_dir)
 
     def create_default_profile(self, config):
@@ -43,6 +70,9 @@ class StorageCommitter(object):
 
             profile['remote_url_templ'] = s3_root
 
+            profile['part_size'] = config['upload_part_size']
+            profile['part_threads'] = config['upload_part_threads']
+
         return profile
 
     def is_locked(self, filename):
@@ -64,71 +94,297 @@ class StorageCommitter(object):
         if not os.path.isdir(self.record_root_dir):
             return
 
-        warc_map = None
-        curr_user = None
+        metrics = CommitMetrics()
+
+        user_dirs = []
+        user_warcs = []
 
         for user_dir in os.listdir(self.record_root_dir):
             full_dir = os.path.join(self.record_root_dir, user_dir)
             if os.path.isdir(full_dir):
-                self.check_user(user_dir, full_dir)
+                user_dirs.append(full_dir)
+                user_warcs.append(self.get_user_warcs(user_dir, full_dir, metrics))
+
+        self.run_commits(self.interleave(user_warcs), metrics)
+
+        # attempt to remove the dirs, if empty
+        for full_dir in user_dirs:
+            try:
+                os.rmdir(full_dir)
+                print('Removed dir ' + full_dir)
+            except:
+                pass
+
+        metrics.report()
+        self.last_metrics = metrics
+
+    def interleave(self, user_warcs):
+        """ round-robin across users, so no single user's backlog
+        delays commits for everyone else
+        """
+        user_warcs = [warcs for warcs in user_warcs if warcs]
 
-    def check_user(self, user, full_dir):
+        while user_warcs:
+            for warcs in user_warcs:
+                yield warcs.pop(0)
+
+            user_warcs = [warcs for warcs in user_warcs if warcs]
+
+    def run_commits(self, commits, metrics):
+        inflight = InflightLimiter(self.max_inflight_bytes)
+        uploaded = []
+
+        def upload(args, size):
+            try:
+                storage = self.get_storage(*args[:3])
+                if storage and self.upload_warc(storage, args, metrics):
+                    uploaded.append((storage, args))
+            except:
+                import traceback
+                traceback.print_exc()
+                metrics.add('failed')
+                self.retry_later(args)
+            finally:
+                inflight.release(size)
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for args in commits:
+                try:
+                    size = os.path.getsize(args[4])
+                except OSError:
+                    continue
+
+                inflight.acquire(size)
+                executor.submit(upload, args, size)
+
+        # verify all uploads from this cycle together
+        self.verify_uploads(uploaded, metrics)
+
+    def get_user_warcs(self, user, full_dir, metrics):
         #print('Checking user ' + user)
-        warc_map = self.get_warcs_for_user(user)
+        warcs = []
 
         for warcname in os.listdir(full_dir):
             if not warcname.endswith('.warc.gz'):
                 continue
 
+            metrics.add('scanned')
+
             full_filename = os.path.join(full_dir, warcname)
 
             if self.is_locked(full_filename):
                 continue
 
-            if self.is_temp(user):
-                continue
+            commit = self.get_commit_args(user, full_filename)
+            if commit:
+                warcs.append(commit)
 
-            coll = None
-            rec = None
+        return warcs
 
-            res = warc_map.get(warcname)
-            if res:
-                coll, rec = res
+    def get_commit_args(self, user, full_filename):
+        if self.is_temp(user):
+            return None
 
-            if not coll or not rec:
-                print('Orphan WARC:', warcname)
-                continue
+        warcname = os.path.basename(full_filename)
+
+        coll, rec = self.get_warc_owner(user, warcname)
+
+        if not coll or not rec:
+            print('Orphan WARC:', warcname)
+            return None
+
+        return (user, coll, rec, warcname, full_filename)
+
+    def process(self, timeout):
+        """ sweep all WARCs if due, then commit WARCs closed within timeout secs
+        """
+        if time.time() - self.last_sweep >= self.sweep_secs:
+            self()
+            self.last_sweep = time.time()
+
+        self.process_closed(timeout)
+
+    def process_closed(self, timeout):
+        """ wait up to timeout secs for WARCs closed by the recorder,
+        then commit them along with any retries that are due
+        """
+        if not self.closed_queue_key:
+            time.sleep(timeout)
+            return
+
+        filenames = set()
+
+        res = self.redis.blpop(self.closed_queue_key, timeout=int(timeout))
+        if res:
+            filenames.add(res[1].decode('utf-8'))
+
+            # drain any other closed WARCs already queued
+            while len(filenames) < self.num_workers * 4:
+                res = self.redis.lpop(self.closed_queue_key)
+                if not res:
+                    break
+
+                filenames.add(res.decode('utf-8'))
 
-            storage = self.get_storage(user, coll, rec)
-            if not storage:
+        now = time.time()
+        for filename, (retry_at, args) in list(self.retries.items()):
+            if retry_at <= now:
+                filenames.add(filename)
+                self.retries.pop(filename, None)
+
+        commits = []
+
+        for full_filename in filenames:
+            # files removed or renamed since closing are picked up by sweep
+            if not os.path.isfile(full_filename):
                 continue
 
-            warc_upload_wait = self.warc_upload_wait_templ.format(filename=full_filename)
+            user = os.path.basename(os.path.dirname(full_filename))
 
-            if self.redis.get(warc_upload_wait) != b'1':
-                if not storage.upload_file(user, coll, rec, warcname, full_filename):
-                    continue
+            commit = self.get_commit_args(user, full_filename)
+            if commit:
+                commits.append(commit)
+
+        if not commits:
+            return
+
+        metrics = CommitMetrics()
+        self.run_commits(commits, metrics)
+        metrics.report()
+
+    def retry_later(self, args):
+        full_filename = args[4]
+        self.retries[full_filename] = (time.time() + self.upload_wait_secs, args)
+
+    def commit_warc(self, user, coll, rec, warcname, full_filename, metrics=None):
+        metrics = metrics or CommitMetrics()
+
+        storage = self.get_storage(user, coll, rec)
+        if not storage:
+            return False
+
+        args = (user, coll, rec, warcname, full_filename)
+
+        if not self.upload_warc(storage, args, metrics):
+            return False
+
+        return self.verify_uploads([(storage, args)], metrics) == 1
+
+    def upload_warc(self, storage, args, metrics):
+        user, coll, rec, warcname, full_filename = args
 
-                self.redis.setex(warc_upload_wait, self.upload_wait_secs, 1)
+        warc_upload_wait = self.warc_upload_wait_templ.format(filename=full_filename)
 
-            # already uploaded, see if it is accessible
-            # if so, finalize and delete original
-            remote_url = storage.get_valid_remote_url(user, coll, rec, warcname)
-            if not remote_url:
-                print('Not yet available: {0}'.format(full_filename))
+        if self.redis.get(warc_upload_wait) == b'1':
+            return True
+
+        size = os.path.getsize(full_filename)
+
+        if not storage.upload_file(user, coll, rec, warcname, full_filename):
+            metrics.add('failed')
+            self.retry_later(args)
+            return False
+
+        metrics.add('uploaded')
+        metrics.add('bytes', size)
+
+        # uploaded again, any earlier verification no longer applies
+        self.verified.pop(full_filename, None)
+
+        self.redis.setex(warc_upload_wait, self.upload_wait_secs, 1)
+        return True
+
+    def verify_uploads(self, uploaded, metrics):
+        """ check that uploaded WARCs are accessible, and if so,
+        finalize and delete the originals. Storages that support it
+        check all WARCs from one storage profile in a single batch
+        """
+        groups = {}
+        count = 0
+
+        for storage, args in uploaded:
+            full_filename = args[4]
+
+            try:
+                size = os.path.getsize(full_filename)
+            except OSError:
                 continue
 
-            if not self.commit_uploaded(user, coll, rec, warcname, full_filename, remote_url):
+            remote_url = None
+
+            # verified on an earlier cycle, but commit not finished
+            res = self.verified.get(full_filename)
+            if res and res[2] == size:
+                remote_url = res[0]
+
+            # no batch support, check individually
+            elif not hasattr(storage, 'get_valid_remote_urls'):
+                remote_url = storage.get_valid_remote_url(*args[:4])
+
+            else:
+                group = (type(storage), str(storage.config.get('remote_url_templ')))
+                groups.setdefault(group, (storage, []))[1].append((args, size))
                 continue
 
-        # attempt to remove the dir, if empty
-        try:
-            os.rmdir(full_dir)
-            print('Removed dir ' + full_dir)
-        except:
-            pass
+            count += self._commit_verified(args, remote_url, metrics)
+
+        for storage, pending in groups.values():
+            found = storage.get_valid_remote_urls(
+                        [args[:4] + (size,) for args, size in pending])
+
+            for args, size in pending:
+                res = found.get((args[0], args[3]))
+                if res:
+                    self.verified[args[4]] = res
+
+                count += self._commit_verified(args, res[0] if res else None, metrics)
+
+        return count
+
+    def _commit_verified(self, args, remote_url, metrics):
+        full_filename = args[4]
+
+        if not remote_url:
+            print('Not yet available: {0}'.format(full_filename))
+            self.retry_later(args)
+            return False
+
+        if not self.commit_uploaded(*args, remote_url=remote_url):
+            return False
+
+        self.verified.pop(full_filename, None)
+        metrics.add('verified')
+        return True
+
+    def get_warc_owner(self, user, warcname):
+        owner_key = self.warc_owner_key_templ.format(user=user)
+
+        res = self.redis.hget(owner_key, warcname)
+
+        # WARCs written before the index existed are added once per user,
+        # from the per-recording warc keys
+        if res is None and not self.redis.hexists(self.warc_owner_built_key, user):
+            warc_map = self.get_local_warcs_for_user(user)
+
+            with redis.utils.pipeline(self.redis) as pi:
+                if warc_map:
+                    pi.hmset(owner_key, dict((warc, coll + ':' + rec)
+                                             for warc, (coll, rec) in warc_map.items()))
 
-    def get_warcs_for_user(self, user):
+                pi.hset(self.warc_owner_built_key, user, int(time.time()))
+
+            res = warc_map.get(warcname)
+            return res if res else (None, None)
+
+        if res is None:
+            return None, None
+
+        coll, rec = res.decode('utf-8').split(':', 1)
+        return coll, rec
+
+    def get_local_warcs_for_user(self, user):
+        """ WARCs of the user not yet committed to remote storage: warcname -> (coll, rec)
+        """
         key_templ = self.warc_key_templ.format(user=user, coll='*', rec='*')
         allwarcs = {}
 
@@ -137,16 +393,23 @@ class StorageCommitter(object):
             coll = parts[2]
             rec = parts[3]
 
-            warcmap = self.redis.hkeys(key)
-            for warc in warcmap:
-                allwarcs[warc.decode('utf-8')] = (coll, rec)
+            warcmap = self.redis.hgetall(key)
+            for warc, url in warcmap.items():
+                if url.decode('utf-8').startswith(self.full_warc_prefix):
+                    allwarcs[warc.decode('utf-8')] = (coll, rec)
 
         return allwarcs
 
     def commit_uploaded(self, user, coll, rec, warcname, full_filename, remote_url):
         # update path index to point to remote url!
         key = self.warc_key_templ.format(user=user, coll=coll, rec=rec)
-        self.redis.hset(key, warcname, remote_url)
+        owner_key = self.warc_owner_key_templ.format(user=user)
+
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hset(key, warcname, remote_url)
+
+            # no longer a local WARC, remove from ownership index
+            pi.hdel(owner_key, warcname)
 
         print('Commit Verified, Deleting: {0}'.format(full_filename))
         try:
@@ -186,6 +449,65 @@ class StorageCommitter(object):
         self.storage_class_map[type_] = cls
 
 
+# ============================================================================
+class InflightLimiter(object):
+    """ Block until enough bytes are free, always allowing at least
+    one file through so a file larger than the limit is not stuck
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        with self.cond:
+            while self.inflight > 0 and self.inflight + size > self.max_bytes:
+                self.cond.wait()
+
+            self.inflight += size
+
+    def release(self, size):
+        with self.cond:
+            self.inflight -= size
+            self.cond.notify_all()
+
+
+# ============================================================================
+class CommitMetrics(object):
+    FIELDS = ('scanned', 'uploaded', 'verified', 'failed', 'bytes')
+
+    def __init__(self):
+        self.start = time.time()
+        self.counts = dict((field, 0) for field in self.FIELDS)
+        self.lock = threading.Lock()
+
+    def add(self, field, value=1):
+        with self.lock:
+            self.counts[field] += value
+
+    def __getitem__(self, field):
+        return self.counts[field]
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def bytes_per_sec(self):
+        elapsed = self.elapsed()
+        return self.counts['bytes'] / elapsed if elapsed > 0 else 0
+
+    def report(self):
+        if not any(self.counts[field] for field in ('uploaded', 'verified', 'failed')):
+            return
+
+        msg = 'Commit Cycle: {scanned} scanned, {uploaded} uploaded, {verified} verified'
+        msg += ', {failed} failed'
+        msg += ', {bytes} bytes in {secs:.1f}s ({rate:.0f} bytes/sec)'
+
+        print(msg.format(secs=self.elapsed(),
+                         rate=self.bytes_per_sec(),
+                         **self.counts))
+
+
 # =============================================================================
 def run():
     sleep_secs = int(os.environ.get('TEMP_SLEEP_CHECK', 30))
@@ -198,12 +520,15 @@ def run():
     storage_committer = StorageCommitter(config)
     storage_committer.add_storage_class('s3', S3Storage)
 
+    last_close_idle = time.time()
+
     while True:
         try:
-            storage_committer()
-            time.sleep(sleep_secs)
+            storage_committer.process(sleep_secs)
 
-            storage_committer.redis.publish('close_idle', '')
+            if time.time() - last_close_idle >= sleep_secs:
+                storage_committer.redis.publish('close_idle', '')
+                last_close_idle = time.time()
         except:
             import traceback
             traceback.print_exc()
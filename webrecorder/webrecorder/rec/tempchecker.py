@@ -86,7 +86,8 @@ class TempChecker(object):
             self._delete_if_expired(temp)
             temps_removed.add(temp)
 
-        temp_match = 'u:{0}*'.format(self.temp_prefix)
+        # only the info key, not the user's other keys (u:<temp>:colls, ...)
+        temp_match = 'u:{0}*:info'.format(self.temp_prefix)
 
         #print('Temp Key Check')
 
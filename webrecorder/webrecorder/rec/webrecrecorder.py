@@ -11,8 +11,13 @@ import time
 import json
 import glob
 import tempfile
+import uuid
 
 from pywb.webagg.utils import res_template
+from pywb.cdx.cdxobject import CDXObject
+
+from webrecorder.utils import is_page, MAX_DETECT_PAGES
+from webrecorder.redisutils import KeyRegistry
 
 from bottle import Bottle, request, debug
 from datetime import datetime
@@ -22,6 +27,8 @@ from six import iteritems
 
 # ============================================================================
 class WebRecRecorder(object):
+    RENAME_CHUNK_SIZE = 500
+
     def __init__(self, config=None):
         self.upstream_url = os.environ['WEBAGG_HOST']
 
@@ -36,6 +43,11 @@ class WebRecRecorder(object):
 
         self.warc_key_templ = config['warc_key_templ']
 
+        self.warc_owner_key_templ = config['warc_owner_key_templ']
+        self.warc_owner_built_key = config['warc_owner_built_key']
+        self.warc_size_key_templ = config['warc_size_key_templ']
+        self.detected_pages_key_templ = config['detected_pages_key_templ']
+
         self.warc_name_templ = config['warc_name_templ']
 
         self.full_warc_prefix = config['full_warc_prefix']
@@ -46,14 +58,33 @@ class WebRecRecorder(object):
 
         self.del_templ = config['del_templ']
 
+        self.rename_progress_key_templ = config['rename_progress_key_templ']
+
         self.skip_key_templ = config['skip_key_templ']
 
         self.user_usage_key = config['user_usage_key']
         self.temp_usage_key = config['temp_usage_key']
 
+        self.pending_flush_size = int(config['pending_flush_size'])
+        self.pending_flush_secs = float(config['pending_flush_secs'])
+
+        self.write_check_cache_secs = float(config['write_check_cache_secs'])
+
+        self.closed_warc_queue_key = config['closed_warc_queue_key']
+
+        self.delete_queue_key = config['delete_queue_key']
+        self.delete_jobs_key = config['delete_jobs_key']
+        self.delete_batch_size = int(config['delete_batch_size'])
+        self.delete_batch_secs = float(config['delete_batch_secs'])
+        self.delete_lease_secs = int(config['delete_lease_secs'])
+        self.delete_retry_secs = int(config['delete_retry_secs'])
+        self.delete_poll_secs = float(config['delete_poll_secs'])
+
         self.redis_base_url = os.environ['REDIS_BASE_URL']
         self.redis = redis.StrictRedis.from_url(self.redis_base_url)
 
+        self.key_registry = KeyRegistry(self.redis, config)
+
     def init_app(self, storage_committer):
         self.storage_committer = storage_committer
 
@@ -87,6 +118,10 @@ class WebRecRecorder(object):
             temp_prefix=self.temp_prefix,
             user_usage=self.user_usage_key,
             temp_usage=self.temp_usage_key,
+
+            warc_owner_key_templ=self.warc_owner_key_templ,
+            warc_size_key_templ=self.warc_size_key_templ,
+            detected_pages_key_templ=self.detected_pages_key_templ,
         )
 
     @staticmethod
@@ -104,7 +139,11 @@ class WebRecRecorder(object):
                                      redis=self.redis,
                                      skip_key_templ=self.skip_key_templ,
                                      key_template=self.info_keys['rec'],
-                                     header_filter=header_filter)
+                                     coll_key_template=self.info_keys['coll'],
+                                     header_filter=header_filter,
+                                     cache_secs=self.write_check_cache_secs,
+                                     closed_queue_key=self.closed_warc_queue_key,
+                                     temp_prefix=self.temp_prefix)
 
         self.writer = writer
         recorder_app = RecorderApp(self.upstream_url,
@@ -116,7 +155,9 @@ class WebRecRecorder(object):
 
     def create_buffer(self, params, name):
         info_key = res_template(self.info_keys['rec'], params)
-        return TempWriteBuffer(self.redis, info_key, name, params['url'])
+        return TempWriteBuffer(self.redis, info_key, name, params['url'],
+                               flush_size=self.pending_flush_size,
+                               flush_secs=self.pending_flush_secs)
 
     def get_profile(self, scheme, profile):
         res = self.redis.hgetall('st:' + profile)
@@ -131,8 +172,7 @@ class WebRecRecorder(object):
         allwarcs = {}
 
         if rec == '*':
-            for key in self.redis.scan_iter(warc_key):
-                key = key.decode('utf-8')
+            for key in self._get_warc_keys(user, coll):
                 allwarcs[key] = self.redis.hgetall(key)
         else:
             allwarcs[warc_key] = self.redis.hgetall(warc_key)
@@ -142,6 +182,17 @@ class WebRecRecorder(object):
                 n = n.decode('utf-8')
                 yield key, n, v.decode('utf-8')
 
+    def _get_warc_keys(self, user, coll):
+        if not self.key_registry.is_ready():
+            warc_key = self.warc_key_templ.format(user=user, coll=coll, rec='*')
+            return [key.decode('utf-8') for key in self.redis.scan_iter(warc_key)]
+
+        colls = self.key_registry.get_colls(user) if coll == '*' else [coll]
+
+        return [self.warc_key_templ.format(user=user, coll=coll, rec=rec)
+                for coll in colls
+                for rec in self.key_registry.get_recs(user, coll)]
+
     # Messaging ===============
     def msg_listen_loop(self):
         self.pubsub = self.redis.pubsub()
@@ -149,6 +200,7 @@ class WebRecRecorder(object):
         self.pubsub.subscribe('delete')
         self.pubsub.subscribe('rename')
         self.pubsub.subscribe('close_idle')
+        self.pubsub.subscribe('skip')
 
         print('Waiting for messages')
 
@@ -158,11 +210,16 @@ class WebRecRecorder(object):
                     continue
 
                 if item['channel'] == b'delete':
+                    self.writer.clear_cached_checks()
                     self.handle_delete_local(item['data'].decode('utf-8'))
 
                 elif item['channel'] == b'rename':
+                    self.writer.clear_cached_checks()
                     self.handle_rename_local(item['data'].decode('utf-8'))
 
+                elif item['channel'] == b'skip':
+                    self.writer.skip_cache.remove(item['data'].decode('utf-8'))
+
                 elif item['channel'] == b'close_idle':
                     self.recorder.writer.close_idle_files()
 
@@ -193,68 +250,56 @@ class WebRecRecorder(object):
         if (from_rec == '*' or to_rec == '*') and (from_rec != to_rec):
             return {'error_message': 'must specify rec name or "*" if moving entire coll'}
 
-        # Move the redis keys, this performs the move as far as user is concerned
-        match_pattern = ':' + from_user + ':' + from_coll + ':'
-        replace_pattern = ':' + to_user + ':' + to_coll + ':'
+        target = to_user + ':' + to_coll + ':' + to_rec
 
-        if to_rec != '*':
-            match_pattern += from_rec + ':'
-            replace_pattern += to_rec + ':'
+        # Progress of an interrupted rename is resumed, rather than planned again
+        progress_key = self.rename_progress_key_templ.format(user=from_user,
+                                                             coll=from_coll,
+                                                             rec=from_rec)
 
-        moves = {}
+        progress = self.redis.hgetall(progress_key)
 
-        for key in self.redis.scan_iter(match='*' + match_pattern + '*'):
-            key = key.decode('utf-8')
-            moves[key] = key.replace(match_pattern, replace_pattern)
-
-        # Get Info Keys
-        to_user_key = self.info_keys['user'].format(user=to_user)
-        from_user_key = self.info_keys['user'].format(user=from_user)
-
-        if to_rec != '*':
-            to_coll_key = self.info_keys['coll'].format(user=to_user, coll=to_coll)
-            from_coll_key = self.info_keys['coll'].format(user=from_user, coll=from_coll)
+        if progress:
+            if progress[b'target'].decode('utf-8') != target:
+                return {'error_message': 'rename to another target already in progress'}
 
-            info_key = self.info_keys['rec'].format(user=from_user, coll=from_coll, rec=from_rec)
+            print('Resuming Rename: ' + progress_key)
 
-            to_id = to_rec
         else:
-            info_key = self.info_keys['coll'].format(user=from_user, coll=from_coll)
+            steps = self._plan_rename(from_user, from_coll, from_rec,
+                                      to_user, to_coll, to_rec)
 
-            to_id = to_coll
+            progress = {b'target': target,
+                        b'steps': json.dumps(steps),
+                        b'done': 0}
 
-        the_size = int(self.redis.hget(info_key, 'size'))
+            self.redis.hmset(progress_key, progress)
 
-        with redis.utils.pipeline(self.redis) as pi:
-            # Fix Id
-            pi.hset(info_key, 'id', to_id)
+        # Move the redis keys in bounded, atomic chunks
+        if not progress.get(b'finished'):
+            steps = json.loads(progress[b'steps'])
 
-            # Change title, if provided
-            if to_title:
-                pi.hset(info_key, 'title', to_title)
+            for start in range(int(progress[b'done']), len(steps), self.RENAME_CHUNK_SIZE):
+                self._move_chunk(progress_key, steps, start)
 
-            # actual rename
-            for from_key, to_key in iteritems(moves):
-                pi.rename(from_key, to_key)
-
-        with redis.utils.pipeline(self.redis) as pi:
-            # change user size, if different users
-            if to_user_key != from_user_key:
-                pi.hincrby(from_user_key, 'size', -the_size)
-                pi.hincrby(to_user_key, 'size', the_size)
-
-            # change coll size if moving rec and different colls
-            if to_rec != '*' and to_coll_key != from_coll_key:
-                pi.hincrby(from_coll_key, 'size', -the_size)
-                pi.hincrby(to_coll_key, 'size', the_size)
+            # Move the info key and sizes last, this performs the move as far as user is concerned
+            self._finish_rename(progress_key,
+                                from_user, from_coll, from_rec,
+                                to_user, to_coll, to_rec, to_title)
 
         # rename WARCs (only if switching users)
         replace_list = []
 
+        from_owner_key = self.warc_owner_key_templ.format(user=from_user)
+        to_owner_key = self.warc_owner_key_templ.format(user=to_user)
+        owners = {}
+
         for key, name, url in self._iter_all_warcs(to_user, to_coll, to_rec):
             if not url.startswith(self.full_warc_prefix):
                 continue
 
+            owners[name] = self._get_warc_owner(key)
+
             filename = url[len(self.full_warc_prefix):]
 
             new_filename = filename.replace(from_user + '/', to_user + '/')
@@ -266,17 +311,239 @@ class WebRecRecorder(object):
 
             replace_list.append(repl)
 
+        # update WARC ownership index to point to new location
+        if owners:
+            with redis.utils.pipeline(self.redis) as pi:
+                if from_owner_key != to_owner_key:
+                    pi.hdel(from_owner_key, *owners.keys())
+
+                pi.hmset(to_owner_key, owners)
+
         if replace_list:
             if not self.queue_message('rename', {'replace_list': replace_list}):
                 return {'error_message': 'no local clients'}
 
+        self.redis.delete(progress_key)
+
         #if self.storage_committer:
         #    storage = self.storage_committer.get_storage(to_user, to_coll, to_rec)
         #    if storage and not storage.rename(from_user, from_coll, from_rec,
         #                                      to_user, to_coll, to_rec):
         #        return {'error_message': 'remote rename failed'}
 
-        return {'success': to_user + ':' + to_coll + ':' + to_rec}
+        return {'success': target}
+
+    def _get_rename_info_keys(self, user, coll, rec):
+        if rec != '*':
+            return self.info_keys['rec'].format(user=user, coll=coll, rec=rec)
+        else:
+            return self.info_keys['coll'].format(user=user, coll=coll)
+
+    def _plan_rename(self, from_user, from_coll, from_rec, to_user, to_coll, to_rec):
+        """ List of [op, from_key, to_key] steps to move all keys, except the
+        info key, which is moved last along with the sizes
+        """
+        if self.key_registry.is_ready():
+            moves, merges = self._get_registry_moves(from_user, from_coll, from_rec,
+                                                     to_user, to_coll, to_rec)
+        else:
+            moves = self._scan_moves(from_user, from_coll, from_rec,
+                                     to_user, to_coll, to_rec)
+            merges = []
+
+        moves.pop(self._get_rename_info_keys(from_user, from_coll, from_rec), None)
+
+        steps = [['rename', from_key, to_key] for from_key, to_key in sorted(iteritems(moves))]
+
+        for from_key, to_key, is_zset in merges:
+            steps.append(['zmerge' if is_zset else 'smerge', from_key, to_key])
+
+        return steps
+
+    def _move_chunk(self, progress_key, steps, start):
+        """ Apply one chunk of rename steps in a single MULTI, along with
+        the progress marker, so a chunk is either entirely done or not at all
+        """
+        chunk = steps[start:start + self.RENAME_CHUNK_SIZE]
+
+        tag_index = self.key_registry.tag_index
+
+        # read registries and sorted sets to merge, and pages of tag sets to reindex
+        with redis.utils.pipeline(self.redis) as pi:
+            for op, from_key, to_key in chunk:
+                if op == 'zmerge':
+                    pi.zrange(from_key, 0, -1, withscores=True)
+                elif op == 'smerge' or tag_index.parse_tag_key(from_key):
+                    pi.smembers(from_key)
+
+            values = iter(pi.execute())
+
+        pi = self.redis.pipeline(transaction=True)
+
+        for op, from_key, to_key in chunk:
+            if op == 'rename':
+                if tag_index.parse_tag_key(from_key):
+                    tag_index.move_key(pi, from_key, to_key, next(values))
+
+                pi.rename(from_key, to_key)
+                continue
+
+            members = next(values)
+            if not members:
+                continue
+
+            if op == 'zmerge':
+                args = []
+                for member, score in members:
+                    args.extend((score, member))
+
+                pi.zadd(to_key, *args)
+            else:
+                pi.sadd(to_key, *members)
+
+            pi.delete(from_key)
+
+        pi.hset(progress_key, 'done', start + len(chunk))
+
+        # a key that has since expired should not stop the rename
+        for res in pi.execute(raise_on_error=False):
+            if isinstance(res, Exception):
+                print('Rename Error: ' + str(res))
+
+    def _finish_rename(self, progress_key,
+                       from_user, from_coll, from_rec,
+                       to_user, to_coll, to_rec, to_title):
+        """ Move the info key and adjust sizes in one transaction, watching
+        the info key so the size moved is the size at the time of the move
+        """
+        info_key = self._get_rename_info_keys(from_user, from_coll, from_rec)
+        to_info_key = self._get_rename_info_keys(to_user, to_coll, to_rec)
+
+        to_user_key = self.info_keys['user'].format(user=to_user)
+        from_user_key = self.info_keys['user'].format(user=from_user)
+
+        to_coll_key = self.info_keys['coll'].format(user=to_user, coll=to_coll)
+        from_coll_key = self.info_keys['coll'].format(user=from_user, coll=from_coll)
+
+        if to_rec != '*':
+            to_id = to_rec
+            parent = (self.key_registry.coll_recs_key,
+                      from_user, from_coll, from_rec,
+                      to_user, to_coll, to_rec)
+        else:
+            to_id = to_coll
+            parent = (self.key_registry.user_colls_key,
+                      from_user, '', from_coll,
+                      to_user, '', to_coll)
+
+        def move_info(pi):
+            the_size = int(pi.hget(info_key, 'size') or 0)
+
+            pi.multi()
+
+            # Fix Id
+            pi.hset(info_key, 'id', to_id)
+
+            # Change title, if provided
+            if to_title:
+                pi.hset(info_key, 'title', to_title)
+
+            if info_key != to_info_key:
+                pi.rename(info_key, to_info_key)
+
+            # change user size, if different users
+            if to_user_key != from_user_key:
+                pi.hincrby(from_user_key, 'size', -the_size)
+                pi.hincrby(to_user_key, 'size', the_size)
+
+            # change coll size if moving rec and different colls
+            if to_rec != '*' and to_coll_key != from_coll_key:
+                pi.hincrby(from_coll_key, 'size', -the_size)
+                pi.hincrby(to_coll_key, 'size', the_size)
+
+            # update collection recordings or user collections
+            self._move_child(pi, *parent)
+
+            if to_rec == '*':
+                self.key_registry.move_coll(pi, from_user, from_coll, to_user, to_coll)
+
+            pi.hset(progress_key, 'finished', 1)
+
+        self.redis.transaction(move_info, info_key)
+
+    def _scan_moves(self, from_user, from_coll, from_rec, to_user, to_coll, to_rec):
+        """ Find keys to move by scanning the keyspace, until key registries are built
+        """
+        match_pattern = ':' + from_user + ':' + from_coll + ':'
+        replace_pattern = ':' + to_user + ':' + to_coll + ':'
+
+        if to_rec != '*':
+            match_pattern += from_rec + ':'
+            replace_pattern += to_rec + ':'
+
+        moves = {}
+
+        for key in self.redis.scan_iter(match='*' + match_pattern + '*'):
+            key = key.decode('utf-8')
+            moves[key] = key.replace(match_pattern, replace_pattern)
+
+        return moves
+
+    def _get_registry_moves(self, from_user, from_coll, from_rec, to_user, to_coll, to_rec):
+        """ Find keys to move from the key registries of the recording or collection.
+        Registries and sorted sets are merged into the target, others renamed
+        """
+        if from_rec != '*':
+            owned = self.key_registry.iter_owned('rec', from_user, from_coll, from_rec)
+        else:
+            owned = self.key_registry.iter_owned('coll', from_user, from_coll)
+
+        moves = {}
+        merges = []
+
+        for templ, coll, rec in owned:
+            from_key = self.key_registry.format_key(templ, from_user, coll, rec)
+            to_key = self.key_registry.format_key(templ, to_user, to_coll,
+                                                  to_rec if from_rec != '*' else rec)
+
+            if from_key == to_key:
+                continue
+
+            if self.key_registry.is_merged(templ):
+                merges.append((from_key, to_key, templ == self.key_registry.coll_recs_key))
+            else:
+                moves[from_key] = to_key
+
+        # keys with fixed templates may not exist
+        from_keys = list(moves.keys())
+
+        with redis.utils.pipeline(self.redis) as pi:
+            for key in from_keys:
+                pi.exists(key)
+
+            exists = pi.execute()
+
+        moves = dict((key, moves[key]) for key, exist in zip(from_keys, exists) if exist)
+
+        return moves, merges
+
+    def _move_child(self, pi, templ, from_user, from_coll, from_id,
+                    to_user, to_coll, to_id):
+
+        from_key = self.key_registry.format_key(templ, from_user, from_coll)
+        to_key = self.key_registry.format_key(templ, to_user, to_coll)
+
+        if from_key == to_key and from_id == to_id:
+            return
+
+        score = self.redis.zscore(from_key, from_id) or int(time.time())
+
+        pi.zrem(from_key, from_id)
+        pi.zadd(to_key, score, to_id)
+
+    def _get_warc_owner(self, warc_key):
+        parts = warc_key.split(':')
+        return parts[2] + ':' + parts[3]
 
     def handle_rename_local(self, data):
         data = json.loads(data)
@@ -307,86 +574,306 @@ class WebRecRecorder(object):
         rec = request.query.getunicode('rec', '*')
         type = request.query.getunicode('type')
 
-        local_delete_list = []
-        remote_delete_list = []
+        if type not in self.del_templ:
+            print('Unknown delete type ' + str(type))
+            return {'error_message': 'unknown delete type'}
 
-        for key, n, url in self._iter_all_warcs(user, coll, rec):
-            if url.startswith(self.full_warc_prefix):
-                filename = url[len(self.full_warc_prefix):]
-                local_delete_list.append(filename)
+        try:
+            self.queue_delete(type, user, coll, rec)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return {'error_message': str(e)}
+
+        return {}
+
+    def queue_delete(self, type, user, coll, rec):
+        """ Tombstone the recording, collection or user, remove it from its
+        owner and adjust sizes immediately, in one transaction with queuing
+        the delete job. The keys and WARCs are then deleted by the delete worker.
+
+        The tombstone removes the id from the info key, so the item is no
+        longer found, and records the job id, so a delete already queued
+        is not queued again. The info key is deleted last by the worker,
+        so the name is not reused until the delete is done.
+        """
+        job_id = uuid.uuid4().hex
+
+        job = {'type': type,
+               'user': user,
+               'coll': coll,
+               'rec': rec,
+               'stage': 'collect',
+               'created_at': int(time.time())}
+
+        del_info = self._get_delete_info_key(type, user, coll, rec)
+
+        user_colls = self.key_registry.get_colls(user) if type == 'user' else []
+
+        def start_delete(pi):
+            if pi.hexists(del_info, 'deleted'):
+                return
+
+            length = int(pi.hget(del_info, 'size') or 0) if type != 'user' else 0
+
+            pi.multi()
+
+            pi.hdel(del_info, 'id')
+            pi.hset(del_info, 'deleted', job_id)
+
+            if length > 0:
+                user_key = self.info_keys['user'].format(user=user)
+                pi.hincrby(user_key, 'size', -length)
+
+                if type == 'rec':
+                    coll_key = self.info_keys['coll'].format(user=user, coll=coll)
+                    pi.hincrby(coll_key, 'size', -length)
+
+            # remove from collection recordings or user collections
+            if type == 'rec':
+                pi.zrem(self.key_registry.format_key(self.key_registry.coll_recs_key, user, coll), rec)
+            elif type == 'coll':
+                pi.zrem(self.key_registry.format_key(self.key_registry.user_colls_key, user), coll)
+                self.key_registry.remove_colls(pi, user, coll)
             else:
-                remote_delete_list.append(url)
+                # collections of the user are no longer found
+                for user_coll in user_colls:
+                    pi.hdel(self.info_keys['coll'].format(user=user, coll=user_coll), 'id')
+
+                self.key_registry.remove_colls(pi, user, *user_colls)
+
+            pi.hset(self.delete_jobs_key, job_id, json.dumps(job))
+            pi.zadd(self.delete_queue_key, time.time(), job_id)
+
+        self.redis.transaction(start_delete, del_info)
+
+        # no new WARCs for the deleted item, clear cached recording checks
+        self.queue_message('delete', {})
+
+    def _get_delete_info_key(self, type, user, coll, rec):
+        return self.info_keys[type].format(user=user, coll=coll, rec=rec)
+
+    def delete_loop(self):
+        """ Run queued delete jobs. A job is leased while running, so a job
+        left by a stopped worker, or a failed job, is retried once the lease expires
+        """
+        print('Waiting for deletes')
+
+        while True:
+            try:
+                job_id = self._claim_delete()
+                if not job_id:
+                    time.sleep(self.delete_poll_secs)
+                    continue
+
+                self.run_delete(job_id)
+
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                time.sleep(self.delete_poll_secs)
+
+    def _claim_delete(self):
+        claimed = []
+
+        def claim(pi):
+            now = time.time()
+            res = pi.zrangebyscore(self.delete_queue_key, 0, now, start=0, num=1)
+            if not res:
+                return
 
-        message = {}
+            pi.multi()
+            pi.zadd(self.delete_queue_key, now + self.delete_lease_secs, res[0])
+            claimed.append(res[0].decode('utf-8'))
 
-        if local_delete_list:
-            message = dict(delete_list=local_delete_list)
+        self.redis.transaction(claim, self.delete_queue_key)
 
-        if type == 'user':
-            message['delete_user'] = user
+        return claimed[0] if claimed else None
 
-        if not self.queue_message('delete', message):
-            return {'error_message': 'no local clients'}
+    def _save_delete_progress(self, job_id, job):
+        job['updated_at'] = int(time.time())
+
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hset(self.delete_jobs_key, job_id, json.dumps(job))
+            pi.zadd(self.delete_queue_key, time.time() + self.delete_lease_secs, job_id)
+
+    def run_delete(self, job_id):
+        job = self.redis.hget(self.delete_jobs_key, job_id)
+        if not job:
+            self.redis.zrem(self.delete_queue_key, job_id)
+            return
+
+        job = json.loads(job.decode('utf-8'))
+
+        print('Delete {0}: {1}'.format(job['stage'], job_id))
 
         try:
-            self._delete_redis_keys(type, user, coll, rec)
+            self._run_delete_stages(job_id, job)
+
         except Exception as e:
             import traceback
             traceback.print_exc()
-            return {'error_message': str(e)}
 
-        if not self.storage_committer:
-            return {}
+            job['error'] = str(e)
+            job['updated_at'] = int(time.time())
 
-        storage = self.storage_committer.get_storage(user, coll, rec)
-        if not storage:
-            return {}
+            with redis.utils.pipeline(self.redis) as pi:
+                pi.hset(self.delete_jobs_key, job_id, json.dumps(job))
+                pi.zadd(self.delete_queue_key, time.time() + self.delete_retry_secs, job_id)
 
-        res = None
+            return
 
-        if type == 'user':
-            res = storage.delete_user(user)
-        elif remote_delete_list:
-            res = storage.delete(remote_delete_list)
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.zrem(self.delete_queue_key, job_id)
+            pi.hdel(self.delete_jobs_key, job_id)
+
+        print('Delete done: {0}, {1} keys, {2} remote files'.format(job_id,
+                                                                     job.get('keys_deleted', 0),
+                                                                     job.get('remote_deleted', 0)))
+
+    def _run_delete_stages(self, job_id, job):
+        """ Each stage can be safely run again if interrupted.
+        Remote files are deleted before the keys, which locate them
+        """
+        type = job['type']
+        user = job['user']
+        coll = job['coll']
+        rec = job['rec']
+
+        # only delete the item tombstoned for this job. If the info key is
+        # gone, the delete is done. If no longer tombstoned for this job, the
+        # name was reused, eg. a user registered again, and nothing is deleted
+        info_key = self._get_delete_info_key(type, user, coll, rec)
+        deleted = self.redis.hget(info_key, 'deleted')
+        if not deleted or deleted.decode('utf-8') != job_id:
+            print('Delete skipped, no longer tombstoned: {0}'.format(job_id))
+            return
+
+        if job['stage'] == 'collect':
+            local_delete_list = []
+            remote_delete_list = []
+            warc_names = []
+
+            for key, n, url in self._iter_all_warcs(user, coll, rec):
+                warc_names.append(n)
+
+                if url.startswith(self.full_warc_prefix):
+                    filename = url[len(self.full_warc_prefix):]
+                    local_delete_list.append(filename)
+                else:
+                    remote_delete_list.append(url)
+
+            job['local_delete_list'] = local_delete_list
+            job['remote_delete_list'] = remote_delete_list
+            job['warc_names'] = warc_names
+            job['stage'] = 'local'
+            self._save_delete_progress(job_id, job)
+
+        if job['stage'] == 'local':
+            message = {}
+
+            if job['local_delete_list']:
+                message = dict(delete_list=job['local_delete_list'])
+
+            if type == 'user':
+                message['delete_user'] = user
+
+            if not self.queue_message('delete', message):
+                raise Exception('no local clients')
+
+            job['stage'] = 'remote'
+            self._save_delete_progress(job_id, job)
+
+        if job['stage'] == 'remote':
+            storage = None
+            if self.storage_committer:
+                storage = self.storage_committer.get_storage(user, coll, rec)
+
+            deletes = None
+            if not storage:
+                pass
+            elif type == 'user':
+                deletes = storage.iter_delete_user(user)
+            elif job['remote_delete_list']:
+                deletes = storage.iter_delete(job['remote_delete_list'])
+
+            for count in deletes or []:
+                job['remote_deleted'] = job.get('remote_deleted', 0) + count
+                self._save_delete_progress(job_id, job)
+                time.sleep(self.delete_batch_secs)
+
+            job['stage'] = 'keys'
+            self._save_delete_progress(job_id, job)
+
+        if job['stage'] == 'keys':
+            for count in self._iter_delete_redis_keys(type, user, coll, rec, info_key):
+                job['keys_deleted'] = job.get('keys_deleted', 0) + count
+                self._save_delete_progress(job_id, job)
+                time.sleep(self.delete_batch_secs)
+
+            # user delete removes the entire ownership index key
+            if type == 'user':
+                self.redis.hdel(self.warc_owner_built_key, user)
+
+            elif job['warc_names']:
+                owner_key = self.warc_owner_key_templ.format(user=user)
+                self.redis.hdel(owner_key, *job['warc_names'])
+
+            # the name may be reused from here
+            self.redis.delete(info_key)
+            job['keys_deleted'] = job.get('keys_deleted', 0) + 1
+
+    def _iter_delete_redis_keys(self, type, user, coll, rec, info_key):
+        """ Delete keys in batches of delete_batch_size, yielding the number deleted.
+        The tombstoned info key is skipped, to be deleted last
+        """
+        if self.key_registry.is_ready():
+            keys_to_del = self.key_registry.get_owned_keys(type,
+                                                           user,
+                                                           coll if type != 'user' else '',
+                                                           rec if type == 'rec' else '')
         else:
-            return {}
+            key_pattern = self.del_templ[type].format(user=user, coll=coll, rec=rec)
+            keys_to_del = self.redis.scan_iter(match=key_pattern)
 
-        if not res:
-            return {'error_message': 'remote delete failed'}
+        batch = []
 
-        return {}
+        for key in keys_to_del:
+            if key in (info_key, info_key.encode('utf-8')):
+                continue
 
-    def _delete_redis_keys(self, type, user, coll, rec):
-        key_templ = self.del_templ.get(type)
-        if not key_templ:
-            print('Unknown delete type ' + str(type))
-            return
+            batch.append(key)
 
-        key_pattern = key_templ.format(user=user, coll=coll, rec=rec)
-        keys_to_del = list(self.redis.scan_iter(match=key_pattern))
+            if len(batch) == self.delete_batch_size:
+                self._delete_keys(batch)
+                yield len(batch)
+                batch = []
 
-        if type != 'user':
-            del_info = self.info_keys[type].format(user=user, coll=coll, rec=rec)
+        if batch:
+            self._delete_keys(batch)
+            yield len(batch)
 
-            try:
-                length = int(self.redis.hget(del_info, 'size'))
-            except:
-                print('Error decreasing size')
-                return
-        else:
-            length = 0
+    def _delete_keys(self, keys):
+        """ Delete a batch of keys, removing the pages of any tag sets from the tag index
+        """
+        tag_index = self.key_registry.tag_index
+
+        keys = [key.decode('utf-8') if isinstance(key, bytes) else key for key in keys]
+        tag_keys = [key for key in keys if tag_index.parse_tag_key(key)]
 
         with redis.utils.pipeline(self.redis) as pi:
-            if length > 0:
-                user_key = self.info_keys['user'].format(user=user)
-                pi.hincrby(user_key, 'size', -length)
+            for key in tag_keys:
+                pi.smembers(key)
 
-                if type == 'rec':
-                    coll_key = self.info_keys['coll'].format(user=user, coll=coll)
-                    pi.hincrby(coll_key, 'size', -length)
+            all_pg_ids = pi.execute()
+
+        pi = self.redis.pipeline(transaction=True)
 
-            for key in keys_to_del:
-                pi.delete(key)
+        for key, pg_ids in zip(tag_keys, all_pg_ids):
+            tag_index.remove_key(pi, key, pg_ids)
+
+        pi.delete(*keys)
+        pi.execute()
 
     def handle_delete_local(self, data):
         data = json.loads(data)
@@ -420,6 +907,10 @@ class WebRecRecorder(object):
 
 # ============================================================================
 class WebRecRedisIndexer(WritableRedisIndexer):
+    # members per ZADD command, and lines per pipeline, for bulk CDXJ loading
+    CDXJ_ZADD_SIZE = 1000
+    CDXJ_BATCH_SIZE = 50000
+
     def __init__(self, *args, **kwargs):
         super(WebRecRedisIndexer, self).__init__(*args, **kwargs)
 
@@ -430,18 +921,111 @@ class WebRecRedisIndexer(WritableRedisIndexer):
         self.temp_usage_key = kwargs.get('temp_usage', None)
         self.temp_prefix = kwargs.get('temp_prefix', 'temp-')
 
+        self.warc_owner_key_templ = kwargs.get('warc_owner_key_templ')
+        self.warc_size_key_templ = kwargs.get('warc_size_key_templ')
+        self.detected_pages_key_templ = kwargs.get('detected_pages_key_templ')
+        self.cdxj_key_templ = kwargs.get('cdx_key_template')
+
+    def get_rel_filename(self, full_filename, params):
+        rel_path = res_template(self.rel_path_template, params)
+        rel_filename = os.path.relpath(full_filename, rel_path)
+
+        # files outside the rel path (eg. in-place player archives) by name only
+        if rel_filename.startswith('..'):
+            rel_filename = os.path.basename(full_filename)
+
+        return rel_filename
+
+    def add_warc_file(self, full_filename, params):
+        super(WebRecRedisIndexer, self).add_warc_file(full_filename, params)
+
+        if not self.warc_owner_key_templ:
+            return
+
+        # reverse index of warc filename -> coll:rec, per user
+        rel_filename = self.get_rel_filename(full_filename, params)
+
+        owner_key = res_template(self.warc_owner_key_templ, params)
+        owner = res_template('{coll}:{rec}', params)
+
+        self.redis.hset(owner_key, rel_filename, owner)
+
     def add_urls_to_index(self, stream, params, filename, length):
         cdx_list = (super(WebRecRedisIndexer, self).
                       add_urls_to_index(stream, params, filename, length))
 
+        self._add_size(params, filename, length, bool(cdx_list))
+        self._detect_pages(params, cdx_list)
+
+        return cdx_list
+
+    def add_cdxj(self, cdx_list, params, filename, length):
+        """ Add CDXJ lines already generated for length bytes of filename,
+        eg. by an indexing worker process
+
+        Lines are added in sorted order, as multi-member ZADDs
+        sent in pipelined batches
+        """
+        key = res_template(self.cdxj_key_templ, params)
+
+        cdx_list = sorted(cdx for cdx in cdx_list if cdx)
+
+        for batch_start in range(0, len(cdx_list), self.CDXJ_BATCH_SIZE):
+            batch_end = min(batch_start + self.CDXJ_BATCH_SIZE, len(cdx_list))
+
+            with redis.utils.pipeline(self.redis) as pi:
+                for start in range(batch_start, batch_end, self.CDXJ_ZADD_SIZE):
+                    args = []
+                    for cdx in cdx_list[start:min(start + self.CDXJ_ZADD_SIZE, batch_end)]:
+                        args.extend((0, cdx))
+
+                    pi.zadd(key, *args)
+
+        self._add_size(params, filename, length, bool(cdx_list))
+        self._detect_pages(params, cdx_list)
+
+    def _detect_pages(self, params, cdx_list):
+        """ If requested, eg. for uploads, check lines as they are indexed for
+        likely pages, adding up to MAX_DETECT_PAGES to the detected pages list
+        """
+        if not self.detected_pages_key_templ or not params.get('param.detect_pages'):
+            return
+
+        key = res_template(self.detected_pages_key_templ, params)
+
+        remaining = MAX_DETECT_PAGES - self.redis.llen(key)
+
+        pages = []
+
+        for cdx in cdx_list or []:
+            if len(pages) >= remaining:
+                break
+
+            if not cdx:
+                continue
+
+            cdxj = CDXObject(cdx)
+            if is_page(cdxj):
+                pages.append(json.dumps(dict(url=cdxj['url'],
+                                             timestamp=cdxj['timestamp'])))
+
+        if pages:
+            self.redis.rpush(key, *pages)
+
+    def _add_size(self, params, filename, length, updated):
         with redis.utils.pipeline(self.redis) as pi:
             for key_templ in self.size_keys:
                 key = res_template(key_templ, params)
                 pi.hincrby(key, 'size', length)
 
-                if key_templ == self.rec_info_key_templ and cdx_list:
+                if key_templ == self.rec_info_key_templ and updated:
                     pi.hset(key, 'updated_at', str(int(time.time())))
 
+            # track bytes written to each WARC, for seeking in downloads
+            if self.warc_size_key_templ:
+                key = res_template(self.warc_size_key_templ, params)
+                pi.hincrby(key, self.get_rel_filename(filename, params), length)
+
             # write size to usage hashes
             ts = datetime.now().date().isoformat()
 
@@ -454,8 +1038,6 @@ class WebRecRedisIndexer(WritableRedisIndexer):
                 if key:
                     pi.hincrby(key, ts, length)
 
-        return cdx_list
-
 
 # ============================================================================
 class SkipCheckingMultiFileWARCWriter(MultiFileWARCWriter):
@@ -464,15 +1046,55 @@ class SkipCheckingMultiFileWARCWriter(MultiFileWARCWriter):
         self.redis = kwargs.get('redis')
         self.skip_key_template = kwargs.get('skip_key_templ')
         self.info_key = kwargs.get('key_template')
+        self.coll_info_key = kwargs.get('coll_key_template')
+
+        # local caches of skip key and recording existence checks,
+        # invalidated via the 'skip', 'delete' and 'rename' channels
+        cache_secs = kwargs.get('cache_secs', 0)
+        self.skip_cache = LocalTTLCache(cache_secs)
+        self.rec_exists_cache = LocalTTLCache(cache_secs)
+
+        self.closed_queue_key = kwargs.get('closed_queue_key')
+        self.temp_prefix = kwargs.get('temp_prefix', 'temp-')
+
+    def _close_file(self, fh):
+        super(SkipCheckingMultiFileWARCWriter, self)._close_file(fh)
+
+        if not self.closed_queue_key:
+            return
+
+        # notify storage committer that this WARC is complete
+        # (temp users are never committed, so not queued)
+        user = os.path.basename(os.path.dirname(fh.name))
+        if user.startswith(self.temp_prefix):
+            return
+
+        try:
+            self.redis.rpush(self.closed_queue_key, fh.name)
+        except Exception as e:
+            print(e)
+
+    def clear_cached_checks(self):
+        self.skip_cache.clear()
+        self.rec_exists_cache.clear()
 
     def allow_new_file(self, filename, params):
         key = res_template(self.info_key, params)
 
-        # ensure recording exists before writing anything
-        # if not, abort opening new warc file here
-        if not self.redis.exists(key):
-            print('Writing skipped, recording does not exist for ' + filename)
-            return False
+        # ensure recording and collection exist, and are not being deleted,
+        # before writing anything. if not, abort opening new warc file here
+        # (only existing recordings are cached, missing ones always rechecked)
+        if not self.rec_exists_cache.get(key):
+            with redis.utils.pipeline(self.redis) as pi:
+                pi.hexists(key, 'id')
+                pi.hexists(res_template(self.coll_info_key, params), 'id')
+                rec_exists, coll_exists = pi.execute()
+
+            if not rec_exists or not coll_exists:
+                print('Writing skipped, recording does not exist for ' + filename)
+                return False
+
+            self.rec_exists_cache.set(key, True)
 
         return True
 
@@ -482,27 +1104,131 @@ class SkipCheckingMultiFileWARCWriter(MultiFileWARCWriter):
 
         skip_key = res_template(self.skip_key_template, params)
 
-        if self.redis.get(skip_key) == b'1':
+        skip = self.skip_cache.get(skip_key)
+        if skip is None:
+            skip = (self.redis.get(skip_key) == b'1')
+            self.skip_cache.set(skip_key, skip)
+
+        if skip:
             print('SKIPPING REQ', params.get('url'))
             return False
 
         return True
 
 
+# ============================================================================
+class LocalTTLCache(object):
+    """ Small in-process cache for redis lookups, entries expire after ttl secs
+    """
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cache = {}
+
+    def get(self, key):
+        if self.ttl <= 0:
+            return None
+
+        res = self.cache.get(key)
+        if not res:
+            return None
+
+        value, expires = res
+        if expires < time.time():
+            self.cache.pop(key, None)
+            return None
+
+        return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+
+        if len(self.cache) >= self.max_size:
+            self.purge_expired()
+
+            if len(self.cache) >= self.max_size:
+                self.cache.clear()
+
+        self.cache[key] = (value, time.time() + self.ttl)
+
+    def remove(self, key):
+        self.cache.pop(key, None)
+
+    def purge_expired(self):
+        now = time.time()
+        for key, (value, expires) in list(self.cache.items()):
+            if expires < now:
+                self.cache.pop(key, None)
+
+    def clear(self):
+        self.cache.clear()
+
+
 # ============================================================================
 class TempWriteBuffer(tempfile.SpooledTemporaryFile):
-    def __init__(self, redis, info_key, class_name, url):
+    """ Buffer for a response being recorded, tracked in 'pending_size'
+
+    If flush_size or flush_secs are set, size increments are batched until
+    either limit is reached, so 'pending_size' may lag by up to flush_size
+    bytes per buffer. Buffers closed before the first flush skip redis entirely.
+    """
+    def __init__(self, redis, info_key, class_name, url,
+                 flush_size=0, flush_secs=0):
         super(TempWriteBuffer, self).__init__(max_size=512*1024)
         self.redis = redis
         self.info_key = info_key
-        self.redis.hincrby(self.info_key, 'pending_count', 1)
+
+        self.flush_size = flush_size
+        self.flush_secs = flush_secs
+
         self._wsize = 0
+        self._flushed_size = 0
+        self._last_flush = time.time()
+
+        self._counted = False
+
+        if not self.is_buffered():
+            self.redis.hincrby(self.info_key, 'pending_count', 1)
+            self._counted = True
+
+    def is_buffered(self):
+        return self.flush_size > 0 or self.flush_secs > 0
 
     def write(self, buff):
         super(TempWriteBuffer, self).write(buff)
-        length = len(buff)
-        self._wsize += length
-        self.redis.hincrby(self.info_key, 'pending_size', length)
+        self._wsize += len(buff)
+
+        if self._should_flush():
+            self.flush_pending()
+
+    def _should_flush(self):
+        if not self.is_buffered():
+            return True
+
+        if self.flush_size > 0 and (self._wsize - self._flushed_size) >= self.flush_size:
+            return True
+
+        if self.flush_secs > 0 and (time.time() - self._last_flush) >= self.flush_secs:
+            return True
+
+        return False
+
+    def flush_pending(self):
+        length = self._wsize - self._flushed_size
+
+        if self._counted:
+            if length:
+                self.redis.hincrby(self.info_key, 'pending_size', length)
+        else:
+            with redis.utils.pipeline(self.redis) as pi:
+                pi.hincrby(self.info_key, 'pending_count', 1)
+                pi.hincrby(self.info_key, 'pending_size', length)
+
+            self._counted = True
+
+        self._flushed_size = self._wsize
+        self._last_flush = time.time()
 
     def close(self):
         try:
@@ -511,7 +1237,11 @@ class TempWriteBuffer(tempfile.SpooledTemporaryFile):
             import traceback
             traceback.print_exc()
 
-        self.redis.hincrby(self.info_key, 'pending_size', -self._wsize)
-        self.redis.hincrby(self.info_key, 'pending_count', -1)
+        if not self._counted:
+            return
 
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hincrby(self.info_key, 'pending_size', -self._flushed_size)
+            pi.hincrby(self.info_key, 'pending_count', -1)
 
+        self._counted = False
@@ -24,9 +24,16 @@ class RecsController(BaseController):
         def get_recordings():
             user, coll = self.get_user_coll(api=True)
 
-            rec_list = self.manager.get_recordings(user, coll)
+            offset, limit = self.get_paging(api=True)
 
-            return {'recordings': rec_list}
+            rec_list = self.manager.get_recordings(user, coll, offset, limit)
+
+            if limit is None:
+                return {'recordings': rec_list}
+
+            return {'recordings': rec_list,
+                    'offset': offset,
+                    'total': self.manager.num_recordings(user, coll)}
 
         @self.app.get('/api/v1/recordings/<rec>')
         def get_recording(rec):
@@ -122,8 +129,14 @@ class RecsController(BaseController):
             user, coll = self.get_user_coll(api=True)
             self._ensure_rec_exists(user, coll, rec)
 
-            pages = self.manager.list_pages(user, coll, rec)
-            return {'pages': pages}
+            if 'cursor' not in request.query and 'limit' not in request.query:
+                pages = self.manager.list_pages(user, coll, rec)
+                return {'pages': pages}
+
+            cursor, limit = self.get_cursor(self.manager.PAGES_LIMIT, api=True)
+
+            pages, cursor = self.manager.list_pages_paged(user, coll, rec, cursor, limit)
+            return {'pages': pages, 'cursor': cursor}
 
         @self.app.post('/api/v1/recordings/<rec>/tag')
         @self.manager.beta_user()
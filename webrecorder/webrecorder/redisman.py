@@ -12,7 +12,7 @@ from datetime import datetime
 from bottle import template, request, HTTPError
 
 from webrecorder.webreccork import ValidationException
-from webrecorder.redisutils import RedisTable
+from webrecorder.redisutils import RedisTable, KeyRegistry, page_ts_score
 from webrecorder.webreccork import WebRecCork
 from webrecorder.session import Session
 
@@ -160,6 +160,8 @@ class LoginManagerMixin(object):
             pi.hset(key, 'name', init_info.get('name', ''))
             pi.hsetnx(key, 'size', '0')
 
+        self._clear_info(key)
+
         self.cork.do_login(user)
         sesh = self.get_session()
         if not sesh.curr_user:
@@ -203,9 +205,11 @@ class LoginManagerMixin(object):
             pi.hset(key, 'created_at', now)
             pi.hsetnx(key, 'size', '0')
 
+        self._clear_info(key)
+
     def get_user_info(self, user):
         key = self.user_key.format(user=user)
-        result = self._format_info(self.redis.hgetall(key))
+        result = self._format_info(dict(self._get_info(key)))
         return result
 
     def has_user(self, user):
@@ -225,6 +229,7 @@ class LoginManagerMixin(object):
         key = self.user_key.format(user=user)
 
         self.redis.hset(key, 'desc', desc)
+        self._clear_info(key)
 
     def delete_user(self, user):
         if not self.is_anon(user) and not self.is_superuser():
@@ -243,17 +248,18 @@ class LoginManagerMixin(object):
 
     def get_size_allotment(self, user):
         user_key = self.user_key.format(user=user)
-        return int(self.redis.hget(user_key, 'max_size')
+        return int(self._get_info(user_key).get(b'max_size')
                    or self.default_max_size)
 
     def get_size_usage(self, user):
         user_key = self.user_key.format(user=user)
-        return int(self.redis.hget(user_key, 'size') or 0)
+        return int(self._get_info(user_key).get(b'size') or 0)
 
     def get_size_remaining(self, user):
         user_key = self.user_key.format(user=user)
 
-        size, max_size = self.redis.hmget(user_key, ['size', 'max_size'])
+        user_info = self._get_info(user_key)
+        size, max_size = user_info.get(b'size'), user_info.get(b'max_size')
 
         try:
             if not size:
@@ -298,7 +304,10 @@ class LoginManagerMixin(object):
             return ''
 
     def validate_user(self, user, email):
-        if self.has_user(user):
+        # a deleted user is reserved until the delete is done
+        deleted = self.redis.hexists(self.user_key.format(user=user), 'deleted')
+
+        if self.has_user(user) or deleted:
             msg = 'User <b>{0}</b> already exists! Please choose a different username'
             msg = msg.format(user)
             raise ValidationException(msg)
@@ -424,6 +433,9 @@ class LoginManagerMixin(object):
         key = self.user_skip_key.format(user=user, url=url)
         r = self.redis.setex(key, self.skip_key_secs, 1)
 
+        # notify recorders to drop any cached skip check for this key
+        self.redis.publish('skip', key)
+
     def rename(self, user, coll, new_coll, rec='*', new_rec='*',
                new_user='', title='', is_move=False):
 
@@ -462,6 +474,8 @@ class LoginManagerMixin(object):
                                                   to_title=to_title)
         res = requests.get(rename_url)
 
+        self._clear_info()
+
         msg = res.json()
 
         if 'success' in msg:
@@ -536,25 +550,27 @@ class AccessManagerMixin(object):
         curr_user = sesh.curr_user
         curr_role = sesh.curr_role
 
+        key = self.coll_info_key.format(user=user, coll=coll)
+        info = self._get_info(key)
+
+        # no access if collection does not exist, or is being deleted
+        if b'id' not in info:
+            return False
+
         # current user or superusers always have access, if collection exists
         if user == curr_user or (type_prefix == self.READ_PREFIX and curr_role == 'admin'):
-            return self._has_collection_no_access_check(user, coll)
-
-        key = self.coll_info_key.format(user=user, coll=coll)
+            return True
 
         #role_key = self.ROLE_KEY.format(role=curr_role)
 
-        if not curr_user:
-            res = self.redis.hmget(key, type_prefix + self.PUBLIC)
-        else:
-            res = self.redis.hmget(key, type_prefix + self.PUBLIC,
-                                        type_prefix + curr_user)
+        if info.get((type_prefix + self.PUBLIC).encode('utf-8')):
+            return True
 
-        return any(res)
+        return bool(curr_user and info.get((type_prefix + curr_user).encode('utf-8')))
 
     def is_public(self, user, coll):
         key = self.coll_info_key.format(user=user, coll=coll)
-        res = self.redis.hget(key, self.READ_PREFIX + self.PUBLIC)
+        res = self._get_info(key).get((self.READ_PREFIX + self.PUBLIC).encode('utf-8'))
         return res == b'1'
 
     def set_public(self, user, coll, is_public):
@@ -568,6 +584,8 @@ class AccessManagerMixin(object):
         else:
             self.redis.hdel(key, self.READ_PREFIX + self.PUBLIC)
 
+        self._clear_info(key)
+
         return True
 
     def can_read_coll(self, user, coll):
@@ -676,25 +694,61 @@ class PageManagerMixin(object):
         self.tags_key = config['tags_key']
 
     def tag_page(self, tags, user, coll, rec, pg_id):
-        pg_id = pg_id.encode('utf-8')
+        tag_index = self.key_registry.tag_index
 
         for tag in tags:
             k = self.user_tag_templ.format(user=user, coll=coll, rec=rec,
                                            tag=tag)
-            if self.redis.exists(k):
-                # if exists, untag
-                if self.redis.sismember(k, pg_id):
-                    self.redis.srem(k, pg_id)
-                    self.redis.zincrby(self.tags_key, tag, -1)
-                    continue
 
-            # if not previously tagged or a new tag, set and add to tag count
-            self.redis.sadd(k, pg_id)
-            self.redis.zincrby(self.tags_key, tag)
+            # toggle tag, along with tag count and tag index, in one transaction
+            def toggle_tag(pi):
+                tagged = pi.sismember(k, pg_id)
+
+                pi.multi()
+
+                if tagged:
+                    pi.srem(k, pg_id)
+                    pi.zincrby(self.tags_key, tag, -1)
+                    tag_index.remove(pi, tag, user, coll, rec, pg_id)
+                else:
+                    pi.sadd(k, pg_id)
+                    pi.zincrby(self.tags_key, tag)
+                    tag_index.add(pi, tag, user, coll, rec, pg_id)
+
+                    templ = self.user_tag_templ.replace('{tag}', tag)
+                    self.key_registry.register(pi, 'rec', templ, user, coll, rec)
+
+            self.redis.transaction(toggle_tag, k)
+
+    def get_pages_for_tag(self, tag, offset=0, limit=None):
+        if not self.key_registry.is_ready():
+            pages = self._scan_pages_for_tag(tag)
+            return pages[offset:offset + limit] if limit is not None else pages[offset:]
+
+        tagged_pages = []
+        can_view = {}
+
+        for user, coll, rec, pg_id in self.key_registry.tag_index.iter_pages(tag):
+            # display if owner or if collection is public
+            if (user, coll) not in can_view:
+                can_view[(user, coll)] = self.is_owner(user) or self.is_public(user, coll)
+
+            if not can_view[(user, coll)]:
+                continue
+
+            tagged_pages.append(self._format_tagged_page(user, coll, rec, pg_id))
+
+            if limit is not None and len(tagged_pages) == offset + limit:
+                break
+
+        return tagged_pages[offset:]
 
-    def get_pages_for_tag(self, tag):
+    def _scan_pages_for_tag(self, tag):
+        """ Find tagged pages by scanning the keyspace, until key registries
+        and tag index are built
+        """
         tagged_pages = []
-        for k in self.redis.keys('*:tag:{}'.format(tag)):
+        for k in self.redis.scan_iter(match='*:tag:{}'.format(tag)):
             parts = k.decode('utf-8').split(':')
             user = parts[1]
             coll = parts[2]
@@ -703,30 +757,37 @@ class PageManagerMixin(object):
             # display if owner or if collection is public
             if self.is_owner(user) or self.is_public(user, coll):
                 for i in self.redis.smembers(k):
-                    data = i.decode('utf-8').split(' ')
-                    tagged_pages.append({
-                        'user': user,
-                        'collection': coll,
-                        'recording': rec,
-                        'timestamp': data[1],
-                        'url': data[0],
-                        'browser': data[2],
-                    })
+                    tagged_pages.append(self._format_tagged_page(user, coll, rec,
+                                                                 i.decode('utf-8')))
 
         return sorted(tagged_pages, key=lambda x: x['timestamp'])
 
+    def _format_tagged_page(self, user, coll, rec, pg_id):
+        data = pg_id.split(' ')
+        return {'user': user,
+                'collection': coll,
+                'recording': rec,
+                'timestamp': data[1],
+                'url': data[0],
+                'browser': data[2],
+               }
+
 
 # ============================================================================
 class RecManagerMixin(object):
+    PAGES_LIMIT = 100
+
     def __init__(self, config):
         super(RecManagerMixin, self).__init__(config)
         self.rec_info_key = config['info_key_templ']['rec']
         self.page_key = config['page_key_templ']
+        self.page_ts_key = config['page_ts_key_templ']
         self.cdx_key = config['cdxj_key_templ']
         self.tags_key = config['tags_key']
 
-    def get_recording(self, user, coll, rec):
-        self.assert_can_read(user, coll)
+    def get_recording(self, user, coll, rec, access_check=True):
+        if access_check:
+            self.assert_can_read(user, coll)
 
         key = self.rec_info_key.format(user=user, coll=coll, rec=rec)
 
@@ -766,9 +827,10 @@ class RecManagerMixin(object):
         return self.redis.hget(key, 'id') != None
 
     def create_recording(self, user, coll, rec, rec_title, coll_title='',
-                         no_dupe=False):
+                         no_dupe=False, access_check=True):
 
-        self.assert_can_write(user, coll)
+        if access_check:
+            self.assert_can_write(user, coll)
 
         orig_rec = rec
         orig_rec_title = rec_title
@@ -782,7 +844,7 @@ class RecManagerMixin(object):
 
             # don't create a dupelicate, just use the specified recording
             if no_dupe:
-                return self.get_recording(user, coll, rec)
+                return self.get_recording(user, coll, rec, access_check)
 
             count += 1
             rec_title = orig_rec_title + ' ' + str(count)
@@ -796,16 +858,23 @@ class RecManagerMixin(object):
             pi.hset(key, 'updated_at', now)
             pi.hsetnx(key, 'size', '0')
 
+            # new recording, all pages added to the timestamp index as written
+            pi.hset(key, 'pages_indexed', '1')
+
+            self.key_registry.add_rec(pi, user, coll, rec, now)
+
         if not self._has_collection_no_access_check(user, coll):
             coll_title = coll_title or coll
-            self.create_collection(user, coll, coll_title)
+            self.create_collection(user, coll, coll_title,
+                                   access_check=access_check)
 
-        return self.get_recording(user, coll, rec)
+        return self.get_recording(user, coll, rec, access_check)
 
     def set_recording_timestamps(self, user, coll, rec,
-                                 created_at, updated_at):
+                                 created_at, updated_at, access_check=True):
 
-        self.assert_can_write(user, coll)
+        if access_check:
+            self.assert_can_write(user, coll)
 
         key = self.rec_info_key.format(user=user, coll=coll, rec=rec)
 
@@ -821,16 +890,36 @@ class RecManagerMixin(object):
 
         return True
 
-    def get_recordings(self, user, coll):
-        self.assert_can_read(user, coll)
+    def _get_rec_ids(self, user, coll, offset=0, limit=None):
+        if self.key_registry.is_ready():
+            return self.key_registry.get_recs(user, coll, offset, limit)
 
         key_pattern = self.rec_info_key.format(user=user, coll=coll, rec='*')
 
-        keys = list(self.redis.scan_iter(match=key_pattern))
+        recs = sorted(key.decode('utf-8').split(':')[3]
+                      for key in self.redis.scan_iter(match=key_pattern))
+
+        if limit is not None:
+            return recs[offset:offset + limit]
+        else:
+            return recs[offset:]
+
+    def num_recordings(self, user, coll):
+        self.assert_can_read(user, coll)
+
+        if self.key_registry.is_ready():
+            return self.key_registry.num_recs(user, coll)
+        else:
+            return len(self._get_rec_ids(user, coll))
+
+    def get_recordings(self, user, coll, offset=0, limit=None):
+        self.assert_can_read(user, coll)
+
+        recs = self._get_rec_ids(user, coll, offset, limit)
 
         with redis.utils.pipeline(self.redis) as pi:
-            for key in keys:
-                pi.hgetall(key)
+            for rec in recs:
+                pi.hgetall(self.rec_info_key.format(user=user, coll=coll, rec=rec))
 
             all_recs = pi.execute()
 
@@ -842,6 +931,22 @@ class RecManagerMixin(object):
 
         return all_rec_list
 
+    def get_rec_titles(self, user, coll):
+        """ title of each recording, without filling in full recording info
+        """
+        self.assert_can_read(user, coll)
+
+        recs = self._get_rec_ids(user, coll)
+
+        with redis.utils.pipeline(self.redis) as pi:
+            for rec in recs:
+                pi.hget(self.rec_info_key.format(user=user, coll=coll, rec=rec), 'title')
+
+            titles = pi.execute()
+
+        return dict((rec, title.decode('utf-8'))
+                    for rec, title in zip(recs, titles) if title is not None)
+
     def delete_recording(self, user, coll, rec):
         self.assert_can_admin(user, coll)
 
@@ -862,18 +967,24 @@ class RecManagerMixin(object):
 
         pagedata_json = json.dumps(pagedata).encode('utf-8')
 
-        self.redis.hset(key,
-                        pagedata['url'] + ' ' + pagedata['timestamp'],
-                        pagedata_json)
+        page_key = pagedata['url'] + ' ' + pagedata['timestamp']
+
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hset(key, page_key, pagedata_json)
+            pi.zadd(self.page_ts_key.format(user=user, coll=coll, rec=rec),
+                    page_ts_score(pagedata['timestamp']), page_key)
+            self._incr_pages_version(pi, user, coll, rec)
 
         return {}
 
-    def import_pages(self, user, coll, rec, pagelist):
-        self.assert_can_admin(user, coll)
+    def import_pages(self, user, coll, rec, pagelist, access_check=True):
+        if access_check:
+            self.assert_can_admin(user, coll)
 
         key = self.page_key.format(user=user, coll=coll, rec=rec)
 
         pagemap = {}
+        scores = []
 
         for pagedata in pagelist:
             url = pagedata['url']
@@ -886,9 +997,17 @@ class RecManagerMixin(object):
 
             pagedata_json = json.dumps(pagedata).encode('utf-8')
 
-            pagemap[pagedata['url'] + ' ' + pagedata['timestamp']] = pagedata_json
+            page_key = pagedata['url'] + ' ' + pagedata['timestamp']
+            pagemap[page_key] = pagedata_json
+            scores.extend([page_ts_score(pagedata['timestamp']), page_key])
 
-        self.redis.hmset(key, pagemap)
+        if not pagemap:
+            return {}
+
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hmset(key, pagemap)
+            pi.zadd(self.page_ts_key.format(user=user, coll=coll, rec=rec), *scores)
+            self._incr_pages_version(pi, user, coll, rec)
 
         return {}
 
@@ -905,9 +1024,12 @@ class RecManagerMixin(object):
 
         pagedata_json = json.dumps(pagedata).encode('utf-8')
 
-        self.redis.hset(key,
-                        pagedata['url'] + ' ' + pagedata['timestamp'],
-                        pagedata_json)
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hset(key,
+                    pagedata['url'] + ' ' + pagedata['timestamp'],
+                    pagedata_json)
+
+            self._incr_pages_version(pi, user, coll, rec)
 
         return {}
 
@@ -916,12 +1038,24 @@ class RecManagerMixin(object):
 
         key = self.page_key.format(user=user, coll=coll, rec=rec)
 
-        res = self.redis.hdel(key, url + ' ' + ts)
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hdel(key, url + ' ' + ts)
+            pi.zrem(self.page_ts_key.format(user=user, coll=coll, rec=rec), url + ' ' + ts)
+            self._incr_pages_version(pi, user, coll, rec)
+            res = pi.execute()[0]
+
         if res == 1:
             return {}
         else:
             return {'error': 'not found'}
 
+    def _incr_pages_version(self, pi, user, coll, rec):
+        """ Count changes to the pages of the recording, so that warcinfo
+        records with the page list, cached for downloads, are not reused
+        """
+        key = self.rec_info_key.format(user=user, coll=coll, rec=rec)
+        pi.hincrby(key, 'pages_version', 1)
+
     def list_pages(self, user, coll, rec):
         self.assert_can_read(user, coll)
 
@@ -939,17 +1073,21 @@ class RecManagerMixin(object):
     def count_pages(self, user, coll, rec):
         self.assert_can_read(user, coll)
 
-        key = self.page_key.format(user=user, coll=coll, rec=rec)
+        if rec != '*':
+            return self.redis.hlen(self.page_key.format(user=user, coll=coll, rec=rec))
 
-        if rec == '*':
-            count = 0
+        return sum(self.count_rec_pages(user, coll).values())
 
-            for pagekey in self.redis.scan_iter(key):
-                count += self.redis.hlen(pagekey)
-        else:
-            count = self.redis.hlen(key)
+    def count_rec_pages(self, user, coll):
+        self.assert_can_read(user, coll)
+
+        recs = self._get_rec_ids(user, coll)
+
+        with redis.utils.pipeline(self.redis) as pi:
+            for rec in recs:
+                pi.hlen(self.page_key.format(user=user, coll=coll, rec=rec))
 
-        return count
+            return dict(zip(recs, pi.execute()))
 
     def get_size(self, user, coll, rec):
         if not self.can_read_coll(user, coll):
@@ -974,9 +1112,9 @@ class RecManagerMixin(object):
     def list_coll_pages(self, user, coll, rec='*'):
         self.assert_can_read(user, coll)
 
-        match_key = self.page_key.format(user=user, coll=coll, rec=rec)
+        recs = self._get_rec_ids(user, coll) if rec == '*' else [rec]
 
-        all_page_keys = list(self.redis.scan_iter(match_key))
+        all_page_keys = [self.page_key.format(user=user, coll=coll, rec=rec) for rec in recs]
 
         pagelist = []
 
@@ -986,13 +1124,12 @@ class RecManagerMixin(object):
 
             all_pages = pi.execute()
 
-        for key, rec_pagelist in zip(all_page_keys, all_pages):
-            rec = key.rsplit(b':', 2)[-2]
+        for rec, rec_pagelist in zip(recs, all_pages):
             for page in rec_pagelist:
                 page = json.loads(page.decode('utf-8'))
                 page['user'] = user
                 page['collection'] = coll
-                page['recording'] = rec.decode('utf-8')
+                page['recording'] = rec
                 pagelist.append(page)
 
         if not self.can_admin_coll(user, coll):
@@ -1000,6 +1137,176 @@ class RecManagerMixin(object):
 
         return sorted(pagelist, key=lambda x: x['timestamp'])
 
+    def list_pages_paged(self, user, coll, rec='*', cursor=None, limit=PAGES_LIMIT):
+        """ Pages of one or all recordings, by timestamp, from the page
+        index of each recording. Returns up to limit pages following the
+        cursor, and the cursor of the next window, or None if no more pages
+        """
+        self.assert_can_read(user, coll)
+
+        recs = self._get_rec_ids(user, coll) if rec == '*' else [rec]
+
+        if cursor:
+            score, cursor_rec, cursor_page = self._parse_page_cursor(cursor)
+            min_score = '(' + str(score)
+        else:
+            min_score = '-inf'
+
+        def query_pages(pi):
+            for rec in recs:
+                key = self.page_ts_key.format(user=user, coll=coll, rec=rec)
+                if cursor:
+                    # pages with the same timestamp as the cursor, ordered by (rec, page)
+                    pi.zrangebyscore(key, score, score, withscores=True)
+
+                pi.zrangebyscore(key, min_score, '+inf', start=0, num=limit, withscores=True)
+
+        with redis.utils.pipeline(self.redis) as pi:
+            for rec in recs:
+                pi.hget(self.rec_info_key.format(user=user, coll=coll, rec=rec), 'pages_indexed')
+
+            query_pages(pi)
+
+            results = pi.execute()
+
+        indexed = results[:len(recs)]
+        results = results[len(recs):]
+
+        unindexed = [rec for rec, is_indexed in zip(recs, indexed) if not is_indexed]
+
+        if unindexed and self._index_pages(user, coll, unindexed):
+            with redis.utils.pipeline(self.redis) as pi:
+                query_pages(pi)
+
+                results = pi.execute()
+
+        entries = []
+        per_rec = 2 if cursor else 1
+
+        for i, rec in enumerate(recs):
+            for res in results[i * per_rec:(i + 1) * per_rec]:
+                for page_key, page_score in res:
+                    page_key = page_key.decode('utf-8')
+                    if cursor and page_score == score and (rec, page_key) <= (cursor_rec, cursor_page):
+                        continue
+
+                    entries.append((int(page_score), rec, page_key))
+
+        entries = sorted(entries)[:limit]
+
+        with redis.utils.pipeline(self.redis) as pi:
+            for page_score, rec, page_key in entries:
+                pi.hget(self.page_key.format(user=user, coll=coll, rec=rec), page_key)
+
+            all_pages = pi.execute()
+
+        can_admin = self.can_admin_coll(user, coll)
+        pagelist = []
+
+        for (page_score, rec, page_key), page in zip(entries, all_pages):
+            if not page:
+                continue
+
+            page = json.loads(page.decode('utf-8'))
+            if not can_admin and page.get('hidden') == '1':
+                continue
+
+            page['user'] = user
+            page['collection'] = coll
+            page['recording'] = rec
+            pagelist.append(page)
+
+        if len(entries) == limit:
+            next_cursor = '{0}:{1}:{2}'.format(*entries[-1])
+        else:
+            next_cursor = None
+
+        return pagelist, next_cursor
+
+    def _parse_page_cursor(self, cursor):
+        try:
+            score, rec, page_key = cursor.split(':', 2)
+            return int(score), rec, page_key
+        except ValueError:
+            raise HTTPError(400, 'Invalid Cursor')
+
+    def get_prev_pages_cursor(self, user, coll, rec='*', cursor=None, limit=PAGES_LIMIT):
+        """ Cursor for the window of pages before the window following cursor,
+        as returned by list_pages_paged. Returns '' if the previous window is
+        the first, or None if there is no previous window
+        """
+        if not cursor:
+            return None
+
+        self.assert_can_read(user, coll)
+
+        score, cursor_rec, cursor_page = self._parse_page_cursor(cursor)
+
+        recs = self._get_rec_ids(user, coll) if rec == '*' else [rec]
+
+        # the previous window ends with the cursor page, so the page before
+        # that window is the limit + 1 page back, counting the cursor page
+        with redis.utils.pipeline(self.redis) as pi:
+            for rec in recs:
+                key = self.page_ts_key.format(user=user, coll=coll, rec=rec)
+                pi.zrangebyscore(key, score, score, withscores=True)
+                pi.zrevrangebyscore(key, '(' + str(score), '-inf', start=0, num=limit + 1, withscores=True)
+
+            results = pi.execute()
+
+        entries = []
+
+        for i, rec in enumerate(recs):
+            for res in results[i * 2:(i + 1) * 2]:
+                for page_key, page_score in res:
+                    page_key = page_key.decode('utf-8')
+                    if page_score == score and (rec, page_key) > (cursor_rec, cursor_page):
+                        continue
+
+                    entries.append((int(page_score), rec, page_key))
+
+        entries = sorted(entries, reverse=True)
+
+        if len(entries) > limit:
+            return '{0}:{1}:{2}'.format(*entries[limit])
+        else:
+            return ''
+
+    def _index_pages(self, user, coll, recs):
+        """ Index pages added before the timestamp index existed, and mark
+        each existing recording as indexed, so only checked once.
+        Returns True if any pages were indexed
+        """
+        with redis.utils.pipeline(self.redis) as pi:
+            for rec in recs:
+                pi.hget(self.rec_info_key.format(user=user, coll=coll, rec=rec), 'id')
+                pi.hkeys(self.page_key.format(user=user, coll=coll, rec=rec))
+
+            results = pi.execute()
+
+        any_pages = False
+
+        with redis.utils.pipeline(self.redis) as pi:
+            for rec, rec_id, page_keys in zip(recs, results[0::2], results[1::2]):
+                # no such recording
+                if not rec_id:
+                    continue
+
+                index_key = self.page_ts_key.format(user=user, coll=coll, rec=rec)
+
+                for i in range(0, len(page_keys), self.PAGES_LIMIT):
+                    scores = []
+                    for page_key in page_keys[i:i + self.PAGES_LIMIT]:
+                        scores.extend([page_ts_score(page_key.rsplit(b' ', 1)[-1].decode('utf-8')), page_key])
+
+                    pi.zadd(index_key, *scores)
+
+                pi.hset(self.rec_info_key.format(user=user, coll=coll, rec=rec), 'pages_indexed', '1')
+
+                any_pages = any_pages or bool(page_keys)
+
+        return any_pages
+
     def num_pages(self, user, coll, rec):
         self.assert_can_read(user, coll)
         key = self.page_key.format(user=user, coll=coll, rec=rec)
@@ -1032,18 +1339,18 @@ class CollManagerMixin(object):
         self.coll_info_key = config['info_key_templ']['coll']
         self.mount_key = config['mount_key_templ']
 
-    def get_collection(self, user, coll, access_check=True):
+    def get_collection(self, user, coll, access_check=True, include_recs=True):
         if access_check:
             self.assert_can_read(user, coll)
 
         key = self.coll_info_key.format(user=user, coll=coll)
-        return self._fill_collection(user, self.redis.hgetall(key), True)
+        return self._fill_collection(user, dict(self._get_info(key)), include_recs)
 
     def get_collection_size(self, user, coll):
         key = self.coll_info_key.format(user=user, coll=coll)
 
         try:
-            size = int(self.redis.hget(key, 'size'))
+            size = int(self._get_info(key).get(b'size'))
         except:
             size = 0
 
@@ -1093,7 +1400,7 @@ class CollManagerMixin(object):
 
     def _has_collection_no_access_check(self, user, coll):
         key = self.coll_info_key.format(user=user, coll=coll)
-        return self.redis.hget(key, 'id') != None
+        return b'id' in self._get_info(key)
 
     def has_collection(self, user, coll):
         if not self.can_read_coll(user, coll):
@@ -1101,8 +1408,10 @@ class CollManagerMixin(object):
 
         return self._has_collection_no_access_check(user, coll)
 
-    def create_collection(self, user, coll, coll_title, desc='', public=False):
-        self.assert_can_admin(user, coll)
+    def create_collection(self, user, coll, coll_title, desc='', public=False,
+                          access_check=True):
+        if access_check:
+            self.assert_can_admin(user, coll)
 
         orig_coll = coll
         orig_coll_title = coll_title
@@ -1128,31 +1437,53 @@ class CollManagerMixin(object):
                 pi.hset(key, self.READ_PREFIX + self.PUBLIC, 1)
             pi.hsetnx(key, 'size', '0')
 
-        return self.get_collection(user, coll)
+            self.key_registry.add_coll(pi, user, coll, now)
+
+        self._clear_info(key)
+
+        return self.get_collection(user, coll, access_check)
+
+    def _get_coll_ids(self, user):
+        """ (user, coll) for each collection of user, or all collections if user is '*'
+        """
+        if not self.key_registry.is_ready():
+            key_pattern = self.coll_info_key.format(user=user, coll='*')
+            return [tuple(key.decode('utf-8').split(':')[1:3])
+                    for key in self.redis.scan_iter(match=key_pattern)]
+
+        if user == '*':
+            return self.key_registry.get_all_colls()
+
+        return [(user, coll) for coll in self.key_registry.get_colls(user)]
 
     def num_collections(self, user):
-        key_pattern = self.coll_info_key.format(user=user, coll='*')
+        colls = self._get_coll_ids(user)
 
-        keys = list(self.redis.scan_iter(match=key_pattern))
+        is_owner = self.is_owner(user)
 
-        if not self.is_owner(user):
-            keys = [key for key in keys if self.is_public(user, key.decode('utf-8'))]
+        with redis.utils.pipeline(self.redis) as pi:
+            for coll_user, coll in colls:
+                pi.hmget(self.coll_info_key.format(user=coll_user, coll=coll),
+                         'id', self.READ_PREFIX + self.PUBLIC)
 
-        return len(keys)
+            all_colls = pi.execute()
 
-    def get_collections(self, user, include_recs=False, api=False):
-        key_pattern = self.coll_info_key.format(user=user, coll='*')
+        # skip collections being deleted, as in get_collections
+        return len([coll_id for coll_id, public in all_colls
+                    if coll_id and (is_owner or public == b'1')])
 
-        keys = list(self.redis.scan_iter(match=key_pattern))
+    def get_collections(self, user, include_recs=False, api=False):
+        colls = self._get_coll_ids(user)
 
         with redis.utils.pipeline(self.redis) as pi:
-            for key in keys:
-                pi.hgetall(key)
+            for coll_user, coll in colls:
+                pi.hgetall(self.coll_info_key.format(user=coll_user, coll=coll))
 
             all_colls = pi.execute()
 
+        # skip collections being deleted
         all_colls = [self._fill_collection(user, x, include_recs=include_recs)
-                     for x in all_colls]
+                     for x in all_colls if b'id' in x]
 
         # if this is an API request or the user is not an owner,
         # filter out private collections
@@ -1176,6 +1507,7 @@ class CollManagerMixin(object):
         key = self.coll_info_key.format(user=user, coll=coll)
 
         self.redis.hset(key, prop_name, prop_value)
+        self._clear_info(key)
 
     def set_rec_prop(self, user, coll, rec, prop_name, prop_value):
         self.assert_can_admin(user, coll)
@@ -1185,20 +1517,23 @@ class CollManagerMixin(object):
         self.redis.hset(key, prop_name, prop_value)
 
     def get_tags_in_collection(self, user, coll):
-        keys = self.redis.keys('*:{user}:{coll}:*:tag:*'.format(user=user,
-                                                                coll=coll))
+        if self.key_registry.is_ready():
+            tag_keys = self.key_registry.get_tag_keys(user, coll)
+        else:
+            pattern = self.user_tag_templ.format(user=user, coll=coll, rec='*', tag='*')
+            tag_keys = [(k.decode('utf-8').split(':')[5], k)
+                        for k in self.redis.scan_iter(match=pattern)]
+
+        with redis.utils.pipeline(self.redis) as pi:
+            for tag, k in tag_keys:
+                pi.smembers(k)
+
+            all_members = pi.execute()
 
         # return pages grouped by tag
         tagged_pages = {}
-        for k in keys:
-            tag = k.decode('utf-8').split(':')[5]
-            if tag in tagged_pages:
-                tagged_pages[tag].extend([i.decode('utf-8')
-                                          for i in self.redis.smembers(k)])
-            else:
-                tagged_pages.update({
-                    tag: [i.decode('utf-8') for i in self.redis.smembers(k)]
-                })
+        for (tag, k), members in zip(tag_keys, all_members):
+            tagged_pages.setdefault(tag, []).extend(i.decode('utf-8') for i in members)
 
         return tagged_pages
 
@@ -1218,15 +1553,21 @@ class DeleteManagerMixin(object):
 
         res = requests.delete(delete_url)
 
+        self._clear_info()
+
         return res.json() == {}
 
 
 # ============================================================================
 class Base(object):
+    INFO_CACHE_KEY = 'webrec.info_cache'
+
     def __init__(self, config):
         self.download_paths = config['download_paths']
         self.INT_KEYS = ('size', 'created_at', 'updated_at')
 
+        self.key_registry = KeyRegistry(self.redis, config)
+
     def get_content_inject_info(self, user, coll, rec):
         info = {}
 
@@ -1269,6 +1610,58 @@ class Base(object):
 
         return info
 
+    def _get_request_cache(self):
+        """ Info hashes already loaded in the current request, or None if not
+        in a request. Cached info is used for access checks and metadata only
+        """
+        try:
+            environ = request.environ
+        except RuntimeError:
+            return None
+
+        cache = environ.get(self.INFO_CACHE_KEY)
+        if cache is None:
+            cache = environ[self.INFO_CACHE_KEY] = {}
+
+        return cache
+
+    def reset_info_cache(self, environ=None):
+        """ Drop info cached in the current request, or in environ, eg. for
+        each message of a long running websocket, or in an environ copied
+        for a background job
+        """
+        if environ is None:
+            try:
+                environ = request.environ
+            except RuntimeError:
+                return
+
+        environ.pop(self.INFO_CACHE_KEY, None)
+
+    def _get_info(self, key):
+        cache = self._get_request_cache()
+        if cache is None:
+            return self.redis.hgetall(key)
+
+        info = cache.get(key)
+        if info is None:
+            info = cache[key] = self.redis.hgetall(key)
+
+        return info
+
+    def _clear_info(self, key=None):
+        """ Clear cached info for key, or all cached info if no key,
+        after it is changed in this request
+        """
+        cache = self._get_request_cache()
+        if not cache:
+            return
+
+        if key:
+            cache.pop(key, None)
+        else:
+            cache.clear()
+
     def _format_info(self, result):
         if not result:
             return {}
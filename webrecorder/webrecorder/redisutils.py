@@ -1,4 +1,8 @@
 import json
+import re
+import time
+
+import redis
 
 
 # ============================================================================
@@ -85,3 +89,379 @@ class RedisHashTable(object):
         return bool(self.thedict)
 
 
+
+
+# ============================================================================
+def page_ts_score(ts):
+    """ Score of a page timestamp in sorted sets, as 14-digit int
+    """
+    try:
+        return int(ts[:14].ljust(14, '0'))
+    except ValueError:
+        return 0
+
+
+# ============================================================================
+class TagIndex(object):
+    """ Index of tagged pages by tag, across all collections, kept alongside
+    the tag set of each recording. Pages of each tag are in a sorted set,
+    by timestamp, as {user}:{coll}:{rec}:{page id}
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, redis, config):
+        self.redis = redis
+        self.tag_pages_key = config['tag_pages_key_templ']
+
+        # match the tag set of a recording, eg. r:{user}:{coll}:{rec}:tag:{tag}
+        tag_key_rx = re.escape(config['user_tag_templ'])
+        for name in ('user', 'coll', 'rec', 'tag'):
+            tag_key_rx = tag_key_rx.replace(re.escape('{' + name + '}'),
+                                            '(?P<' + name + '>[^:]+)')
+
+        self.tag_key_rx = re.compile('^' + tag_key_rx + '$')
+
+    def parse_tag_key(self, key):
+        """ (user, coll, rec, tag) of a recording tag set key, or None
+        """
+        m = self.tag_key_rx.match(key)
+        if not m:
+            return None
+
+        return m.group('user'), m.group('coll'), m.group('rec'), m.group('tag')
+
+    def add(self, pi, tag, user, coll, rec, *pg_ids):
+        args = []
+        for pg_id in pg_ids:
+            args.extend([self._score(pg_id), ':'.join((user, coll, rec, pg_id))])
+
+        if args:
+            pi.zadd(self.tag_pages_key.format(tag=tag), *args)
+
+    def remove(self, pi, tag, user, coll, rec, *pg_ids):
+        if pg_ids:
+            pi.zrem(self.tag_pages_key.format(tag=tag),
+                    *[':'.join((user, coll, rec, pg_id)) for pg_id in pg_ids])
+
+    def move_key(self, pi, from_key, to_key, pg_ids):
+        """ Update the index for a recording tag set moved by a rename
+        """
+        from_parts = self.parse_tag_key(from_key)
+        to_parts = self.parse_tag_key(to_key)
+
+        if not from_parts or not to_parts or from_parts == to_parts:
+            return
+
+        pg_ids = [self._decode(pg_id) for pg_id in pg_ids]
+
+        self.remove(pi, from_parts[3], *(from_parts[:3] + tuple(pg_ids)))
+        self.add(pi, to_parts[3], *(to_parts[:3] + tuple(pg_ids)))
+
+    def remove_key(self, pi, key, pg_ids):
+        """ Update the index for a recording tag set being deleted
+        """
+        parts = self.parse_tag_key(key)
+        if not parts:
+            return
+
+        pg_ids = [self._decode(pg_id) for pg_id in pg_ids]
+
+        self.remove(pi, parts[3], *(parts[:3] + tuple(pg_ids)))
+
+    def iter_pages(self, tag):
+        """ Yield (user, coll, rec, page id) tagged with tag, by timestamp
+        """
+        key = self.tag_pages_key.format(tag=tag)
+        start = 0
+
+        while True:
+            members = self.redis.zrange(key, start, start + self.BATCH_SIZE - 1)
+
+            for member in members:
+                yield tuple(member.decode('utf-8').split(':', 3))
+
+            if len(members) < self.BATCH_SIZE:
+                break
+
+            start += self.BATCH_SIZE
+
+    def num_pages(self, tag):
+        return self.redis.zcard(self.tag_pages_key.format(tag=tag))
+
+    @staticmethod
+    def _decode(pg_id):
+        return pg_id.decode('utf-8') if isinstance(pg_id, bytes) else pg_id
+
+    @staticmethod
+    def _score(pg_id):
+        # page id is '{url} {timestamp} {browser}'
+        parts = pg_id.split(' ')
+        return page_ts_score(parts[1]) if len(parts) > 1 else 0
+
+
+# ============================================================================
+class KeyRegistry(object):
+    """ Track the keys owned by each user, collection and recording, so that
+    rename and delete can touch only those keys, without a keyspace scan
+
+    Keys with fixed templates are known from config. Keys created per item,
+    such as tags or cookies, are added as templates to the registry set of
+    the owning recording or collection. The collections of each user and
+    recordings of each collection are kept in sorted sets, by creation time
+    """
+    BUILD_LOCK_SECS = 3600
+    BUILD_BATCH_SIZE = 1000
+
+    def __init__(self, redis, config):
+        self.redis = redis
+
+        self.registry_templ = config['key_registry_templ']
+        self.user_colls_key = config['user_colls_key_templ']
+        self.coll_recs_key = config['coll_recs_key_templ']
+        self.all_colls_key = config['all_colls_key']
+        self.status_key = config['key_registry_status_key']
+
+        self.tag_index = TagIndex(redis, config)
+
+        info_keys = config['info_key_templ']
+
+        self.owned_templs = {
+            'rec': [info_keys['rec'],
+                    config['cdxj_key_templ'],
+                    config['warc_key_templ'],
+                    config['warc_size_key_templ'],
+                    config['page_key_templ'],
+                    config['page_ts_key_templ'],
+                    config['mount_key_templ'],
+                    config['detected_pages_key_templ']],
+
+            'coll': [info_keys['coll']],
+
+            'user': [info_keys['user'],
+                     config['warc_owner_key_templ']],
+        }
+
+    @staticmethod
+    def format_key(templ, user, coll='', rec=''):
+        # only fill in owner, registered templates may contain braces, eg. in tags
+        return templ.replace('{user}', user).replace('{coll}', coll).replace('{rec}', rec)
+
+    def is_ready(self):
+        return self.redis.hexists(self.status_key, 'built_at')
+
+    def register(self, pi, type_, templ, user, coll, rec=''):
+        """ Add key template to the registry of owning recording or collection
+        """
+        key = self.format_key(self.registry_templ[type_], user, coll, rec)
+        pi.sadd(key, templ)
+
+    def add_coll(self, pi, user, coll, created_at):
+        pi.zadd(self.format_key(self.user_colls_key, user), int(created_at), coll)
+        pi.zadd(self.all_colls_key, int(created_at), user + ':' + coll)
+
+    def remove_colls(self, pi, user, *colls):
+        """ Remove from the index of all collections, the user's own index
+        is removed with the collection or user
+        """
+        if colls:
+            pi.zrem(self.all_colls_key, *[user + ':' + coll for coll in colls])
+
+    def move_coll(self, pi, from_user, from_coll, to_user, to_coll):
+        from_id = from_user + ':' + from_coll
+        to_id = to_user + ':' + to_coll
+
+        if from_id == to_id:
+            return
+
+        score = self.redis.zscore(self.all_colls_key, from_id) or int(time.time())
+
+        pi.zrem(self.all_colls_key, from_id)
+        pi.zadd(self.all_colls_key, score, to_id)
+
+    def add_rec(self, pi, user, coll, rec, created_at):
+        pi.zadd(self.format_key(self.coll_recs_key, user, coll), int(created_at), rec)
+
+    def get_colls(self, user):
+        key = self.format_key(self.user_colls_key, user)
+        return [coll.decode('utf-8') for coll in self.redis.zrange(key, 0, -1)]
+
+    def get_all_colls(self):
+        """ (user, coll) for all collections, for the admin view
+        """
+        return [tuple(coll.decode('utf-8').split(':', 1))
+                for coll in self.redis.zrange(self.all_colls_key, 0, -1)]
+
+    def get_recs(self, user, coll, start=0, num=None):
+        """ Recordings of a collection by creation time, num of None for all
+        """
+        if num == 0:
+            return []
+
+        end = start + num - 1 if num is not None else -1
+
+        key = self.format_key(self.coll_recs_key, user, coll)
+        return [rec.decode('utf-8') for rec in self.redis.zrange(key, start, end)]
+
+    def num_recs(self, user, coll):
+        return self.redis.zcard(self.format_key(self.coll_recs_key, user, coll))
+
+    def _get_registered(self, type_, user, colls_recs):
+        with redis.utils.pipeline(self.redis) as pi:
+            for coll, rec in colls_recs:
+                pi.smembers(self.format_key(self.registry_templ[type_], user, coll, rec))
+
+            results = pi.execute()
+
+        return [sorted(templ.decode('utf-8') for templ in templs) for templs in results]
+
+    def iter_owned(self, type_, user, coll='', rec=''):
+        """ Yield (templ, coll, rec) for each key the recording, collection
+        or user may own. Keys with fixed templates may not exist.
+        Registries and sorted sets of children are yielded last for each owner
+        """
+        if type_ == 'user':
+            for coll in self.get_colls(user):
+                for res in self.iter_owned('coll', user, coll):
+                    yield res
+
+            for templ in self.owned_templs['user']:
+                yield templ, '', ''
+
+            yield self.user_colls_key, '', ''
+            return
+
+        if type_ == 'coll':
+            recs = self.get_recs(user, coll)
+            all_templs = self._get_registered('rec', user, [(coll, rec) for rec in recs])
+
+            for rec, templs in zip(recs, all_templs):
+                for templ in self.owned_templs['rec'] + templs:
+                    yield templ, coll, rec
+
+                yield self.registry_templ['rec'], coll, rec
+
+            templs = self._get_registered('coll', user, [(coll, '')])[0]
+            for templ in self.owned_templs['coll'] + templs:
+                yield templ, coll, ''
+
+            yield self.registry_templ['coll'], coll, ''
+            yield self.coll_recs_key, coll, ''
+            return
+
+        templs = self._get_registered('rec', user, [(coll, rec)])[0]
+        for templ in self.owned_templs['rec'] + templs:
+            yield templ, coll, rec
+
+        yield self.registry_templ['rec'], coll, rec
+
+    def get_tag_keys(self, user, coll):
+        """ (tag, key) for the tag sets of all recordings in a collection
+        """
+        recs = self.get_recs(user, coll)
+        all_templs = self._get_registered('rec', user, [(coll, rec) for rec in recs])
+
+        tag_keys = []
+
+        for rec, templs in zip(recs, all_templs):
+            for templ in templs:
+                key = self.format_key(templ, user, coll, rec)
+                parts = self.tag_index.parse_tag_key(key)
+                if parts:
+                    tag_keys.append((parts[3], key))
+
+        return tag_keys
+
+    def get_owned_keys(self, type_, user, coll='', rec=''):
+        return [self.format_key(templ, user, c, r)
+                for templ, c, r in self.iter_owned(type_, user, coll, rec)]
+
+    def is_merged(self, templ):
+        """ Registries and sorted sets of children are merged into
+        an existing target on rename, rather than replacing it
+        """
+        return templ in (self.registry_templ['rec'],
+                         self.registry_templ['coll'],
+                         self.coll_recs_key,
+                         self.user_colls_key)
+
+    def build(self):
+        """ Register existing keys from a one-time keyspace scan, for data
+        created before registries were kept. Until done, rename and
+        delete fall back to scanning
+        """
+        if self.is_ready():
+            return
+
+        now = int(time.time())
+
+        if not self.redis.hsetnx(self.status_key, 'building', now):
+            started = int(self.redis.hget(self.status_key, 'building') or 0)
+            if now - started < self.BUILD_LOCK_SECS:
+                return
+
+            self.redis.hset(self.status_key, 'building', now)
+
+        print('Building Key Registries')
+
+        coll_info_templ = self.owned_templs['coll'][0]
+        rec_info_templ = self.owned_templs['rec'][0]
+        rec_prefix = rec_info_templ.rsplit(':', 1)[0]
+
+        pi = self.redis.pipeline()
+        count = 0
+
+        for key in self.redis.scan_iter(match=self.format_key(coll_info_templ, '*', '*')):
+            key = key.decode('utf-8')
+            parts = key.split(':')
+            if len(parts) != 4 or key != self.format_key(coll_info_templ, parts[1], parts[2]):
+                continue
+
+            created_at = self.redis.hget(key, 'created_at') or 0
+            self.add_coll(pi, parts[1], parts[2], created_at)
+
+            count += 1
+            if count % self.BUILD_BATCH_SIZE == 0:
+                pi.execute()
+
+        fixed_templs = self.owned_templs['rec'] + [self.registry_templ['rec']]
+
+        for key in self.redis.scan_iter(match=self.format_key(rec_prefix + ':*', '*', '*', '*')):
+            key = key.decode('utf-8')
+            parts = key.split(':')
+            if len(parts) < 5:
+                continue
+
+            user, coll, rec = parts[1:4]
+
+            if key == self.format_key(rec_info_templ, user, coll, rec):
+                created_at = self.redis.hget(key, 'created_at') or 0
+                self.add_rec(pi, user, coll, rec, created_at)
+
+            elif any(key == self.format_key(templ, user, coll, rec) for templ in fixed_templs):
+                continue
+
+            # keys for all recordings, eg. cookies, are owned by the collection
+            elif rec == '<all>':
+                templ = ':'.join([self.format_key(rec_prefix, '{user}', '{coll}', rec)] + parts[4:])
+                self.register(pi, 'coll', templ, user, coll)
+
+            else:
+                templ = ':'.join([rec_prefix] + parts[4:])
+                self.register(pi, 'rec', templ, user, coll, rec)
+
+                tag_parts = self.tag_index.parse_tag_key(key)
+                if tag_parts:
+                    self.tag_index.add(pi, tag_parts[3], user, coll, rec,
+                                       *[pg_id.decode('utf-8') for pg_id in self.redis.smembers(key)])
+
+            count += 1
+            if count % self.BUILD_BATCH_SIZE == 0:
+                pi.execute()
+
+        pi.execute()
+
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hset(self.status_key, 'built_at', int(time.time()))
+            pi.hdel(self.status_key, 'building')
+
+        print('Key Registries Built')
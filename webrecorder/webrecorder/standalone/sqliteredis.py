@@ -0,0 +1,1076 @@
+import re
+import sqlite3
+import time
+
+from contextlib import contextmanager
+
+from six.moves.urllib.parse import urlsplit
+
+import gevent.event
+import gevent.queue
+
+from redis.exceptions import ResponseError
+
+
+# ============================================================================
+WRONG_TYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (db INTEGER, key TEXT, type TEXT,
+                                 value BLOB, expire REAL,
+                                 PRIMARY KEY (db, key));
+
+CREATE TABLE IF NOT EXISTS hashes (db INTEGER, key TEXT, field BLOB, value BLOB,
+                                   PRIMARY KEY (db, key, field));
+
+CREATE TABLE IF NOT EXISTS sets (db INTEGER, key TEXT, member BLOB,
+                                 PRIMARY KEY (db, key, member));
+
+CREATE TABLE IF NOT EXISTS zsets (db INTEGER, key TEXT, member BLOB, score REAL,
+                                  PRIMARY KEY (db, key, member));
+
+CREATE INDEX IF NOT EXISTS zsets_score ON zsets (db, key, score, member);
+
+CREATE TABLE IF NOT EXISTS lists (db INTEGER, key TEXT, pos INTEGER, value BLOB,
+                                  PRIMARY KEY (db, key, pos));
+"""
+
+TYPE_TABLES = {'hash': 'hashes',
+               'set': 'sets',
+               'zset': 'zsets',
+               'list': 'lists'}
+
+
+# ============================================================================
+class SQLiteRedisStore(object):
+    """ On-disk store shared by all SQLiteRedis clients in the process
+
+    All data stays in the sqlite file, only the sqlite page cache is
+    kept in memory, so memory use is bounded by cache_size_kb
+    """
+    PURGE_INTERVAL = 60
+
+    def __init__(self, filename, cache_size_kb=16384):
+        self.filename = filename
+
+        self.conn = sqlite3.connect(filename, isolation_level=None,
+                                    check_same_thread=False)
+
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA cache_size=-{0}'.format(int(cache_size_kb)))
+        self.conn.executescript(SCHEMA)
+
+        self.tx_depth = 0
+
+        self.channels = {}
+        self.list_pushed = gevent.event.Event()
+
+        self.last_purge = 0
+        self.purge_expired()
+
+    @contextmanager
+    def transaction(self):
+        if self.tx_depth == 0:
+            self.conn.execute('BEGIN')
+
+        self.tx_depth += 1
+        try:
+            yield self.conn
+        except:
+            self.tx_depth -= 1
+            if self.tx_depth == 0:
+                self.conn.execute('ROLLBACK')
+            raise
+        else:
+            self.tx_depth -= 1
+            if self.tx_depth == 0:
+                self.conn.execute('COMMIT')
+
+    def purge_expired(self):
+        now = time.time()
+        if now - self.last_purge < self.PURGE_INTERVAL:
+            return
+
+        self.last_purge = now
+
+        with self.transaction() as conn:
+            expired = conn.execute('SELECT db, key, type FROM keys WHERE expire <= ?',
+                                   (now,)).fetchall()
+
+            for db, key, type_ in expired:
+                _delete_key(conn, db, key, type_)
+
+    def notify_list_push(self):
+        event = self.list_pushed
+        self.list_pushed = gevent.event.Event()
+        event.set()
+
+    def publish(self, channel, message):
+        subs = self.channels.get(channel, ())
+        for pubsub in list(subs):
+            pubsub.queue.put({'type': 'message',
+                              'pattern': None,
+                              'channel': channel,
+                              'data': message})
+
+        return len(subs)
+
+    def close(self):
+        self.conn.close()
+
+
+# ============================================================================
+def _delete_key(conn, db, key, type_):
+    conn.execute('DELETE FROM keys WHERE db = ? AND key = ?', (db, key))
+
+    table = TYPE_TABLES.get(type_)
+    if table:
+        conn.execute('DELETE FROM {0} WHERE db = ? AND key = ?'.format(table), (db, key))
+
+
+# ============================================================================
+class SQLiteRedis(object):
+    """ StrictRedis-compatible client for the commands used by webrecorder
+    and pywb, backed by a SQLiteRedisStore
+    """
+    store = None
+
+    def __init__(self, host='localhost', port=6379, db=0,
+                 decode_responses=False, store=None, **kwargs):
+        self.store = store or self.store
+        self.conn = self.store.conn
+        self.db = int(db)
+        self.decode_responses = decode_responses
+
+    @classmethod
+    def from_url(cls, url, db=None, **kwargs):
+        if db is None:
+            path = urlsplit(url).path.strip('/')
+            db = int(path) if path else 0
+
+        return cls(db=db, **kwargs)
+
+    # Encoding
+    @staticmethod
+    def _enc(value):
+        if isinstance(value, bytes):
+            return value
+
+        if isinstance(value, float):
+            value = repr(value)
+
+        return str(value).encode('utf-8')
+
+    @staticmethod
+    def _key(key):
+        if isinstance(key, bytes):
+            return key.decode('utf-8')
+
+        return str(key)
+
+    def _dec(self, value):
+        if value is None:
+            return None
+
+        value = bytes(value)
+        if self.decode_responses:
+            return value.decode('utf-8')
+
+        return value
+
+    def _dec_key(self, key):
+        return key if self.decode_responses else key.encode('utf-8')
+
+    # Keys
+    def _get_type(self, key):
+        res = self.conn.execute('SELECT type, expire FROM keys WHERE db = ? AND key = ?',
+                                (self.db, key)).fetchone()
+        if not res:
+            return None
+
+        type_, expire = res
+        if expire is not None and expire <= time.time():
+            with self.store.transaction() as conn:
+                _delete_key(conn, self.db, key, type_)
+            return None
+
+        return type_
+
+    def _check_type(self, key, type_):
+        curr_type = self._get_type(key)
+        if curr_type and curr_type != type_:
+            raise ResponseError(WRONG_TYPE)
+
+        return curr_type
+
+    def _create(self, key, type_):
+        if not self._check_type(key, type_):
+            self.conn.execute('INSERT INTO keys (db, key, type) VALUES (?, ?, ?)',
+                              (self.db, key, type_))
+
+    def _remove_if_empty(self, key, type_):
+        table = TYPE_TABLES[type_]
+        res = self.conn.execute('SELECT 1 FROM {0} WHERE db = ? AND key = ? LIMIT 1'.format(table),
+                                (self.db, key)).fetchone()
+        if not res:
+            self.conn.execute('DELETE FROM keys WHERE db = ? AND key = ?', (self.db, key))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return SQLiteRedisPipeline(self)
+
+    def transaction(self, func, *watches, **kwargs):
+        """ Run func with a watching pipeline, as in redis-py. The whole call runs
+        in one sqlite transaction, so watched keys can't change and no retry is needed
+        """
+        value_from_callable = kwargs.get('value_from_callable', False)
+
+        with self.store.transaction():
+            pi = self.pipeline()
+            pi.watch(*watches)
+            func_value = func(pi)
+            exec_value = pi.execute()
+
+        return func_value if value_from_callable else exec_value
+
+    def ping(self):
+        return True
+
+    def delete(self, *names):
+        count = 0
+        with self.store.transaction() as conn:
+            for name in names:
+                key = self._key(name)
+                type_ = self._get_type(key)
+                if type_:
+                    _delete_key(conn, self.db, key, type_)
+                    count += 1
+
+        return count
+
+    def exists(self, name):
+        return self._get_type(self._key(name)) is not None
+
+    def type(self, name):
+        return self._enc(self._get_type(self._key(name)) or 'none')
+
+    def expire(self, name, time_secs):
+        if hasattr(time_secs, 'total_seconds'):
+            time_secs = time_secs.total_seconds()
+
+        key = self._key(name)
+        if not self._get_type(key):
+            return False
+
+        with self.store.transaction() as conn:
+            conn.execute('UPDATE keys SET expire = ? WHERE db = ? AND key = ?',
+                         (time.time() + int(time_secs), self.db, key))
+
+        self.store.purge_expired()
+        return True
+
+    def persist(self, name):
+        key = self._key(name)
+        if not self._get_type(key):
+            return False
+
+        with self.store.transaction() as conn:
+            conn.execute('UPDATE keys SET expire = NULL WHERE db = ? AND key = ?',
+                         (self.db, key))
+        return True
+
+    def ttl(self, name):
+        key = self._key(name)
+        if not self._get_type(key):
+            return -2
+
+        expire = self.conn.execute('SELECT expire FROM keys WHERE db = ? AND key = ?',
+                                   (self.db, key)).fetchone()[0]
+        if expire is None:
+            return -1
+
+        return max(int(round(expire - time.time())), 0)
+
+    def _iter_keys(self, pattern):
+        pattern = self._key(pattern or '*')
+        now = time.time()
+
+        cursor = self.conn.execute('SELECT key FROM keys WHERE db = ? AND key GLOB ? ' +
+                                   'AND (expire IS NULL OR expire > ?)',
+                                   (self.db, pattern, now))
+
+        # fetch all, so that keys may be modified while iterating
+        return [self._dec_key(key) for key, in cursor.fetchall()]
+
+    def keys(self, pattern='*'):
+        return self._iter_keys(pattern)
+
+    def scan_iter(self, match=None, count=None):
+        for key in self._iter_keys(match):
+            yield key
+
+    def rename(self, src, dst):
+        src = self._key(src)
+        dst = self._key(dst)
+
+        type_ = self._get_type(src)
+        if not type_:
+            raise ResponseError('no such key')
+
+        if src == dst:
+            return True
+
+        with self.store.transaction() as conn:
+            dst_type = self._get_type(dst)
+            if dst_type:
+                _delete_key(conn, self.db, dst, dst_type)
+
+            conn.execute('UPDATE keys SET key = ? WHERE db = ? AND key = ?', (dst, self.db, src))
+
+            table = TYPE_TABLES.get(type_)
+            if table:
+                conn.execute('UPDATE {0} SET key = ? WHERE db = ? AND key = ?'.format(table),
+                             (dst, self.db, src))
+
+        return True
+
+    def dbsize(self):
+        return len(self._iter_keys('*'))
+
+    def flushdb(self):
+        with self.store.transaction() as conn:
+            for table in ['keys'] + list(TYPE_TABLES.values()):
+                conn.execute('DELETE FROM {0} WHERE db = ?'.format(table), (self.db,))
+
+        return True
+
+    # Strings
+    def get(self, name):
+        key = self._key(name)
+        if not self._check_type(key, 'string'):
+            return None
+
+        res = self.conn.execute('SELECT value FROM keys WHERE db = ? AND key = ?',
+                                (self.db, key)).fetchone()
+        return self._dec(res[0])
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        key = self._key(name)
+        curr_type = self._get_type(key)
+
+        if (nx and curr_type) or (xx and not curr_type):
+            return None
+
+        if px:
+            ex = px / 1000.0
+
+        expire = time.time() + ex if ex else None
+
+        with self.store.transaction() as conn:
+            if curr_type:
+                _delete_key(conn, self.db, key, curr_type)
+
+            conn.execute('INSERT INTO keys (db, key, type, value, expire) VALUES (?, ?, ?, ?, ?)',
+                         (self.db, key, 'string', self._enc(value), expire))
+
+        if expire:
+            self.store.purge_expired()
+
+        return True
+
+    def setex(self, name, time_secs, value):
+        if hasattr(time_secs, 'total_seconds'):
+            time_secs = time_secs.total_seconds()
+
+        return self.set(name, value, ex=int(time_secs))
+
+    def setnx(self, name, value):
+        return self.set(name, value, nx=True) or False
+
+    def incrby(self, name, amount=1):
+        key = self._key(name)
+        with self.store.transaction() as conn:
+            if self._check_type(key, 'string'):
+                value = conn.execute('SELECT value FROM keys WHERE db = ? AND key = ?',
+                                     (self.db, key)).fetchone()[0]
+                value = int(value) + amount
+                conn.execute('UPDATE keys SET value = ? WHERE db = ? AND key = ?',
+                             (self._enc(value), self.db, key))
+            else:
+                value = amount
+                conn.execute('INSERT INTO keys (db, key, type, value) VALUES (?, ?, ?, ?)',
+                             (self.db, key, 'string', self._enc(value)))
+
+        return value
+
+    def incr(self, name, amount=1):
+        return self.incrby(name, amount)
+
+    def decr(self, name, amount=1):
+        return self.incrby(name, -amount)
+
+    # Hashes
+    def hget(self, name, key):
+        name = self._key(name)
+        if not self._check_type(name, 'hash'):
+            return None
+
+        res = self.conn.execute('SELECT value FROM hashes WHERE db = ? AND key = ? AND field = ?',
+                                (self.db, name, self._enc(key))).fetchone()
+
+        return self._dec(res[0]) if res else None
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+
+        return [self.hget(name, key) for key in list(keys) + list(args)]
+
+    def hgetall(self, name):
+        return dict(self._hitems(name))
+
+    def _hitems(self, name):
+        name = self._key(name)
+        if not self._check_type(name, 'hash'):
+            return []
+
+        cursor = self.conn.execute('SELECT field, value FROM hashes WHERE db = ? AND key = ?',
+                                   (self.db, name))
+
+        return [(self._dec(field), self._dec(value)) for field, value in cursor]
+
+    def hkeys(self, name):
+        return [field for field, value in self._hitems(name)]
+
+    def hvals(self, name):
+        return [value for field, value in self._hitems(name)]
+
+    def hlen(self, name):
+        name = self._key(name)
+        if not self._check_type(name, 'hash'):
+            return 0
+
+        return self.conn.execute('SELECT COUNT(*) FROM hashes WHERE db = ? AND key = ?',
+                                 (self.db, name)).fetchone()[0]
+
+    def hexists(self, name, key):
+        return self.hget(name, key) is not None
+
+    def _hset(self, conn, name, key, value, replace=True):
+        cmd = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        cursor = conn.execute(cmd + ' INTO hashes (db, key, field, value) VALUES (?, ?, ?, ?)',
+                              (self.db, name, self._enc(key), self._enc(value)))
+        return cursor.rowcount
+
+    def hset(self, name, key, value):
+        name = self._key(name)
+        with self.store.transaction() as conn:
+            self._create(name, 'hash')
+            existed = self.hget(name, key) is not None
+            self._hset(conn, name, key, value)
+
+        return 0 if existed else 1
+
+    def hsetnx(self, name, key, value):
+        name = self._key(name)
+        with self.store.transaction() as conn:
+            self._create(name, 'hash')
+            return self._hset(conn, name, key, value, replace=False)
+
+    def hmset(self, name, mapping):
+        if not mapping:
+            raise ResponseError("'hmset' with 'mapping' of length 0")
+
+        name = self._key(name)
+        with self.store.transaction() as conn:
+            self._create(name, 'hash')
+            for key, value in mapping.items():
+                self._hset(conn, name, key, value)
+
+        return True
+
+    def hincrby(self, name, key, amount=1):
+        value = self.hget(name, key)
+        value = int(value or 0) + int(amount)
+        self.hset(name, key, value)
+        return value
+
+    def hdel(self, name, *keys):
+        name = self._key(name)
+        if not self._check_type(name, 'hash'):
+            return 0
+
+        count = 0
+        with self.store.transaction() as conn:
+            for key in keys:
+                cursor = conn.execute('DELETE FROM hashes WHERE db = ? AND key = ? AND field = ?',
+                                      (self.db, name, self._enc(key)))
+                count += cursor.rowcount
+
+            self._remove_if_empty(name, 'hash')
+
+        return count
+
+    # Sets
+    def sadd(self, name, *values):
+        name = self._key(name)
+        count = 0
+        with self.store.transaction() as conn:
+            self._create(name, 'set')
+            for value in values:
+                cursor = conn.execute('INSERT OR IGNORE INTO sets (db, key, member) VALUES (?, ?, ?)',
+                                      (self.db, name, self._enc(value)))
+                count += cursor.rowcount
+
+        return count
+
+    def srem(self, name, *values):
+        name = self._key(name)
+        if not self._check_type(name, 'set'):
+            return 0
+
+        count = 0
+        with self.store.transaction() as conn:
+            for value in values:
+                cursor = conn.execute('DELETE FROM sets WHERE db = ? AND key = ? AND member = ?',
+                                      (self.db, name, self._enc(value)))
+                count += cursor.rowcount
+
+            self._remove_if_empty(name, 'set')
+
+        return count
+
+    def smembers(self, name):
+        name = self._key(name)
+        if not self._check_type(name, 'set'):
+            return set()
+
+        cursor = self.conn.execute('SELECT member FROM sets WHERE db = ? AND key = ?',
+                                   (self.db, name))
+        return set(self._dec(member) for member, in cursor)
+
+    def sismember(self, name, value):
+        name = self._key(name)
+        if not self._check_type(name, 'set'):
+            return False
+
+        res = self.conn.execute('SELECT 1 FROM sets WHERE db = ? AND key = ? AND member = ?',
+                                (self.db, name, self._enc(value))).fetchone()
+        return res is not None
+
+    def scard(self, name):
+        return len(self.smembers(name))
+
+    # Sorted Sets
+    def zadd(self, name, *args, **kwargs):
+        pairs = list(zip(args[::2], args[1::2])) + [(score, member) for member, score in kwargs.items()]
+
+        name = self._key(name)
+        count = 0
+        with self.store.transaction() as conn:
+            self._create(name, 'zset')
+            for score, member in pairs:
+                params = (float(score), self.db, name, self._enc(member))
+
+                cursor = conn.execute('INSERT OR IGNORE INTO zsets (score, db, key, member) VALUES (?, ?, ?, ?)',
+                                      params)
+                if cursor.rowcount:
+                    count += 1
+                else:
+                    conn.execute('UPDATE zsets SET score = ? WHERE db = ? AND key = ? AND member = ?',
+                                 params)
+
+        return count
+
+    def _zscore(self, name, member):
+        res = self.conn.execute('SELECT score FROM zsets WHERE db = ? AND key = ? AND member = ?',
+                                (self.db, name, member)).fetchone()
+        return res[0] if res else None
+
+    def zscore(self, name, value):
+        name = self._key(name)
+        if not self._check_type(name, 'zset'):
+            return None
+
+        return self._zscore(name, self._enc(value))
+
+    def zincrby(self, name, value, amount=1):
+        name = self._key(name)
+        member = self._enc(value)
+        with self.store.transaction() as conn:
+            self._create(name, 'zset')
+            score = (self._zscore(name, member) or 0) + float(amount)
+            conn.execute('INSERT OR REPLACE INTO zsets (db, key, member, score) VALUES (?, ?, ?, ?)',
+                         (self.db, name, member, score))
+
+        return score
+
+    def zrem(self, name, *values):
+        name = self._key(name)
+        if not self._check_type(name, 'zset'):
+            return 0
+
+        count = 0
+        with self.store.transaction() as conn:
+            for value in values:
+                cursor = conn.execute('DELETE FROM zsets WHERE db = ? AND key = ? AND member = ?',
+                                      (self.db, name, self._enc(value)))
+                count += cursor.rowcount
+
+            self._remove_if_empty(name, 'zset')
+
+        return count
+
+    def zcard(self, name):
+        name = self._key(name)
+        if not self._check_type(name, 'zset'):
+            return 0
+
+        return self.conn.execute('SELECT COUNT(*) FROM zsets WHERE db = ? AND key = ?',
+                                 (self.db, name)).fetchone()[0]
+
+    def _zquery(self, name, where='', params=(), desc=False, start=None, num=None,
+                withscores=False, score_cast_func=float, order='score'):
+
+        name = self._key(name)
+        if not self._check_type(name, 'zset'):
+            return []
+
+        direction = ' DESC' if desc else ''
+        if order == 'score':
+            order = 'score{0}, member{0}'.format(direction)
+        else:
+            order = 'member' + direction
+
+        sql = 'SELECT member, score FROM zsets WHERE db = ? AND key = ?' + where
+        sql += ' ORDER BY ' + order
+
+        if start is not None and num is not None:
+            sql += ' LIMIT {0} OFFSET {1}'.format(int(num), int(start))
+
+        cursor = self.conn.execute(sql, (self.db, name) + tuple(params))
+
+        if withscores:
+            return [(self._dec(member), score_cast_func(score)) for member, score in cursor]
+        else:
+            return [self._dec(member) for member, score in cursor]
+
+    def zrange(self, name, start, end, desc=False, withscores=False, score_cast_func=float):
+        if start < 0 or end < 0:
+            size = self.zcard(name)
+            start = max(start + size if start < 0 else start, 0)
+            end = end + size if end < 0 else end
+
+        if end < start:
+            return []
+
+        return self._zquery(name, desc=desc, start=start, num=end - start + 1,
+                            withscores=withscores, score_cast_func=score_cast_func)
+
+    def zrevrange(self, name, start, end, withscores=False, score_cast_func=float):
+        return self.zrange(name, start, end, desc=True, withscores=withscores,
+                           score_cast_func=score_cast_func)
+
+    @staticmethod
+    def _score_range(min_, max_):
+        where = ''
+        params = []
+
+        for value, op in ((min_, '>'), (max_, '<')):
+            value = value.decode('utf-8') if isinstance(value, bytes) else str(value)
+            if value in ('-inf', '+inf', 'inf'):
+                continue
+
+            if value.startswith('('):
+                value = value[1:]
+            else:
+                op += '='
+
+            where += ' AND score {0} ?'.format(op)
+            params.append(float(value))
+
+        return where, params
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        where, params = self._score_range(min, max)
+        return self._zquery(name, where, params, start=start, num=num,
+                            withscores=withscores, score_cast_func=score_cast_func)
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None,
+                         withscores=False, score_cast_func=float):
+        where, params = self._score_range(min, max)
+        return self._zquery(name, where, params, desc=True, start=start, num=num,
+                            withscores=withscores, score_cast_func=score_cast_func)
+
+    def zcount(self, name, min, max):
+        return len(self.zrangebyscore(name, min, max))
+
+    def zremrangebyscore(self, name, min, max):
+        members = self.zrangebyscore(name, min, max)
+        return self.zrem(name, *members) if members else 0
+
+    def _lex_range(self, min_, max_):
+        where = ''
+        params = []
+
+        for value, op in ((min_, '>'), (max_, '<')):
+            value = self._enc(value)
+            if value in (b'-', b'+'):
+                continue
+
+            if value.startswith(b'['):
+                op += '='
+            elif not value.startswith(b'('):
+                raise ResponseError('min or max not valid string range item')
+
+            where += ' AND member {0} ?'.format(op)
+            params.append(value[1:])
+
+        return where, params
+
+    def zrangebylex(self, name, min, max, start=None, num=None):
+        where, params = self._lex_range(min, max)
+        return self._zquery(name, where, params, start=start, num=num, order='member')
+
+    def zrevrangebylex(self, name, max, min, start=None, num=None):
+        where, params = self._lex_range(min, max)
+        return self._zquery(name, where, params, desc=True, start=start, num=num, order='member')
+
+    def zlexcount(self, name, min, max):
+        return len(self.zrangebylex(name, min, max))
+
+    def zremrangebylex(self, name, min, max):
+        members = self.zrangebylex(name, min, max)
+        return self.zrem(name, *members) if members else 0
+
+    def zscan_iter(self, name, match=None, count=None, score_cast_func=float):
+        for member, score in self._zquery(name, withscores=True, order='member',
+                                          score_cast_func=score_cast_func):
+            if match and not _glob_match(match, member):
+                continue
+
+            yield member, score
+
+    # Lists
+    def _push(self, name, values, left):
+        name = self._key(name)
+        with self.store.transaction() as conn:
+            self._create(name, 'list')
+            agg = 'MIN' if left else 'MAX'
+            pos = conn.execute('SELECT {0}(pos) FROM lists WHERE db = ? AND key = ?'.format(agg),
+                               (self.db, name)).fetchone()[0] or 0
+
+            for value in values:
+                pos += -1 if left else 1
+                conn.execute('INSERT INTO lists (db, key, pos, value) VALUES (?, ?, ?, ?)',
+                             (self.db, name, pos, self._enc(value)))
+
+        self.store.notify_list_push()
+        return self.llen(name)
+
+    def lpush(self, name, *values):
+        return self._push(name, values, left=True)
+
+    def rpush(self, name, *values):
+        return self._push(name, values, left=False)
+
+    def _pop(self, name, left):
+        name = self._key(name)
+        if not self._check_type(name, 'list'):
+            return None
+
+        with self.store.transaction() as conn:
+            order = 'ASC' if left else 'DESC'
+            pos, value = conn.execute('SELECT pos, value FROM lists WHERE db = ? AND key = ? ' +
+                                      'ORDER BY pos {0} LIMIT 1'.format(order),
+                                      (self.db, name)).fetchone()
+
+            conn.execute('DELETE FROM lists WHERE db = ? AND key = ? AND pos = ?',
+                         (self.db, name, pos))
+
+            self._remove_if_empty(name, 'list')
+
+        return self._dec(value)
+
+    def lpop(self, name):
+        return self._pop(name, left=True)
+
+    def rpop(self, name):
+        return self._pop(name, left=False)
+
+    def _bpop(self, keys, timeout, left):
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+
+        end_time = time.time() + timeout if timeout else None
+
+        while True:
+            event = self.store.list_pushed
+
+            for key in keys:
+                value = self._pop(key, left)
+                if value is not None:
+                    return (self._dec(self._enc(key)), value)
+
+            if end_time is None:
+                event.wait()
+            else:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return None
+
+                event.wait(remaining)
+
+    def blpop(self, keys, timeout=0):
+        return self._bpop(keys, timeout, left=True)
+
+    def brpop(self, keys, timeout=0):
+        return self._bpop(keys, timeout, left=False)
+
+    def llen(self, name):
+        name = self._key(name)
+        if not self._check_type(name, 'list'):
+            return 0
+
+        return self.conn.execute('SELECT COUNT(*) FROM lists WHERE db = ? AND key = ?',
+                                 (self.db, name)).fetchone()[0]
+
+    def lrange(self, name, start, end):
+        name = self._key(name)
+        if not self._check_type(name, 'list'):
+            return []
+
+        if start < 0 or end < 0:
+            size = self.llen(name)
+            start = max(start + size if start < 0 else start, 0)
+            end = end + size if end < 0 else end
+
+        if end < start:
+            return []
+
+        cursor = self.conn.execute('SELECT value FROM lists WHERE db = ? AND key = ? ' +
+                                   'ORDER BY pos LIMIT ? OFFSET ?',
+                                   (self.db, name, end - start + 1, start))
+
+        return [self._dec(value) for value, in cursor]
+
+    def lrem(self, name, count, value):
+        name = self._key(name)
+        if not self._check_type(name, 'list'):
+            return 0
+
+        order = 'DESC' if count < 0 else 'ASC'
+        sql = 'SELECT pos FROM lists WHERE db = ? AND key = ? AND value = ? ORDER BY pos ' + order
+        if count:
+            sql += ' LIMIT {0}'.format(abs(int(count)))
+
+        with self.store.transaction() as conn:
+            positions = [pos for pos, in conn.execute(sql, (self.db, name, self._enc(value)))]
+            for pos in positions:
+                conn.execute('DELETE FROM lists WHERE db = ? AND key = ? AND pos = ?',
+                             (self.db, name, pos))
+
+            self._remove_if_empty(name, 'list')
+
+        return len(positions)
+
+    # PubSub
+    def publish(self, channel, message):
+        return self.store.publish(self._enc(channel), self._enc(message))
+
+    def pubsub(self, **kwargs):
+        return SQLiteRedisPubSub(self)
+
+
+# ============================================================================
+class SQLiteRedisPipeline(object):
+    """ Queues commands and runs them in a single sqlite transaction.
+    As in redis-py, commands run immediately after watch() until multi()
+    """
+    def __init__(self, redis_obj):
+        self.redis = redis_obj
+        self.command_stack = []
+        self.watching = False
+
+    def __getattr__(self, name):
+        func = getattr(self.redis, name)
+
+        if self.watching:
+            return func
+
+        def queue(*args, **kwargs):
+            self.command_stack.append((func, args, kwargs))
+            return self
+
+        return queue
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def multi(self):
+        self.watching = False
+
+    def watch(self, *names):
+        self.watching = True
+        return True
+
+    def unwatch(self):
+        self.watching = False
+        return True
+
+    def reset(self):
+        self.command_stack = []
+        self.watching = False
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+        self.reset()
+
+        results = []
+
+        with self.redis.store.transaction():
+            for func, args, kwargs in stack:
+                try:
+                    results.append(func(*args, **kwargs))
+                except ResponseError as e:
+                    if raise_on_error:
+                        raise
+
+                    results.append(e)
+
+        return results
+
+
+# ============================================================================
+class SQLiteRedisPubSub(object):
+    """ In-process PubSub, messages are delivered through a gevent queue
+    """
+    def __init__(self, redis_obj):
+        self.redis = redis_obj
+        self.store = redis_obj.store
+        self.queue = gevent.queue.Queue()
+        self.channels = set()
+
+    @property
+    def subscribed(self):
+        return bool(self.channels)
+
+    def _msg(self, msg):
+        if not msg or not self.redis.decode_responses:
+            return msg
+
+        msg = dict(msg)
+        for name in ('channel', 'data'):
+            if isinstance(msg[name], bytes):
+                msg[name] = msg[name].decode('utf-8')
+
+        return msg
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            channel = self.redis._enc(channel)
+            self.store.channels.setdefault(channel, set()).add(self)
+            self.channels.add(channel)
+
+            self.queue.put({'type': 'subscribe',
+                            'pattern': None,
+                            'channel': channel,
+                            'data': len(self.channels)})
+
+    def unsubscribe(self, *channels):
+        for channel in channels or list(self.channels):
+            channel = self.redis._enc(channel)
+            self.store.channels.get(channel, set()).discard(self)
+            self.channels.discard(channel)
+
+            self.queue.put({'type': 'unsubscribe',
+                            'pattern': None,
+                            'channel': channel,
+                            'data': len(self.channels)})
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        while True:
+            try:
+                msg = self.queue.get(block=bool(timeout), timeout=timeout or None)
+            except gevent.queue.Empty:
+                return None
+
+            if ignore_subscribe_messages and msg['type'] != 'message':
+                continue
+
+            return self._msg(msg)
+
+    def listen(self):
+        while self.subscribed or not self.queue.empty():
+            yield self._msg(self.queue.get())
+
+    def close(self):
+        for channel in self.channels:
+            self.store.channels.get(channel, set()).discard(self)
+
+        self.channels = set()
+
+    reset = close
+
+
+# ============================================================================
+def _glob_match(pattern, value):
+    if isinstance(pattern, bytes):
+        pattern = pattern.decode('utf-8')
+
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+
+    return re.match(_glob_to_regex(pattern), value) is not None
+
+
+def _glob_to_regex(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '*':
+            regex += '.*'
+        elif c == '?':
+            regex += '.'
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end < 0:
+                regex += re.escape(c)
+            else:
+                group = pattern[i + 1:end]
+                if group.startswith('^'):
+                    group = '^' + group[1:].replace('\\', '\\\\')
+                else:
+                    group = group.replace('\\', '\\\\')
+                regex += '[' + group + ']'
+                i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+
+        i += 1
+
+    return regex + '$'
+
+
+# ============================================================================
+def patch_redis(filename, **kwargs):
+    """ Replace redis.StrictRedis with SQLiteRedis clients sharing
+    a store in the given sqlite file
+    """
+    import redis
+
+    SQLiteRedis.store = SQLiteRedisStore(filename, **kwargs)
+    redis.StrictRedis = SQLiteRedis
+
+    return SQLiteRedis.store
@@ -3,9 +3,15 @@ from webrecorder.fullstackrunner import FullStackRunner
 from webrecorder.admin import main as admin_main
 from webrecorder.standalone.assetsutils import patch_bundle
 
-from webrecorder.uploadcontroller import UploadController
+from webrecorder.uploadcontroller import UploadController, UploadParser
 from webrecorder.rec.webrecrecorder import WebRecRecorder
 
+from pywb.warc.cdxindexer import write_cdx_index
+from pywb.cdx.cdxobject import CDXObject
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 from webrecorder.redisman import init_manager_for_cli
@@ -22,6 +28,14 @@ import redis
 
 import argparse
 import atexit
+import bisect
+import gzip
+import hashlib
+import json
+import multiprocessing
+import traceback
+
+import gevent
 
 
 # ============================================================================
@@ -60,6 +74,11 @@ class StandaloneRunner(FullStackRunner):
         atexit.register(self.close)
 
     def _patch_redis(self, redis_db):
+        if redis_db:
+            from webrecorder.standalone.sqliteredis import patch_redis
+            self.redis_store = patch_redis(redis_db)
+            return
+
         import redis
         import fakeredis
         redis.StrictRedis = fakeredis.FakeStrictRedis
@@ -96,6 +115,9 @@ class StandaloneRunner(FullStackRunner):
     def close(self):
         super(StandaloneRunner, self).close()
 
+        if getattr(self, 'redis_store', None):
+            self.redis_store.close()
+
     @classmethod
     def main(cls, args=None):
         parser = ArgumentParser(formatter_class=RawTextHelpFormatter)
@@ -129,10 +151,6 @@ class WebrecorderRunner(StandaloneRunner):
             import webbrowser
             webbrowser.open_new(os.environ['APP_HOST'] + '/')
 
-  #  def _patch_redis(self, redis_db):
-  #      from webrecorder.standalone.hiconn import patch_from_url
-  #      patch_from_url(redis_db)
-
     def init_env(self):
         super(WebrecorderRunner, self).init_env()
         os.environ['WR_USER_CONFIG'] = 'pkg://webrecorder/config/standalone_recorder.yaml'
@@ -161,15 +179,47 @@ class WebrecPlayerRunner(StandaloneRunner):
 
         indexer = WebRecRecorder.make_wr_indexer(manager.config)
 
-        uploader = InplaceUploader(manager, indexer)
+        # in-place archives may contain several recordings,
+        # so per-WARC sizes can't be used to seek in downloads
+        indexer.warc_size_key_templ = None
+
+        self.uploader = InplaceUploader(manager, indexer)
+
+        self.index_status_key = manager.config['player_index_status_key']
 
-        for filename in self.get_archive_files(argres.inputs):
-            with open(filename, 'rb') as stream:
-                uploader.handle_upload(stream, filename, 'local', False)
+        filenames = list(self.get_archive_files(argres.inputs))
+
+        # index in the background, collections can be browsed as they are added
+        self.index_ge = gevent.spawn(self.index_files, filenames,
+                                     argres.index_workers or None,
+                                     not argres.no_index_cache)
 
         if not argres.no_browser:
             import webbrowser
-            webbrowser.open_new(os.environ['APP_HOST'] + '/local/')
+            webbrowser.open_new(os.environ['APP_HOST'] + '/')
+
+    def index_files(self, filenames, num_workers=None, use_cache=True):
+        """ Index archives in worker processes, loading results into redis
+        in the original order, as each is ready
+        """
+        redis = self.uploader.manager.redis
+        redis.hmset(self.index_status_key, {'total': len(filenames), 'indexed': 0})
+
+        cdx_filenames = [self.uploader.indexer.get_rel_filename(filename, {'param.user': 'local'})
+                         for filename in filenames]
+
+        for filename, infos, error in iter_indexed_archives(filenames, cdx_filenames,
+                                                            num_workers, use_cache):
+            try:
+                if error:
+                    raise error
+
+                self.uploader.load_indexed(filename, infos, 'local')
+            except:
+                print('Error indexing ' + filename)
+                traceback.print_exc()
+
+            redis.hincrby(self.index_status_key, 'indexed', 1)
 
     def init_env(self):
         super(WebrecPlayerRunner, self).init_env()
@@ -193,26 +243,90 @@ class WebrecPlayerRunner(StandaloneRunner):
     def add_args(cls, parser):
         parser.add_argument('inputs', nargs='+')
 
+        parser.add_argument('--index-workers', type=int,
+                            default=0,
+                            help='Number of processes for indexing archives (default: number of cpus)')
+
+        parser.add_argument('--no-index-cache', action='store_true',
+                            default=False,
+                            help="Don't read or write index cache files next to each archive")
+
 
 # ============================================================================
 class InplaceUploader(UploadController):
     def __init__(self, manager, indexer):
         super(InplaceUploader, self).__init__(None, None, manager, manager.config)
         self.indexer = indexer
+        self.indexed_cdx = {}
 
     def init_routes(self):
         pass
 
-    def do_upload(self, filename, stream, user, coll, rec, offset, length):
-        stream.seek(offset)
+    def load_indexed(self, filename, infos, user):
+        """ Add collections and recordings from infos, with CDXJ
+        already generated by index_archive_file()
+        """
+        for info in infos:
+            if 'cdx' in info:
+                self.indexed_cdx[(filename, info['offset'])] = info.pop('cdx')
+
+        try:
+            for coll, rec in self.process_upload(user, infos, filename):
+                pass
+        finally:
+            self.indexed_cdx.clear()
+
+    def process_upload(self, user, infos, filename):
+        collection = None
+        recording = None
+
+        for info in infos:
+            type = info.get('type')
 
+            if type == 'collection':
+                collection = self._create_collection(user, info)
+
+            elif type == 'recording':
+                if not collection:
+                    collection = self.default_collection(user, filename)
+
+                recording = self._create_recording(user, collection, info)
+
+                yield collection, recording
+
+                self.do_upload(filename,
+                               user,
+                               collection['id'],
+                               recording['id'],
+                               recording['offset'],
+                               recording['length'])
+
+                self.finish_recording(user, collection, recording)
+
+    def do_upload(self, filename, user, coll, rec, offset, length):
         params = {'param.user': user,
                   'param.coll': coll,
-                  'param.rec': rec
+                  'param.rec': rec,
+                  'param.detect_pages': '1'
                  }
 
+        cdx_list = self.indexed_cdx.pop((filename, offset), None)
+
+        # not pre-indexed, index the whole archive once and bulk load
+        # each recording's lines, rather than adding line by line
+        if cdx_list is None:
+            self.index_archive(filename, params)
+            cdx_list = self.indexed_cdx.pop((filename, offset), [])
+
         self.indexer.add_warc_file(filename, params)
-        self.indexer.add_urls_to_index(stream, params, filename, length)
+        self.indexer.add_cdxj(cdx_list, params, filename, length)
+
+    def index_archive(self, filename, params):
+        cdx_filename = self.indexer.get_rel_filename(filename, params)
+
+        for info in index_archive_file(filename, cdx_filename):
+            if 'cdx' in info:
+                self.indexed_cdx[(filename, info['offset'])] = info['cdx']
 
     def _get_existing_coll(self, user, info):
         # if enabled, force all 'Temporary Collection' into one collection?
@@ -244,10 +358,201 @@ class InplaceUploader(UploadController):
         return collection
 
 
+# ============================================================================
+INDEX_POLL_SECS = 0.1
+
+
+def iter_indexed_archives(filenames, cdx_filenames, num_workers=None, use_cache=True):
+    """ Yield (filename, infos, error) for each archive, in order, as each
+    is indexed. Archives unchanged since last indexed are loaded from the
+    index cache
+
+    The process pool runs in a real thread, not a greenlet, as it blocks
+    on its workers. Only the results are passed back, so redis is only
+    used from the calling greenlet
+    """
+    results = [None] * len(filenames)
+
+    pool = gevent.get_hub().threadpool.spawn(run_index_pool, filenames, cdx_filenames,
+                                             num_workers, use_cache, results)
+
+    for i, filename in enumerate(filenames):
+        # set by the pool thread
+        while results[i] is None and not pool.ready():
+            gevent.sleep(INDEX_POLL_SECS)
+
+        if results[i] is None:
+            pool.get()
+            results[i] = (None, Exception('Not indexed'))
+
+        infos, error = results[i]
+        results[i] = False
+
+        yield filename, infos, error
+
+    # wait for the pool to shut down
+    pool.get()
+
+
+def run_index_pool(filenames, cdx_filenames, num_workers, use_cache, results):
+    """ Index archives in a process pool, setting results[i] to
+    (infos, error) for each archive as it is ready
+    """
+    pending = []
+
+    for i, (filename, cdx_filename) in enumerate(zip(filenames, cdx_filenames)):
+        infos = load_index_cache(filename, cdx_filename) if use_cache else None
+        if infos is not None:
+            results[i] = (infos, None)
+        else:
+            pending.append(i)
+
+    if not pending:
+        return
+
+    # spawn rather than fork, as gevent only tracks forked children
+    # from the main thread
+    mp_context = multiprocessing.get_context('spawn')
+
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context) as executor:
+        futures = [executor.submit(index_archive_file, filenames[i], cdx_filenames[i], use_cache)
+                   for i in pending]
+
+        for i, future in zip(pending, futures):
+            try:
+                results[i] = (future.result(), None)
+            except Exception as e:
+                results[i] = (None, e)
+
+
+# ============================================================================
+def index_archive_file(filename, cdx_filename, use_cache=False):
+    """ Parse and CDXJ-index one archive, run in an indexing worker process
+
+    Returns the collection and recording infos, each recording
+    with the CDXJ lines for the records it contains
+    """
+    with open(filename, 'rb') as fh:
+        infos = UploadParser().parse_uploaded(fh)
+
+        fh.seek(0)
+        cdxout = BytesIO()
+        write_cdx_index(cdxout, fh, cdx_filename, cdxj=True, append_post=True)
+
+    recordings = [info for info in infos if info.get('type') == 'recording']
+    starts = [info['offset'] for info in recordings]
+
+    for info in recordings:
+        info['cdx'] = []
+
+    for cdx in cdxout.getvalue().rstrip().split(b'\n'):
+        if not cdx:
+            continue
+
+        offset = int(CDXObject(cdx)['offset'])
+
+        i = bisect.bisect_right(starts, offset) - 1
+        if i >= 0 and offset < starts[i] + recordings[i]['length']:
+            recordings[i]['cdx'].append(cdx)
+
+    # sort here, in the worker, for bulk loading
+    for info in recordings:
+        info['cdx'].sort()
+
+    if use_cache:
+        save_index_cache(filename, cdx_filename, infos)
+
+    return infos
+
+
+# ============================================================================
+INDEX_CACHE_EXT = '.wrindex.gz'
+INDEX_CACHE_VERSION = 1
+FINGERPRINT_BLOCK_SIZE = 65536
+
+
+def get_file_fingerprint(filename):
+    """ Identify archive by path, size, mtime and hash of first and last blocks
+    """
+    stat = os.stat(filename)
+
+    digest = hashlib.sha1()
+
+    with open(filename, 'rb') as fh:
+        digest.update(fh.read(FINGERPRINT_BLOCK_SIZE))
+
+        if stat.st_size > FINGERPRINT_BLOCK_SIZE:
+            fh.seek(max(stat.st_size - FINGERPRINT_BLOCK_SIZE, FINGERPRINT_BLOCK_SIZE))
+            digest.update(fh.read(FINGERPRINT_BLOCK_SIZE))
+
+    return {'path': os.path.abspath(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': digest.hexdigest()}
+
+
+def load_index_cache(filename, cdx_filename):
+    """ Return infos from index cache, if the archive is unchanged since cached
+    """
+    try:
+        with gzip.open(filename + INDEX_CACHE_EXT, 'rt') as fh:
+            data = json.load(fh)
+
+        if (data.get('version') != INDEX_CACHE_VERSION or
+            data.get('cdx_filename') != cdx_filename or
+            data.get('fingerprint') != get_file_fingerprint(filename)):
+            return None
+
+    except (IOError, OSError, ValueError):
+        return None
+
+    infos = data['infos']
+    for info in infos:
+        if 'cdx' in info:
+            info['cdx'] = [cdx.encode('utf-8') for cdx in info['cdx']]
+
+    return infos
+
+
+def save_index_cache(filename, cdx_filename, infos):
+    """ Write index cache next to the archive, skipped if not writable
+    """
+    cache_infos = []
+    for info in infos:
+        info = dict(info)
+        if 'cdx' in info:
+            info['cdx'] = [cdx.decode('utf-8') for cdx in info['cdx']]
+
+        cache_infos.append(info)
+
+    data = {'version': INDEX_CACHE_VERSION,
+            'cdx_filename': cdx_filename,
+            'fingerprint': get_file_fingerprint(filename),
+            'infos': cache_infos}
+
+    cache_filename = filename + INDEX_CACHE_EXT
+    temp_filename = cache_filename + '.tmp'
+
+    try:
+        with gzip.open(temp_filename, 'wt') as fh:
+            json.dump(data, fh)
+
+        os.replace(temp_filename, cache_filename)
+
+    except (IOError, OSError) as e:
+        print('Unable to write index cache for {0}: {1}'.format(filename, e))
+
+
 # ============================================================================
 # cli scripts
 webrecorder = WebrecorderRunner.main
-webrecorder_player = WebrecPlayerRunner.main
+
+
+def webrecorder_player(args=None):
+    # needed for indexing worker processes in frozen builds,
+    # which start by running this entry point again
+    multiprocessing.freeze_support()
+    WebrecPlayerRunner.main(args)
 
 
 # ============================================================================
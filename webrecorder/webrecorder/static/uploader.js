@@ -26,78 +26,186 @@ $(function() {
     var uploader = $(".upload-progress");
 
     var currXhr = undefined;
+    var currUser = undefined;
       
-    $('#upload-form').ajaxForm({
-        beforeSerialize: function() {
-            var force_coll;
-
-            if ($("#upload-add").is(":checked")) {
-                force_coll = $("#upload-coll").attr("data-collection-id");
-            } else {
-                force_coll = "";
-            }
+    function beforeSend() {
+        status.text("Uploading...");
 
-            $("#force-coll").val(force_coll);
-        },
+        var percentVal = '0%';
+        bar.width(percentVal)
+        percent.html(percentVal);
 
-        beforeSend: function(xhr, settings) {
-            status.text("Uploading...");
+        $("body").css("cursor", "wait");
 
-            var percentVal = '0%';
-            bar.width(percentVal)
-            percent.html(percentVal);
+        $("#upload-modal button").prop("disabled", true);
 
-            currXhr = xhr;
+        $("#upload-modal button.upload-cancel").prop("disabled", false);
+        $("#upload-modal button.upload-cancel").text("Cancel Upload");
 
-            $("body").css("cursor", "wait");
+        uploader.show();
+        status.show();
+        status.removeClass("upload-error");
+    }
+
+    function uploadProgress(event) {
+        if (!event.lengthComputable) {
+            return;
+        }
+
+        var percentVal = Math.round(event.loaded * 100 / event.total) + '%';
+        bar.width(percentVal)
+        percent.html(percentVal);
+        if (percentVal == "100%") {
+            status.text("Processing...");
+            $("#upload-modal button.upload-cancel").prop("disabled", true);
+        }
+    }
+
+    function complete(xhr) {
+        $("#upload-modal button").prop("disabled", false);
+        $("body").css("cursor", "inherit");
+
+        var data = undefined;
+
+        try {
+            data = JSON.parse(xhr.responseText);
+        } catch (e) {
+        }
+
+        if (data && data.uploaded && data.user && data.coll) {
+            RouteTo.collectionInfo(data.user, data.coll);
+            return;
+        }
 
+        if (data && data.upload_id) {
+            currUser = data.user;
+            status.text("Processing...");
             $("#upload-modal button").prop("disabled", true);
+            $("body").css("cursor", "wait");
+            watchUpload(data.upload_id);
+            return;
+        }
 
-            $("#upload-modal button.upload-cancel").prop("disabled", false);
-            $("#upload-modal button.upload-cancel").text("Cancel Upload");
+        var message = "Upload Status Missing";
 
-            uploader.show();
-            status.show();
-            status.removeClass("upload-error");
-
-        },
-        uploadProgress: function(event, position, total, percentComplete) {
-            var percentVal = percentComplete + '%';
-            bar.width(percentVal)
-            percent.html(percentVal);
-            if (percentVal == "100%") {
-                status.text("Processing...");
-                $("#upload-modal button.upload-cancel").prop("disabled", true);
-            }
-        },
+        if (data && data.error_message) {
+            message = data.error_message;
+        }
+
+        status.text(message);
+        status.addClass("upload-error");
+        currXhr = undefined;
+    }
 
-        success: function() {
-            var percentVal = '100%';
-            bar.width(percentVal)
-            percent.html(percentVal);
-        },
+    // show upload progress, returns true once the upload is done or failed
+    function updateUpload(data) {
+        if (data.status == "done") {
+            RouteTo.collectionInfo(currUser, data.coll);
+            return true;
+        }
+
+        if (data.status == "error" || data.ws_type == "error") {
+            complete({"responseText": JSON.stringify(data)});
+            return true;
+        }
 
-        complete: function(xhr) {
-            $("#upload-modal button").prop("disabled", false);
-            $("body").css("cursor", "inherit");
+        var percentVal = (data.size ? Math.round(data.bytes * 100 / data.size) : 0) + '%';
+        bar.width(percentVal);
+        percent.html(percentVal);
 
-            data = xhr.responseJSON;
+        status.text("Processing... " + data.recordings + " recording(s), " + data.records + " record(s)");
+        return false;
+    }
 
-            if (data && data.uploaded && data.user && data.coll) {
-                RouteTo.collectionInfo(data.user, data.coll);
+    // upload is processed in the background, progress is pushed over a websocket
+    function watchUpload(upload_id) {
+        var url = window.location.protocol == "https:" ? "wss://" : "ws://";
+        url += window.location.host + "/_client_ws?" + $.param({"upload_id": upload_id});
+
+        var finished = false;
+        var ws;
+
+        function ws_closed() {
+            if (!finished) {
+                finished = true;
+                checkUpload(upload_id);
+            }
+        }
+
+        try {
+            ws = new WebSocket(url);
+        } catch (e) {
+            checkUpload(upload_id);
+            return;
+        }
+
+        ws.addEventListener("message", function(event) {
+            if (finished) {
                 return;
             }
 
-            var message = "Upload Status Missing";
+            var data = JSON.parse(event.data);
+            if (data.ws_type == "upload" || data.ws_type == "error") {
+                if (updateUpload(data)) {
+                    finished = true;
+                    ws.close();
+                }
+            }
+        });
+
+        ws.addEventListener("close", ws_closed);
+        ws.addEventListener("error", ws_closed);
+    }
 
-            if (data.error_message) {
-                message = data.error_message;
+    // fallback if no websocket, check on progress until done
+    function checkUpload(upload_id) {
+        $.getJSON("/api/v1/upload/" + upload_id).done(function(data) {
+            if (!updateUpload(data)) {
+                setTimeout(function() { checkUpload(upload_id); }, 1000);
             }
 
-            status.text(message);
-            status.addClass("upload-error");
-            currXhr = undefined;
+        }).fail(function() {
+            complete({"responseText": ""});
+        });
+    }
+
+    // send the file as the raw request body, so it can be processed as it arrives
+    $('#upload-form').on('submit', function(event) {
+        event.preventDefault();
+
+        var file = $("#choose-upload-file")[0].files[0];
+
+        if (!file) {
+            return;
         }
+
+        var force_coll;
+
+        if ($("#upload-add").is(":checked")) {
+            force_coll = $("#upload-coll").attr("data-collection-id");
+        } else {
+            force_coll = "";
+        }
+
+        $("#force-coll").val(force_coll);
+
+        var url = "/_upload?" + $.param({"filename": file.name, "force-coll": force_coll});
+
+        var xhr = new XMLHttpRequest();
+
+        xhr.upload.addEventListener("progress", uploadProgress);
+
+        xhr.addEventListener("loadend", function() {
+            complete(xhr);
+        });
+
+        xhr.open("PUT", url, true);
+        xhr.setRequestHeader("Content-Type", "application/octet-stream");
+
+        currXhr = xhr;
+        beforeSend();
+
+        xhr.send(file);
     });
 
     $("#upload-modal").on('show.bs.modal', function() {
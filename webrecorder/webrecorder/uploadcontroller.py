@@ -1,33 +1,132 @@
 from webrecorder.basecontroller import BaseController
-from tempfile import SpooledTemporaryFile
 from bottle import request
 
 from pywb.warc.archiveiterator import ArchiveIterator
 from pywb.utils.loaders import LimitReader
-from pywb.cdx.cdxobject import CDXObject
+
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+
+import gevent
 
 import traceback
 import json
 import requests
+import redis
+import time
+import uuid
+import os
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 BLOCK_SIZE = 16384 * 8
-EMPTY_DIGEST = '3I42H3S6NNFQ2MSVX7XZKYAYSCX5QBYJ'
+UPLOAD_BATCH_SIZE = 16 * 1024 * 1024
+UPLOAD_MAX_BUFF_SIZE = 2 * UPLOAD_BATCH_SIZE
 
 # ============================================================================
-class UploadController(BaseController):
+class UploadParser(object):
+    """ Split an archive into collection and recording infos at warcinfo
+    records. No app state, so can also be used in indexing worker processes
+    """
+    def parse_uploaded(self, stream):
+        arciterator = ArchiveIterator(stream, no_record_parse=True, verify_http=True)
+        infos = []
+
+        last_indexinfo = None
+        indexinfo = None
+        is_first = True
+
+        for record in arciterator(BLOCK_SIZE):
+            warcinfo = None
+            if record.rec_type == 'warcinfo':
+                try:
+                    warcinfo = self.parse_warcinfo(record)
+                except Exception as e:
+                    print('Error Parsing WARCINFO')
+                    traceback.print_exc()
+
+            arciterator.read_to_end(record)
+
+            if warcinfo:
+                new_offset = self.add_index_info(infos, indexinfo, arciterator)
+
+                indexinfo = warcinfo.get('json-metadata')
+
+                indexinfo['offset'] = new_offset
+                if 'title' not in indexinfo:
+                    indexinfo['title'] = 'Uploaded Recording'
+
+                if 'type' not in indexinfo:
+                    indexinfo['type'] = 'recording'
+
+            elif is_first:
+                indexinfo = {'type': 'recording',
+                             'title': 'Uploaded Recording',
+                             'offset': 0,
+                            }
+
+            is_first = False
+
+        if indexinfo:
+            self.add_index_info(infos, indexinfo, arciterator)
+
+        return infos
+
+    def add_index_info(self, infos, indexinfo, arciterator):
+        new_offset = arciterator.member_info[0] + arciterator.member_info[1]
+        if indexinfo:
+            indexinfo['length'] = new_offset - indexinfo['offset']
+            infos.append(indexinfo)
+
+        return new_offset
+
+    def parse_warcinfo(self, record):
+        valid = False
+        warcinfo = {}
+        warcinfo_buff = record.stream.read(record.length)
+        warcinfo_buff = warcinfo_buff.decode('utf-8')
+        for line in warcinfo_buff.rstrip().split('\n'):
+            parts = line.split(':', 1)
+
+            if parts[0] == 'json-metadata':
+                warcinfo['json-metadata'] = json.loads(parts[1])
+                valid = True
+            else:
+                warcinfo[parts[0]] = parts[1].strip()
+
+        # ignore if no json-metadata or doesn't contain type of colleciton or recording
+        return warcinfo if valid else None
+
+
+# ============================================================================
+class UploadController(UploadParser, BaseController):
+    # request environ kept for upload jobs, for the host of any urls
+    JOB_ENVIRON = ('HTTP_HOST', 'HTTP_X_FORWARDED_HOST', 'HTTP_X_FORWARDED_PROTO',
+                   'SERVER_NAME', 'SERVER_PORT', 'SCRIPT_NAME', 'wsgi.url_scheme')
+
     def __init__(self, app, jinja_env, manager, config):
         super(UploadController, self).__init__(app, jinja_env, manager, config)
         self.upload_path = config['url_templates']['upload']
-        self.cdxj_key = config['cdxj_key_templ']
+        self.detected_pages_key = config['detected_pages_key_templ']
+
+        self.upload_status_key = config['upload_status_key_templ']
+        self.upload_status_ttl = int(config['upload_status_ttl'])
+        self.upload_temp_dir = config['upload_temp_dir'] or None
+
+        self.upload_jobs = UploadJobQueue(manager.redis,
+                                          config['upload_queue_key'],
+                                          config['upload_jobs_key'],
+                                          int(config['upload_lease_secs']),
+                                          float(config['upload_poll_secs']),
+                                          int(config['upload_workers']),
+                                          self.run_upload_job,
+                                          self.fail_upload_job)
 
     def init_routes(self):
         @self.app.post('/_upload')
         def upload_file():
-            stream = None
             upload = None
 
             try:
@@ -36,222 +135,425 @@ class UploadController(BaseController):
                 if not upload:
                     return {'error_message': 'No File Specified'}
 
-                curr_user = self.manager.get_curr_user()
+                force_coll = request.forms.getunicode('force-coll', '')
 
-                if not curr_user:
-                    #user = self.manager.get_anon_user()
-                    #force_coll = 'temp'
-                    #is_anon = True
+                # size of the whole form, close enough for the space check
+                expected_size = request.content_length
 
-                    return {'error_message': 'Sorry, uploads only available for logged-in users'}
+                return self.upload_stream(upload.file, upload.filename,
+                                          expected_size, force_coll)
 
-                user = curr_user
-                force_coll = request.forms.getunicode('force-coll', '')
-                is_anon = False
+            finally:
+                if upload:
+                    upload.file.close()
 
-                if force_coll and not self.manager.has_collection(user, force_coll):
-                    if is_anon:
-                        self.manager.create_collection(user, force_coll, 'Temporary Collection')
+        @self.app.put('/_upload')
+        def upload_file_put():
+            filename = request.query.getunicode('filename')
 
-                    else:
-                        status = 'Collection {0} not found'.format(force_coll)
-                        return {'error_message': status}
+            if not filename:
+                return {'error_message': 'No File Specified'}
 
-                stream = SpooledTemporaryFile(max_size=BLOCK_SIZE)
+            force_coll = request.query.getunicode('force-coll', '')
 
-                logger.debug('Upload Start, Saving')
+            expected_size = request.content_length
+            if expected_size < 0:
+                return {'error_message': 'Content-Length required'}
 
-                upload.save(stream)
+            return self.queue_upload(request.environ['wsgi.input'], filename,
+                                     expected_size, force_coll)
 
-                size_rem = self.manager.get_size_remaining(user)
+        @self.app.get('/api/v1/upload/<upload_id>')
+        def get_upload_status(upload_id):
+            user = self.manager.get_curr_user()
 
-                logger.debug('Size Rem: ' + str(size_rem))
+            status = self.get_upload_status(user, upload_id).get()
+            if not status:
+                self._raise_error(404, 'Upload not found', api=True,
+                                  id=upload_id)
 
-                expected_size = stream.tell()
+            return status
 
-                logger.debug('Expected Size: ' + str(expected_size))
+    def get_upload_status(self, user, upload_id):
+        key = self.upload_status_key.format(user=user, upid=upload_id)
+        return UploadStatus(self.manager.redis, key, self.upload_status_ttl)
 
-                if size_rem < expected_size:
-                    return {'error_message': 'Sorry, not enough space to upload this file'}
+    def check_upload(self, user, expected_size, force_coll):
+        """ Return error message if the upload can not be accepted
 
-                filename = upload.filename
+        Access is only checked here, the upload is then processed
+        for user without a session, as it may run after the request
+        """
+        if not user or not self.manager.is_owner(user):
+            return 'Sorry, uploads only available for logged-in users'
 
-                logger.debug('Filename: ' + filename)
+        if force_coll and not self.manager.has_collection(user, force_coll):
+            return 'Collection {0} not found'.format(force_coll)
 
-                new_coll, error_message = self.handle_upload(stream, filename, user, force_coll)
+        size_rem = self.manager.get_size_remaining(user)
 
-                if new_coll:
-                    msg = 'Uploaded file <b>{1}</b> into collection <b>{0}</b>'.format(new_coll['title'], filename)
+        logger.debug('Size Rem: ' + str(size_rem))
+        logger.debug('Expected Size: ' + str(expected_size))
 
-                    self.flash_message(msg, 'success')
+        if size_rem < expected_size:
+            return 'Sorry, not enough space to upload this file'
 
-                    return {'uploaded': 'true',
-                            'user': user,
-                            'coll': new_coll['id']}
+    def queue_upload(self, stream, filename, expected_size, force_coll):
+        """ Save upload to a temp file and queue for processing,
+        returning the upload id to check progress
 
-                else:
-                    print(error_message)
-                    return {'error_message': error_message}
+        The upload is spooled to disk rather than processed as it arrives,
+        so the request ends once the upload is received, and the job can
+        be run after a restart. This costs a temp copy of the upload on
+        disk and a second read, but memory use is still bounded, as the
+        job streams the file in a single pass
+        """
+        temp_file = None
 
-            except Exception as e:
-                traceback.print_exc()
-                return {'error_message': str(e)}
+        try:
+            user = self.manager.get_curr_user()
 
-            finally:
-                if upload:
-                    upload.file.close()
+            error_message = self.check_upload(user, expected_size, force_coll)
+            if error_message:
+                return {'error_message': error_message}
+
+            upload_id = uuid.uuid4().hex
+
+            with NamedTemporaryFile(prefix='upload-', dir=self.upload_temp_dir,
+                                    delete=False) as temp_file:
+                remaining = expected_size
+                while remaining > 0:
+                    buff = stream.read(min(BLOCK_SIZE, remaining))
+                    if not buff:
+                        break
+
+                    temp_file.write(buff)
+                    remaining -= len(buff)
+
+            if remaining > 0:
+                os.remove(temp_file.name)
+                return {'error_message': 'Upload Incomplete'}
+
+            self.get_upload_status(user, upload_id).init(filename, expected_size)
 
-                if stream:
-                    stream.close()
+            # processed after this request ends, keep host for urls
+            environ = dict((name, request.environ[name]) for name in self.JOB_ENVIRON
+                           if name in request.environ)
 
-    def handle_upload(self, stream, filename, user, force_coll):
-        stream.seek(0)
-        total = 0
+            self.upload_jobs.put(upload_id, {'upload_id': upload_id,
+                                             'temp_filename': temp_file.name,
+                                             'filename': filename,
+                                             'user': user,
+                                             'force_coll': force_coll,
+                                             'environ': environ})
 
-        logger.debug('handle_upload() begin to: ' + filename + ' force_coll: ' + str(force_coll))
+            return {'upload_id': upload_id,
+                    'user': user}
+
+        except Exception as e:
+            traceback.print_exc()
+            if temp_file:
+                try:
+                    os.remove(temp_file.name)
+                except OSError:
+                    pass
+
+            return {'error_message': str(e)}
+
+    def run_upload_job(self, job):
+        upload_id = job['upload_id']
+        temp_filename = job['temp_filename']
+        filename = job['filename']
+        user = job['user']
+        force_coll = job['force_coll']
+
+        # access checked when queued, environ is only for the host of any urls
+        request.bind(job['environ'])
+
+        status = self.get_upload_status(user, upload_id)
+        status.update(force=True, status='processing')
 
         try:
-            infos = self.parse_uploaded(stream)
-            total = len(infos)
-            # first info is for collection, not recording
-            if total >= 2:
-                total -= 1
-            logger.debug('Parsed {0} recordings'.format(total))
-        except:
+            with open(temp_filename, 'rb') as stream:
+                new_coll, error_message = self.handle_stream_upload(stream, filename,
+                                                                    user, force_coll,
+                                                                    status=status)
+
+            if new_coll:
+                status.update(force=True, status='done', coll=new_coll['id'],
+                              coll_title=new_coll['title'])
+            else:
+                print(error_message)
+                status.update(force=True, status='error', error_message=error_message)
+
+        except Exception as e:
             traceback.print_exc()
-            return (None, 'Invalid Web Archive (Parsing Error)')
+            status.update(force=True, status='error', error_message=str(e))
+
+        finally:
+            os.remove(temp_filename)
+
+    def fail_upload_job(self, job, error_message):
+        status = self.get_upload_status(job['user'], job['upload_id'])
+        status.update(force=True, status='error', error_message=error_message)
+
+        try:
+            os.remove(job['temp_filename'])
+        except OSError:
+            pass
+
+    def upload_stream(self, stream, filename, expected_size, force_coll):
+        try:
+            user = self.manager.get_curr_user()
+
+            error_message = self.check_upload(user, expected_size, force_coll)
+            if error_message:
+                return {'error_message': error_message}
+
+            logger.debug('Filename: ' + filename)
+
+            new_coll, error_message = self.handle_stream_upload(stream, filename, user, force_coll)
+
+            if new_coll:
+                msg = 'Uploaded file <b>{1}</b> into collection <b>{0}</b>'.format(new_coll['title'], filename)
+
+                self.flash_message(msg, 'success')
+
+                return {'uploaded': 'true',
+                        'user': user,
+                        'coll': new_coll['id']}
+
+            else:
+                print(error_message)
+                return {'error_message': error_message}
+
+        except Exception as e:
+            traceback.print_exc()
+            return {'error_message': str(e)}
+
+    def _create_collection(self, user, info):
+        collection = self._get_existing_coll(user, info)
+        if collection:
+            return collection
+
+        collection = info
+        collection['id'] = self.sanitize_title(collection['title'])
+        actual_collection = self.manager.create_collection(user,
+                                       collection['id'],
+                                       collection['title'],
+                                       collection.get('desc', ''),
+                                       collection.get('public', False),
+                                       access_check=False)
+
+        collection['id'] = actual_collection['id']
+        collection['title'] = actual_collection['title']
+        return collection
 
-        stream.seek(0)
+    def _create_recording(self, user, collection, info):
+        recording = info
+        recording['id'] = self.sanitize_title(recording['title'])
+        actual_recording = self.manager.create_recording(user,
+                                      collection['id'],
+                                      recording['id'],
+                                      recording['title'],
+                                      collection['title'],
+                                      access_check=False)
+
+        recording['id'] = actual_recording['id']
+        recording['title'] = actual_recording['title']
+        return recording
+
+    def finish_recording(self, user, collection, recording):
+        self.manager.set_recording_timestamps(user,
+                                              collection['id'],
+                                              recording['id'],
+                                              recording.get('created_at'),
+                                              recording.get('updated_at'),
+                                              access_check=False)
 
+        # always read, to clear pages detected while indexing
+        detected_pages = self.detect_pages(user, collection['id'], recording['id'])
+
+        pages = recording.get('pages')
+        if pages is None:
+            pages = detected_pages
+
+        if pages:
+            self.manager.import_pages(user, collection['id'], recording['id'], pages,
+                                      access_check=False)
+
+    def handle_stream_upload(self, stream, filename, user, force_coll, status=None):
+        """ Parse and upload in a single pass over the stream,
+        forwarding each recording in batches as it is read
+        """
         count = 0
 
         first_coll = None
 
+        logger.debug('handle_stream_upload() begin to: ' + filename + ' force_coll: ' + str(force_coll))
+
         try:
-            for coll, rec in self.process_upload(user, force_coll, infos, stream, filename):
+            for coll, rec in self.process_stream_upload(user, force_coll, stream, filename,
+                                                        status=status):
                 count += 1
-                logger.debug('Processing Upload Rec {0} of {1}'.format(count, total))
+                logger.debug('Processing Upload Rec {0}'.format(count))
                 if not first_coll:
                     first_coll = coll
 
         except:
             traceback.print_exc()
+            if not first_coll:
+                return (None, 'Invalid Web Archive (Parsing Error)')
+
             return (None, 'Processing Error')
 
+        if not first_coll:
+            return (None, 'Invalid Web Archive (Parsing Error)')
+
         return (first_coll, None)
 
-    def process_upload(self, user, force_coll, infos, stream, filename):
+    def process_stream_upload(self, user, force_coll, stream, filename, status=None):
         collection = None
         recording = None
+        num_records = 0
+        num_recordings = 0
 
         if force_coll:
-            collection = self.manager.get_collection(user, force_coll)
+            collection = self.manager.get_collection(user, force_coll,
+                                                     access_check=False)
+
+        reader = UploadReader(stream)
+
+        def send_upload(upload, length):
+            self.put_upload(upload, user, collection['id'], recording['id'], length)
+
+        # start of bytes not yet sent for current recording
+        pending = 0
+
+        for info, offset, length in self.iter_upload_infos(reader):
+            end = offset + length
+
+            if length:
+                num_records += 1
+
+            if status:
+                status.update(bytes=reader.tell(),
+                              records=num_records,
+                              recordings=num_recordings)
+
+            # another record for the current slice
+            if not info:
+                if not recording:
+                    reader.discard(end)
+                    pending = end
+
+                elif end - pending >= UPLOAD_BATCH_SIZE:
+                    reader.send(pending, end, send_upload)
+                    reader.discard(end)
+                    pending = end
+
+                continue
+
+            # new slice after this record, finish the current one
+            if recording:
+                if end > pending:
+                    reader.send(pending, end, send_upload)
 
-        for info in infos:
-            type = info.get('type')
+                self.finish_recording(user, collection, recording)
+                recording = None
 
-            if type == 'collection':
+            reader.discard(end)
+            pending = end
+
+            if info.get('type') == 'collection':
                 if not force_coll:
-                    collection = self._get_existing_coll(user, info)
+                    collection = self._create_collection(user, info)
 
-                if not collection:
-                    collection = info
-                    collection['id'] = self.sanitize_title(collection['title'])
-                    actual_collection = self.manager.create_collection(user,
-                                                   collection['id'],
-                                                   collection['title'],
-                                                   collection.get('desc', ''),
-                                                   collection.get('public', False))
-
-                    collection['id'] = actual_collection['id']
-                    collection['title'] = actual_collection['title']
-
-            elif type == 'recording':
+            elif info.get('type') == 'recording':
                 if not collection:
                     collection = self.default_collection(user, filename)
 
-                recording = info
-                recording['id'] = self.sanitize_title(recording['title'])
-                actual_recording = self.manager.create_recording(user,
-                                              collection['id'],
-                                              recording['id'],
-                                              recording['title'],
-                                              collection['title'])
-
-                recording['id'] = actual_recording['id']
-                recording['title'] = actual_recording['title']
+                recording = self._create_recording(user, collection, info)
+                num_recordings += 1
 
                 yield collection, recording
 
-                self.do_upload(filename,
-                               stream,
-                               user,
-                               collection['id'],
-                               recording['id'],
-                               recording['offset'],
-                               recording['length'])
+        if status:
+            status.update(force=True,
+                          bytes=reader.tell(),
+                          records=num_records,
+                          recordings=num_recordings)
 
-                self.manager.set_recording_timestamps(user,
-                                                      collection['id'],
-                                                      recording['id'],
-                                                      recording.get('created_at'),
-                                                      recording.get('updated_at'))
+        if recording:
+            end = reader.tell()
+            if end > pending:
+                reader.send(pending, end, send_upload)
 
-                pages = recording.get('pages')
-                if pages is None:
-                    pages = self.detect_pages(user, collection['id'], recording['id'])
+            self.finish_recording(user, collection, recording)
 
-                if pages:
-                    self.manager.import_pages(user, collection['id'], recording['id'], pages)
+    def iter_upload_infos(self, stream):
+        """ Iterate over all records, yielding (info, offset, length)
+        with info set for records that start a new collection or recording,
+        and the offset and length of the record itself
+        """
+        arciterator = ArchiveIterator(stream, no_record_parse=True, verify_http=True)
 
-    def _get_existing_coll(self, user, info):
-        return None
+        is_first = True
 
-    def detect_pages(self, user, coll, rec):
-        key = self.cdxj_key.format(user=user, coll=coll, rec=rec)
+        for record in arciterator(BLOCK_SIZE):
+            warcinfo = None
+            if record.rec_type == 'warcinfo':
+                try:
+                    warcinfo = self.parse_warcinfo(record)
+                except Exception as e:
+                    print('Error Parsing WARCINFO')
+                    traceback.print_exc()
 
-        pages = []
+            arciterator.read_to_end(record)
 
-        #for member, score in self.manager.redis.zscan_iter(key):
-        for member in self.manager.redis.zrange(key, 0, -1):
-            cdxj = CDXObject(member)
+            offset, length = arciterator.member_info[0], arciterator.member_info[1]
 
-            if len(pages) < 500 and self.is_page(cdxj):
-                pages.append(dict(url=cdxj['url'],
-                                  timestamp=cdxj['timestamp']))
+            indexinfo = None
 
-        return pages
+            if warcinfo:
+                indexinfo = warcinfo.get('json-metadata')
 
-    def is_page(self, cdxj):
-        if cdxj['url'].endswith('/robots.txt'):
-            return False
+                if 'title' not in indexinfo:
+                    indexinfo['title'] = 'Uploaded Recording'
 
-        if not cdxj['url'].startswith(('http://', 'https://')):
-            return False
+                if 'type' not in indexinfo:
+                    indexinfo['type'] = 'recording'
 
-        status = cdxj.get('status', '-')
+            elif is_first:
+                indexinfo = {'type': 'recording',
+                             'title': 'Uploaded Recording',
+                            }
 
-        if (cdxj['mime'] in ('text/html', 'text/plain')  and
-            status in ('200', '-') and
-            cdxj['digest'] != EMPTY_DIGEST):
+                # first record is part of the new recording
+                yield indexinfo, offset, 0
+                indexinfo = None
 
+            is_first = False
 
-            if status == '200':
-                # check for very long query, greater than the rest of url -- probably not a page
-                parts = cdxj['url'].split('?', 1)
-                if len(parts) == 2 and len(parts[1]) > len(parts[0]):
-                    return False
+            yield indexinfo, offset, length
 
-            return True
+    def _get_existing_coll(self, user, info):
+        return None
 
-        return False
+    def detect_pages(self, user, coll, rec):
+        """ Return the pages found by the indexer while the recording
+        was written, removing the list once read
+        """
+        key = self.detected_pages_key.format(user=user, coll=coll, rec=rec)
 
-    def do_upload(self, filename, stream, user, coll, rec, offset, length):
-        stream.seek(offset)
+        pi = self.manager.redis.pipeline()
+        pi.lrange(key, 0, -1)
+        pi.delete(key)
+        pages = pi.execute()[0]
 
-        logger.debug('do_upload(): {0} offset: {1}: len: {2}'.format(rec, offset, length))
+        return [json.loads(page.decode('utf-8')) for page in pages]
 
-        stream = LimitReader(stream, length)
+    def put_upload(self, stream, user, coll, rec, length):
         headers = {'Content-Length': str(length)}
 
         upload_url = self.upload_path.format(record_host=self.record_host,
@@ -275,79 +577,238 @@ class UploadController(BaseController):
                                        collection['id'],
                                        collection['title'],
                                        collection.get('desc', ''),
-                                       collection.get('public', False))
+                                       collection.get('public', False),
+                                       access_check=False)
 
         collection['id'] = actual_collection['id']
         collection['title'] = actual_collection['title']
 
         return collection
 
-    def parse_uploaded(self, stream):
-        arciterator = ArchiveIterator(stream, no_record_parse=True, verify_http=True)
-        infos = []
 
-        last_indexinfo = None
-        indexinfo = None
-        is_first = True
+# ============================================================================
+class UploadReader(object):
+    """ Wraps upload stream, keeping the bytes read so that records
+    can be forwarded once parsed, without rereading the stream
+
+    At most max_buff bytes are kept. Past that, eg. for a single large
+    record, the bytes are reread from the stream when sent, if seekable.
+    Records are always sent whole, as the recorder indexes each upload
+    """
+    def __init__(self, stream, max_buff=UPLOAD_MAX_BUFF_SIZE):
+        self.stream = stream
+        self.buff = bytearray()
+        self.buff_offset = 0
+        self.offset = 0
+
+        seekable = getattr(stream, 'seekable', None)
+        if seekable and seekable():
+            self.max_buff = max_buff
+            self.start = stream.tell()
+        else:
+            self.max_buff = None
+            self.start = None
+
+        # all bytes from buff_offset to offset are in buff
+        self.in_buff = True
+
+    def read(self, size=-1):
+        return self._add(self.stream.read(size))
+
+    def readline(self, size=-1):
+        return self._add(self.stream.readline(size))
+
+    def _add(self, data):
+        self.offset += len(data)
+
+        if self.in_buff:
+            if self.max_buff and len(self.buff) + len(data) > self.max_buff:
+                self.buff = bytearray()
+                self.in_buff = False
+            else:
+                self.buff.extend(data)
 
-        for record in arciterator(BLOCK_SIZE):
-            warcinfo = None
-            if record.rec_type == 'warcinfo':
-                try:
-                    warcinfo = self.parse_warcinfo(record)
-                except Exception as e:
-                    print('Error Parsing WARCINFO')
-                    traceback.print_exc()
+        return data
 
-            arciterator.read_to_end(record)
+    def tell(self):
+        return self.offset
 
-            if warcinfo:
-                new_offset = self.add_index_info(infos, indexinfo, arciterator)
+    def send(self, start, end, send_func):
+        """ call send_func(stream, length) with bytes from start to end,
+        from the buffer if kept, otherwise reread from the stream
+        """
+        if self.in_buff:
+            send_func(BytesIO(self.buff[start - self.buff_offset:end - self.buff_offset]),
+                      end - start)
+            return
 
-                indexinfo = warcinfo.get('json-metadata')
+        pos = self.stream.tell()
+        try:
+            self.stream.seek(self.start + start)
+            send_func(LimitReader(self.stream, end - start), end - start)
+        finally:
+            self.stream.seek(pos)
+
+    def discard(self, end):
+        """ drop bytes before end, no longer needed
+        """
+        if self.in_buff:
+            del self.buff[:end - self.buff_offset]
+
+        else:
+            # keep bytes already read past end, at most a block
+            pos = self.stream.tell()
+            try:
+                self.stream.seek(self.start + end)
+                self.buff = bytearray(self.stream.read(self.offset - end))
+            finally:
+                self.stream.seek(pos)
 
-                indexinfo['offset'] = new_offset
-                if 'title' not in indexinfo:
-                    indexinfo['title'] = 'Uploaded Recording'
+            self.in_buff = True
 
-                if 'type' not in indexinfo:
-                    indexinfo['type'] = 'recording'
+        self.buff_offset = end
 
-            elif is_first:
-                indexinfo = {'type': 'recording',
-                             'title': 'Uploaded Recording',
-                             'offset': 0,
-                            }
 
-            is_first = False
+# ============================================================================
+class UploadStatus(object):
+    """ Progress of an upload job, stored in redis so that any
+    app process can report it. Updates are sent at most once per UPDATE_SECS
+    """
+    UPDATE_SECS = 1.0
 
-        if indexinfo:
-            self.add_index_info(infos, indexinfo, arciterator)
+    INT_FIELDS = ('size', 'bytes', 'records', 'recordings')
 
-        return infos
+    def __init__(self, redis, key, ttl):
+        self.redis = redis
+        self.key = key
+        self.ttl = ttl
+        self.last_update = 0
+        self.pending = {}
 
-    def add_index_info(self, infos, indexinfo, arciterator):
-        new_offset = arciterator.member_info[0] + arciterator.member_info[1]
-        if indexinfo:
-            indexinfo['length'] = new_offset - indexinfo['offset']
-            infos.append(indexinfo)
+    def init(self, filename, size):
+        self.update(force=True,
+                    filename=filename,
+                    size=size,
+                    status='queued',
+                    bytes=0,
+                    records=0,
+                    recordings=0)
 
-        return new_offset
+    def update(self, force=False, **kwargs):
+        self.pending.update(kwargs)
 
-    def parse_warcinfo(self, record):
-        valid = False
-        warcinfo = {}
-        warcinfo_buff = record.stream.read(record.length)
-        warcinfo_buff = warcinfo_buff.decode('utf-8')
-        for line in warcinfo_buff.rstrip().split('\n'):
-            parts = line.split(':', 1)
+        now = time.time()
+        if not force and now - self.last_update < self.UPDATE_SECS:
+            return
+
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hmset(self.key, self.pending)
+            pi.expire(self.key, self.ttl)
+
+        self.pending = {}
+        self.last_update = now
+
+    def get(self):
+        result = self.redis.hgetall(self.key)
+        if not result:
+            return {}
+
+        result = dict((n.decode('utf-8'), v.decode('utf-8')) for n, v in result.items())
+
+        for field in self.INT_FIELDS:
+            if field in result:
+                result[field] = int(result[field])
+
+        return result
+
+
+# ============================================================================
+class UploadJobQueue(object):
+    """ Queue of uploads to process, kept in redis so jobs outlive the app
+    process, run by a pool of worker greenlets. A job is leased while
+    running. A job whose lease expires after it started was interrupted,
+    and is partly imported, so it fails rather than being run again
+    """
+    def __init__(self, redis, queue_key, jobs_key, lease_secs, poll_secs,
+                 num_workers, process, fail):
+        self.redis = redis
+        self.queue_key = queue_key
+        self.jobs_key = jobs_key
+        self.lease_secs = lease_secs
+        self.poll_secs = poll_secs
+        self.num_workers = num_workers
+        self.process = process
+        self.fail = fail
+        self.workers = []
+
+    def start(self):
+        """ Start the workers, in the app that runs the jobs.
+        Jobs queued before a restart are also run
+        """
+        if not self.workers:
+            self.workers = [gevent.spawn(self._work) for _ in range(self.num_workers)]
+
+    def put(self, job_id, job):
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.hset(self.jobs_key, job_id, json.dumps(job))
+            pi.zadd(self.queue_key, time.time(), job_id)
+
+    def _work(self):
+        while True:
+            try:
+                job_id = self._claim()
+                if not job_id:
+                    gevent.sleep(self.poll_secs)
+                    continue
+
+                self._run(job_id)
+
+            except Exception:
+                traceback.print_exc()
+                gevent.sleep(self.poll_secs)
+
+    def _claim(self):
+        claimed = []
+
+        def claim(pi):
+            now = time.time()
+            res = pi.zrangebyscore(self.queue_key, 0, now, start=0, num=1)
+            if not res:
+                return
+
+            pi.multi()
+            pi.zadd(self.queue_key, now + self.lease_secs, res[0])
+            claimed.append(res[0].decode('utf-8'))
+
+        self.redis.transaction(claim, self.queue_key)
+
+        return claimed[0] if claimed else None
+
+    def _renew(self, job_id):
+        while True:
+            gevent.sleep(self.lease_secs / 3.0)
+            self.redis.zadd(self.queue_key, time.time() + self.lease_secs, job_id)
+
+    def _run(self, job_id):
+        job = self.redis.hget(self.jobs_key, job_id)
+
+        if job:
+            job = json.loads(job.decode('utf-8'))
+
+            if job.get('started'):
+                print('Upload interrupted: ' + job_id)
+                self.fail(job, 'Upload interrupted, please try again')
 
-            if parts[0] == 'json-metadata':
-                warcinfo['json-metadata'] = json.loads(parts[1])
-                valid = True
             else:
-                warcinfo[parts[0]] = parts[1].strip()
+                job['started'] = int(time.time())
+                self.redis.hset(self.jobs_key, job_id, json.dumps(job))
 
-        # ignore if no json-metadata or doesn't contain type of colleciton or recording
-        return warcinfo if valid else None
+                renewer = gevent.spawn(self._renew, job_id)
+                try:
+                    self.process(job)
+                finally:
+                    renewer.kill()
 
+        with redis.utils.pipeline(self.redis) as pi:
+            pi.zrem(self.queue_key, job_id)
+            pi.hdel(self.jobs_key, job_id)
@@ -3,3 +3,37 @@ from pywb.webagg.utils import load_config
 def load_wr_config():
     return load_config('WR_CONFIG', 'pkg://webrecorder/config/wr.yaml', 'WR_USER_CONFIG', '')
 
+
+
+# ============================================================================
+EMPTY_DIGEST = '3I42H3S6NNFQ2MSVX7XZKYAYSCX5QBYJ'
+
+MAX_DETECT_PAGES = 500
+
+
+def is_page(cdxj):
+    """ Guess if a CDXJ entry is a top-level page, for recordings
+    that don't have a page list, such as uploaded WARCs
+    """
+    if cdxj['url'].endswith('/robots.txt'):
+        return False
+
+    if not cdxj['url'].startswith(('http://', 'https://')):
+        return False
+
+    status = cdxj.get('status', '-')
+
+    if (cdxj['mime'] in ('text/html', 'text/plain')  and
+        status in ('200', '-') and
+        cdxj['digest'] != EMPTY_DIGEST):
+
+
+        if status == '200':
+            # check for very long query, greater than the rest of url -- probably not a page
+            parts = cdxj['url'].split('?', 1)
+            if len(parts) == 2 and len(parts[1]) > len(parts[0]):
+                return False
+
+        return True
+
+    return False
@@ -6,6 +6,7 @@ import gevent
 import gevent.queue
 
 from webrecorder.basecontroller import BaseController
+from webrecorder.uploadcontroller import UploadStatus
 
 
 # ============================================================================
@@ -14,6 +15,9 @@ class WebsockController(BaseController):
         super(WebsockController, self).__init__(app, jinja_env, manager, config)
         self.status_update_secs = float(config['status_update_secs'])
 
+        self.upload_status_key = config['upload_status_key_templ']
+        self.upload_status_ttl = int(config['upload_status_ttl'])
+
     def init_routes(self):
         @self.app.get('/_client_ws')
         def client_ws():
@@ -44,7 +48,25 @@ class WebsockController(BaseController):
 
         return json.dumps(result)
 
+    def get_upload_status(self, user, upload_id):
+        key = self.upload_status_key.format(user=user, upid=upload_id)
+        status = UploadStatus(self.manager.redis, key, self.upload_status_ttl).get()
+
+        if status:
+            result = {'ws_type': 'upload'}
+            result.update(status)
+        else:
+            result = {'ws_type': 'error',
+                      'error_message': 'not found'}
+
+        return json.dumps(result)
+
     def client_ws(self):
+        # progress of an upload job instead of recording status
+        upload_id = request.query.getunicode('upload_id')
+        if upload_id:
+            return self.upload_ws(upload_id)
+
         user, coll = self.get_user_coll(api=True)
         rec = request.query.getunicode('rec', '*')
 
@@ -65,6 +87,17 @@ class WebsockController(BaseController):
 
         return self.run_ws(user, coll, rec, local_store, updater)
 
+    def upload_ws(self, upload_id):
+        user = self.manager.get_curr_user()
+
+        updater = StatusUpdater(self.status_update_secs,
+                                lambda user, coll, rec: self.get_upload_status(user, upload_id))
+
+        WebSockHandler('to', None, self.manager,
+                       'to_cbr_ps:', 'from_cbr_ps:',
+                       user, None, None,
+                       updater=updater).run()
+
     def client_ws_cont(self):
         info = self.manager.browser_mgr.init_cont_browser_sesh()
         if not info:
@@ -118,6 +151,9 @@ class BaseWebSockHandler(object):
         websocket_fd = self._get_ws_fd()
 
         while True:
+            # permissions and sizes may change while connected, don't reuse cached info
+            self.manager.reset_info_cache()
+
             self._multiplex(websocket_fd)
 
             if self.updater: